@@ -1,13 +1,17 @@
+from gzip import GzipFile
 from logging import StreamHandler
+from os import stat
 from os.path import isdir, isfile, join
 from sys import stderr
 from time import time
 from urllib import quote_plus
 
 from flask import (Blueprint, Flask, send_from_directory, current_app,
-                   send_file, request, redirect, jsonify, render_template)
+                   send_file, request, redirect, jsonify, render_template,
+                   Response, safe_join, abort)
 
 from dxr.query import Query, filter_menu_items
+from dxr.render import PageCache, render_file_page
 from dxr.server_utils import connect_db
 from dxr.utils import non_negative_int, search_url, TEMPLATE_DIR, sqlite3  # Make sure we load trilite before possibly importing the wrong version of sqlite3.
 
@@ -32,6 +36,10 @@ def make_app(instance_path):
     # Load the special config file generated by dxr-build:
     app.config.from_pyfile(join(app.instance_path, 'config.py'))
 
+    if app.config.get('RENDER_ON_DEMAND'):
+        app.page_cache = PageCache(app.config['RENDER_CACHE_FOLDER'],
+                                   app.config['RENDER_CACHE_SIZE'])
+
     # Log to Apache's error log in production:
     app.logger.addHandler(StreamHandler(stderr))
     return app
@@ -168,9 +176,35 @@ def search(tree):
 @dxr_blueprint.route('/<tree>/source/')
 @dxr_blueprint.route('/<tree>/source/<path:path>')
 def browse(tree, path=''):
-    """Show a directory listing or a single file from one of the trees."""
+    """Show a directory listing or a single file from one of the trees.
+
+    If the build left a gzipped copy of the page (see the html_compression
+    option), send that to clients that accept gzip. Decompress it on the fly
+    for the rest if there's no plain copy.
+
+    If the build left no page for a file at all and the render_on_demand
+    option is on, render the page now, from the database.
+
+    """
     tree_folder = _tree_folder(tree)
-    return send_from_directory(tree_folder, _html_file_path(tree_folder, path))
+    disk_path = _html_file_path(tree_folder, path)
+    gzipped_path = safe_join(tree_folder, disk_path + '.gz')
+    if isfile(gzipped_path):
+        if request.accept_encodings['gzip']:
+            response = send_from_directory(tree_folder,
+                                           disk_path + '.gz',
+                                           mimetype='text/html')
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
+        if not isfile(safe_join(tree_folder, disk_path)):
+            return Response(_gunzipped(gzipped_path), mimetype='text/html')
+    elif (current_app.config.get('RENDER_ON_DEMAND') and
+          tree in current_app.config['TREES'] and
+          not isfile(safe_join(tree_folder, disk_path)) and
+          not isdir(safe_join(tree_folder, path))):
+        return _rendered_page(tree, tree_folder, path)
+    return send_from_directory(tree_folder, disk_path)
 
 
 @dxr_blueprint.route('/<tree>/')
@@ -196,7 +230,8 @@ def parallel(tree, path=''):
     tree_folder = _tree_folder(tree)
     disk_path = _html_file_path(tree_folder, path)
     www_root = current_app.config['WWW_ROOT']
-    if isfile(join(tree_folder, disk_path)):
+    if (isfile(join(tree_folder, disk_path)) or
+        isfile(join(tree_folder, disk_path + '.gz'))):
         return redirect('{root}/{tree}/source/{path}'.format(
             root=www_root,
             tree=tree,
@@ -207,6 +242,44 @@ def parallel(tree, path=''):
             tree=tree))
 
 
+def _rendered_page(tree, tree_folder, path):
+    """Return a response with the page of a file rendered at request time, or
+    a 404 if the tree has no such file.
+
+    Pages come from the app's PageCache, keyed by the modification time of the
+    tree's database, which changes with every build.
+
+    """
+    generation = '%r' % stat(join(tree_folder, '.dxr-xref.sqlite')).st_mtime
+    page = current_app.page_cache.page(
+        tree, generation, path,
+        lambda out_path: render_file_page(current_app.jinja_env,
+                                          tree_folder,
+                                          generation,
+                                          path,
+                                          out_path))
+    if page is None:
+        abort(404)
+    return Response(page, mimetype='text/html')
+
+
+def _gunzipped(path):
+    """Yield the decompressed contents of a gzipped file, a chunk at a time."""
+    gzipped = GzipFile(path, 'rb')
+    try:
+        while True:
+            chunk = gzipped.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        gzipped.close()
+
+
+# How much decompressed HTML to send at once
+_CHUNK_SIZE = 64 * 1024
+
+
 def _tree_folder(tree):
     """Return the on-disk path to the root of the given tree's folder in the
     instance."""
@@ -1,22 +1,33 @@
+from array import array
 from codecs import getdecoder
+from collections import deque
+from contextlib import contextmanager
 import cgi
-from datetime import datetime
-from fnmatch import fnmatchcase
+import cPickle
+from datetime import datetime, timedelta
+from fnmatch import translate
+from gzip import GzipFile
+from hashlib import sha1
 from heapq import merge
-from itertools import chain, groupby, izip_longest
+from itertools import chain, groupby, izip_longest, tee
 import json
-from operator import itemgetter
+from mmap import mmap, ACCESS_READ
+from multiprocessing import Process, Semaphore
+from operator import attrgetter, itemgetter
 import os
-from os import stat
 from os.path import dirname
+import re
 import shutil
+import signal
+from stat import S_ISDIR, S_ISLNK
 import subprocess
 import sys
 from sys import exc_info
+from tempfile import SpooledTemporaryFile
 from traceback import format_exc
 from warnings import warn
 
-from concurrent.futures import as_completed, ProcessPoolExecutor
+from concurrent.futures import as_completed, Future, ProcessPoolExecutor
 from jinja2 import Markup
 from ordereddict import OrderedDict
 
@@ -34,6 +45,12 @@ except ImportError:
     def compress(data, selectors):
         return (d for d, s in izip(data, selectors) if s)
 
+try:
+    from scandir import scandir
+except ImportError:
+    def scandir(folder):
+        return [_DirEntry(folder, name) for name in os.listdir(folder)]
+
 
 def linked_pathname(path, tree_name):
     """Return a list of (server-relative URL, subtree name) tuples that can be
@@ -96,7 +113,7 @@ def build_instance(config_path, nb_jobs=None, tree=None, verbose=False):
     # Create config.target_folder (if not exists)
     print "Generating target folder"
     ensure_folder(config.target_folder, False)
-    ensure_folder(config.temp_folder, not skip_indexing)
+    ensure_folder(config.temp_folder, not skip_indexing and not config.incremental)
     ensure_folder(config.log_folder, not skip_indexing)
 
     jinja_env = load_template_env(config.temp_folder, config.dxrroot)
@@ -111,7 +128,10 @@ def build_instance(config_path, nb_jobs=None, tree=None, verbose=False):
                                     for t in config.trees)),
              wwwroot=repr(config.wwwroot),
              generated_date=repr(config.generated_date),
-             directory_index=repr(config.directory_index)))
+             directory_index=repr(config.directory_index),
+             render_on_demand=repr(bool(config.render_on_demand)),
+             render_cache_folder=repr(config.render_cache_folder),
+             render_cache_size=repr(config.render_cache_size * 1024 * 1024)))
 
     # Create jinja cache folder in target folder
     ensure_folder(os.path.join(config.target_folder, 'jinja_dxr_cache'))
@@ -120,66 +140,198 @@ def build_instance(config_path, nb_jobs=None, tree=None, verbose=False):
 
     # Build trees requested
     ensure_folder(os.path.join(config.target_folder, 'trees'))
-    for tree in trees:
-        # Note starting time
-        start_time = datetime.now()
-
-        # Create folders (delete if exists)
-        ensure_folder(tree.target_folder, not skip_indexing) # <config.target_folder>/<tree.name>
-        ensure_folder(tree.object_folder,                    # Object folder (user defined!)
-            tree.source_folder != tree.object_folder)        # Only clean if not the srcdir
-        ensure_folder(tree.temp_folder,   not skip_indexing) # <config.temp_folder>/<tree.name>
-                                                             # (or user defined)
-        ensure_folder(tree.log_folder,    not skip_indexing) # <config.log_folder>/<tree.name>
-                                                             # (or user defined)
-        # Temporary folders for plugins
-        ensure_folder(os.path.join(tree.temp_folder, 'plugins'), not skip_indexing)
-        for plugin in tree.enabled_plugins:     # <tree.config>/plugins/<plugin>
-            ensure_folder(os.path.join(tree.temp_folder, 'plugins', plugin), not skip_indexing)
-
-        # Connect to database (exits on failure: sqlite_version, tokenizer, etc)
-        conn = connect_database(tree)
+    concurrent_trees = min(config.concurrent_trees, len(trees))
+    if concurrent_trees > 1:
+        _build_trees_concurrently(config, trees, verbose, concurrent_trees)
+    else:
+        for tree in trees:
+            _build_one_tree(config, tree, verbose)
 
-        if skip_indexing:
-            print " - Skipping indexing (due to 'index' in 'skip_stages')"
-        else:
-            # Create database tables
-            create_tables(tree, conn)
+    # Print a neat summary
 
-            # Index all source files (for full text search)
-            # Also build all folder listing while we're at it
-            index_files(tree, conn)
 
-            # Build tree
+def _build_one_tree(config, tree, verbose):
+    """Index a tree and build its HTML."""
+    skip_indexing = 'index' in config.skip_stages
+
+    # Note starting time
+    start_time = datetime.now()
+
+    # Update the previous build in place if asked to and there is one.
+    # Otherwise, start from scratch.
+    incremental = (config.incremental and not skip_indexing and
+                   _has_manifest(tree))
+    clean = not skip_indexing and not incremental
+
+    # Create folders (delete if exists)
+    ensure_folder(tree.target_folder, clean)     # <config.target_folder>/<tree.name>
+    ensure_folder(tree.object_folder,            # Object folder (user defined!)
+        tree.source_folder != tree.object_folder # Only clean if not the srcdir
+        and not incremental)                     # or make has work to reuse
+    ensure_folder(tree.temp_folder,   clean)     # <config.temp_folder>/<tree.name>
+                                                 # (or user defined)
+    ensure_folder(tree.log_folder,    not skip_indexing) # <config.log_folder>/<tree.name>
+                                                         # (or user defined)
+    # Temporary folders for plugins
+    ensure_folder(os.path.join(tree.temp_folder, 'plugins'), clean)
+    for plugin in tree.enabled_plugins:     # <tree.config>/plugins/<plugin>
+        ensure_folder(os.path.join(tree.temp_folder, 'plugins', plugin), clean)
+
+    # Connect to database (exits on failure: sqlite_version, tokenizer, etc)
+    conn = connect_database(tree)
+
+    # Files with IDs from here on need their HTML (re)built:
+    if incremental:
+        first_file_id = conn.execute(
+            "SELECT coalesce(max(id), 0) + 1 FROM files").fetchone()[0]
+    else:
+        first_file_id = 1
+
+    if skip_indexing:
+        print " - Skipping indexing (due to 'index' in 'skip_stages')"
+    else:
+        # Create database tables
+        create_tables(tree, conn, incremental)
+
+        # Index all source files (for full text search)
+        # Also build all folder listing while we're at it
+        def ingest(nb_jobs):
+            tree.changed_paths = index_files(tree, conn, incremental, nb_jobs)
+
+        # Build tree
+        if config.index_while_building and _can_index_while_building(
+                tree, incremental):
+            build_tree(tree, conn, verbose, while_building=ingest)
+        else:
+            with _jobs(tree.config.nb_jobs) as nb_jobs:
+                ingest(nb_jobs)
             build_tree(tree, conn, verbose)
 
-            # Optimize and run integrity check on database
+        # Optimize and run integrity check on database
+        with _jobs(1):
             finalize_database(conn)
 
-            # Commit database
-            conn.commit()
+        # Commit database
+        conn.commit()
 
-        if 'html' in config.skip_stages:
-            print " - Skipping htmlifying (due to 'html' in 'skip_stages')"
-        else:
-            print "Building HTML for the '%s' tree." % tree.name
+    if config.render_on_demand:
+        # Leave the web app what it needs to render pages itself:
+        save_tree(tree)
 
-            max_file_id = conn.execute("SELECT max(files.id) FROM files").fetchone()[0]
+    if 'html' in config.skip_stages:
+        print " - Skipping htmlifying (due to 'html' in 'skip_stages')"
+    else:
+        print "Building HTML for the '%s' tree." % tree.name
+
+        max_file_id = conn.execute("SELECT max(files.id) FROM files").fetchone()[0]
+        if max_file_id is None or max_file_id < first_file_id:
+            print " - No new or changed files"
+        else:
             if config.disable_workers:
                 print " - Worker pool disabled (due to 'disable_workers')"
-                _build_html_for_file_ids(tree, 0, max_file_id)
-            else:
-                run_html_workers(tree, config, max_file_id)
+            run_html_workers(tree, config, conn, first_file_id)
 
-        # Close connection
-        conn.commit()
-        conn.close()
+    # Close connection
+    conn.commit()
+    conn.close()
 
-        # Save the tree finish time
-        delta = datetime.now() - start_time
-        print "(finished building '%s' in %s)" % (tree.name, delta)
+    # Save the tree finish time
+    delta = datetime.now() - start_time
+    print "(finished building '%s' in %s)" % (tree.name, delta)
 
-    # Print a neat summary
+
+def _build_trees_concurrently(config, trees, verbose, concurrent_trees):
+    """Build trees in separate processes, ``concurrent_trees`` at a time.
+
+    The trees share a budget of ``nb_jobs`` processes, so the
+    single-process stages of some trees can overlap the parallel stages of
+    others without overloading the machine. Exit with an error if any tree
+    fails, but only once the rest are done.
+
+    """
+    global _job_budget
+    _job_budget = _JobBudget(int(config.nb_jobs))
+
+    pending = list(trees)
+    running = []
+    failed = []
+    while pending or running:
+        while pending and len(running) < concurrent_trees:
+            tree = pending.pop(0)
+            process = Process(target=_build_one_tree,
+                              args=(config, tree, verbose))
+            process.start()
+            running.append((tree, process))
+
+        # Wait a bit for a tree to finish:
+        running[0][1].join(0.1)
+        for tree, process in running[:]:
+            if not process.is_alive():
+                process.join()
+                running.remove((tree, process))
+                if process.exitcode:
+                    failed.append(tree.name)
+
+    if failed:
+        print >> sys.stderr, "Building failed for: %s" % ', '.join(failed)
+        sys.exit(1)
+
+
+class _JobBudget(object):
+    """A number of processes which the trees being built at once share
+
+    Each stage of a tree's build reserves as many processes as it wants and
+    are free, waiting for at least one. Since nothing waits while holding part
+    of the budget, the trees can't deadlock.
+
+    """
+    def __init__(self, size):
+        self._tokens = Semaphore(size)
+
+    def acquire(self, wanted):
+        """Wait for 1 process, take up to ``wanted`` if they're free, and
+        return how many were taken."""
+        self._tokens.acquire()
+        granted = 1
+        while granted < wanted and self._tokens.acquire(False):
+            granted += 1
+        return granted
+
+    def release(self, count):
+        for _ in xrange(count):
+            self._tokens.release()
+
+
+# The budget the trees share when built concurrently, None otherwise
+_job_budget = None
+
+# How much of _job_budget this process holds
+_jobs_held = 0
+
+
+@contextmanager
+def _jobs(wanted):
+    """Reserve up to ``wanted`` processes' worth of the job budget for the
+    duration of the block, and return how many can be used.
+
+    Without a budget, that's always ``wanted``. Reservations nested in another
+    share it rather than waiting for more, so a process never waits while
+    holding part of the budget.
+
+    """
+    global _jobs_held
+    wanted = int(wanted)
+    if _job_budget is None:
+        yield wanted
+    elif _jobs_held:
+        yield min(wanted, _jobs_held)
+    else:
+        _jobs_held = _job_budget.acquire(wanted)
+        try:
+            yield _jobs_held
+        finally:
+            _job_budget.release(_jobs_held)
+            _jobs_held = 0
 
 
 def ensure_folder(folder, clean=False):
@@ -194,97 +346,492 @@ def ensure_folder(folder, clean=False):
         os.mkdir(folder)
 
 
-def create_tables(tree, conn):
+def create_tables(tree, conn, incremental=False):
+    """Create the tables of the common schema.
+
+    :arg incremental: Whether to keep the tables about files from a previous
+        build, so they can be updated in place. The rest start out empty
+        either way.
+
+    """
     print "Creating tables"
-    conn.execute("CREATE VIRTUAL TABLE trg_index USING trilite")
-    conn.executescript(dxr.languages.language_schema.get_create_sql())
+    if incremental:
+        for name, table in dxr.languages.language_schema.tables.iteritems():
+            if name not in _INCREMENTAL_TABLES:
+                conn.executescript(table.get_create_sql())
+    else:
+        conn.execute("CREATE VIRTUAL TABLE trg_index USING trilite")
+        conn.executescript(dxr.languages.language_schema.get_create_sql())
+    conn.execute("DROP TABLE IF EXISTS symbol_trg")
+    conn.execute("CREATE VIRTUAL TABLE symbol_trg USING trilite")
+
+
+# Tables which incremental builds update rather than recreate
+_INCREMENTAL_TABLES = ['files', 'blobs', 'manifest']
+
+# Tables whose names go into symbol_trg: all those the search filters match
+# names in with LIKE
+_SYMBOL_TABLES = ['functions', 'types', 'variables', 'macros', 'typedefs',
+                  'namespaces', 'namespace_aliases']
 
 
-def _unignored_folders(folders, source_path, ignore_patterns, ignore_paths):
-    """Yield the folders from ``folders`` which are not ignored by the given
-    patterns and paths.
+def _has_manifest(tree):
+    """Return whether a previous build of the tree left a manifest (and the
+    other tables incremental builds update) to build incrementally from."""
+    if not os.path.isfile(os.path.join(tree.target_folder, '.dxr-xref.sqlite')):
+        return False
+    conn = connect_database(tree)
+    try:
+        return conn.execute("SELECT count(*) FROM sqlite_master "
+                            "WHERE type = 'table' AND name IN (%s)" %
+                            ', '.join('?' for t in _INCREMENTAL_TABLES),
+                            _INCREMENTAL_TABLES
+                            ).fetchone()[0] == len(_INCREMENTAL_TABLES)
+    finally:
+        conn.close()
+
+
+def _ignore_matcher(ignore_patterns, ignore_paths):
+    """Return a callable that takes the name of a file or folder and its path
+    relative to the source folder, and returns whether it's ignored.
+
+    Each list of globs is compiled into one regex up front, rather than
+    translating every glob for every file.
 
-    :arg source_path: Relative path to the source directory
     :arg ignore_patterns: Non-path-based globs to be ignored
-    :arg ignore_paths: Path-based globs to be ignored
+    :arg ignore_paths: Path-based globs to be ignored. These are matched
+        against the path with a leading slash and, for folders, a trailing
+        one.
 
     """
-    for folder in folders:
-        if not any(fnmatchcase(folder, p) for p in ignore_patterns):
-            folder_path = '/' + os.path.join(source_path, folder).replace(os.sep, '/') + '/'
-            if not any(fnmatchcase(folder_path, p) for p in ignore_paths):
-                yield folder
+    def compiled(globs):
+        if not globs:
+            return lambda string: False
+        return re.compile('|'.join(translate(g) for g in globs)).match
+    name_is_ignored = compiled(ignore_patterns)
+    path_is_ignored = compiled(ignore_paths)
 
+    def is_ignored(name, path, is_folder=False):
+        path = '/' + path.replace(os.sep, '/') + ('/' if is_folder else '')
+        return bool(name_is_ignored(name) or path_is_ignored(path))
+    return is_ignored
 
-def index_files(tree, conn):
-    """Build the ``files`` table, the trigram index, and the HTML folder listings."""
-    print "Indexing files from the '%s' tree" % tree.name
-    start_time = datetime.now()
-    cur = conn.cursor()
-    # Walk the directory tree top-down, this allows us to modify folders to
-    # exclude folders matching an ignore_pattern
-    for root, folders, files in os.walk(tree.source_folder, topdown=True):
-        # Find relative path
-        rel_path = os.path.relpath(root, tree.source_folder)
-        if rel_path == '.':
-            rel_path = ""
 
-        # List of file we indexed (ie. add to folder listing)
-        indexed_files = []
-        for f in files:
-            # Ignore file if it matches an ignore pattern
-            if any(fnmatchcase(f, e) for e in tree.ignore_patterns):
-                continue  # Ignore the file.
+def _walk_source(tree):
+    """Walk the source folder of a tree top-down, like ``os.walk()``, leaving
+    out ignored files and folders.
 
-            # file_path and path
-            file_path = os.path.join(root, f)
-            path = os.path.join(rel_path, f)
+    Yield (relative path, folders, files) for each folder, where ``folders``
+    and ``files`` are lists of directory entries sorted by name. Each entry
+    has ``name`` and ``path`` attributes and caches its ``stat()``, so nothing
+    is stat'd more than once. Like ``os.walk()``, don't descend into symlinks
+    to folders, and skip folders that can't be listed.
 
-            # Ignore file if its path (relative to the root) matches an ignore path
-            if any(fnmatchcase("/" + path.replace(os.sep, "/"), e) for e in tree.ignore_paths):
-                continue  # Ignore the file.
+    """
+    is_ignored = _ignore_matcher(tree.ignore_patterns, tree.ignore_paths)
+    pending = ['']
+    while pending:
+        rel_path = pending.pop()
+        try:
+            entries = sorted(scandir(os.path.join(tree.source_folder, rel_path)),
+                             key=attrgetter('name'))
+        except OSError:
+            continue
+        folders, files = [], []
+        for entry in entries:
+            path = os.path.join(rel_path, entry.name)
+            try:
+                is_folder = entry.is_dir()
+                entry.stat()  # Skip things like dangling symlinks.
+            except OSError:
+                continue
+            if not is_ignored(entry.name, path, is_folder):
+                (folders if is_folder else files).append(entry)
+        yield rel_path, folders, files
+        pending.extend(os.path.join(rel_path, f.name) for f in reversed(folders)
+                       if not f.is_symlink())
 
-            # the file
-            with open(file_path, "r") as source_file:
-                data = source_file.read()
 
-            # Discard non-text files
-            if not dxr.mime.is_text(file_path, data):
-                continue
+class _DirEntry(object):
+    """A stand-in for the entries ``scandir()`` returns, for when the scandir
+    module isn't installed
+
+    Like the real thing, it follows symlinks, except in ``is_symlink()``, and
+    caches what it stats.
+
+    """
+    def __init__(self, folder, name):
+        self.name = name
+        self.path = os.path.join(folder, name)
+        self._stat = self._lstat = None
+
+    def is_dir(self):
+        return S_ISDIR(self.stat().st_mode)
 
-            # Find an icon (ideally dxr.mime should use magic numbers, etc.)
-            # that's why it makes sense to save this result in the database
-            icon = dxr.mime.icon(path)
+    def is_symlink(self):
+        return S_ISLNK(self._lstat_result().st_mode)
 
-            # Insert this file
-            cur.execute("INSERT INTO files (path, icon, encoding) VALUES (?, ?, ?)",
-                        (path, icon, tree.source_encoding))
-            # Index this file
-            sql = "INSERT INTO trg_index (id, text) VALUES (?, ?)"
-            cur.execute(sql, (cur.lastrowid, data))
+    def stat(self):
+        if self._stat is None:
+            if self.is_symlink():
+                self._stat = os.stat(self.path)
+            else:
+                self._stat = self._lstat
+        return self._stat
+
+    def _lstat_result(self):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+
+def index_files(tree, conn, incremental=False, nb_jobs=None):
+    """Build the ``files`` table, the trigram index, the manifest, and the HTML
+    folder listings.
 
-            # Okay to this file was indexed
-            indexed_files.append(f)
+    Reading and sniffing the files is farmed out to a pool of ``nb_jobs``
+    processes (unless workers are disabled), while this process walks the tree,
+    writes the folder listings, and is the single writer to the database.
 
-        # Exclude folders that match an ignore pattern.
-        # os.walk listens to any changes we make in `folders`.
-        folders[:] = _unignored_folders(
-            folders, rel_path, tree.ignore_patterns, tree.ignore_paths)
+    :arg incremental: Whether to update the tables from a previous build rather
+        than fill empty ones. Files whose size and modification time match
+        their manifest entries aren't even read, and files whose contents
+        haven't changed keep their IDs.
 
+    :arg nb_jobs: How many processes to use. Defaults to the configured
+        ``nb_jobs``.
+
+    Return the set of paths which were added, changed, or deleted since the
+    previous build if ``incremental``, None otherwise.
+
+    """
+    print "Indexing files from the '%s' tree" % tree.name
+    start_time = datetime.now()
+    nb_jobs = int(nb_jobs or tree.config.nb_jobs)
+    writer = _FileRowWriter(conn, tree.source_encoding,
+                            _INGESTION_BATCH_SIZE * nb_jobs)
+
+    # path -> (size, mtime, hash, file_id) as of the last build:
+    manifest = {}
+    if incremental:
+        for path, size, mtime, hash, file_id in conn.execute(
+                "SELECT path, size, mtime, hash, file_id FROM manifest"):
+            manifest[path] = size, mtime, hash, file_id
+    changed_paths = set()
+    seen_folders = set()
+
+    if nb_jobs > 1 and not tree.config.disable_workers:
+        pool = ProcessPoolExecutor(max_workers=nb_jobs)
+        submit = pool.submit
+    else:
+        pool = None
+        submit = _inline_future
+
+    # Folders whose files are being read, oldest first. Keeping a couple of
+    # them per worker in flight keeps the pool busy without letting file
+    # contents pile up in memory.
+    in_flight = deque()
+
+    def write_folder():
+        """Index the files of the oldest in-flight folder, and build its
+        listing."""
+        rel_path, folders, unchanged_files, stats, future = in_flight.popleft()
+        indexed_files = unchanged_files
+        for f, hash, icon, data in future.result():
+            path = os.path.join(rel_path, f)
+            file_info = stats[f]
+            old_size, old_mtime, old_hash, file_id = manifest.pop(
+                path, (None, None, None, None))
+            if hash != old_hash:
+                # New or changed: replace whatever we had for it.
+                if file_id is not None:
+                    writer.remove(file_id)
+                    _remove_html(tree, path)
+                file_id = (writer.add(path, icon, data, hash)
+                           if data is not None else None)
+                changed_paths.add(path)
+            # else it was just touched, so keep its rows and HTML.
+            writer.record(path, file_info.st_size, file_info.st_mtime, hash,
+                          file_id)
+            if file_id is not None:
+                indexed_files.append((f, file_info))
         indexed_files.sort()
-        folders.sort()
-        # Now build folder listing and folders for indexed_files
         build_folder(tree, conn, rel_path, indexed_files, folders)
 
+    try:
+        for rel_path, folders, files in _walk_source(tree):
+            seen_folders.add(rel_path)
+
+            # Files worth reading (ie. not known to be the same as last time)
+            files_to_read = []
+            unchanged_files = []
+            stats = {}
+            for entry in files:
+                file_info = stats[entry.name] = entry.stat()
+                path = os.path.join(rel_path, entry.name)
+                old = manifest.get(path)
+                if old and old[:2] == (file_info.st_size, file_info.st_mtime):
+                    # Trust the size and mtime, as make does.
+                    del manifest[path]
+                    if old[3] is not None:
+                        unchanged_files.append((entry.name, file_info))
+                else:
+                    files_to_read.append(entry.name)
+
+            in_flight.append((rel_path,
+                              [(f.name, f.stat()) for f in folders],
+                              unchanged_files,
+                              stats,
+                              submit(_read_files,
+                                     os.path.join(tree.source_folder, rel_path),
+                                     files_to_read,
+                                     tree.max_file_size,
+                                     tree.large_file_policy)))
+            if len(in_flight) > 2 * nb_jobs:
+                write_folder()
+
+        while in_flight:
+            write_folder()
+    finally:
+        if pool:
+            pool.shutdown()
+
+    # Whatever is left in the manifest is gone from the source tree.
+    for path, (size, mtime, hash, file_id) in manifest.iteritems():
+        writer.forget(path)
+        if file_id is not None:
+            writer.remove(file_id)
+            _remove_html(tree, path)
+        changed_paths.add(path)
+    if incremental:
+        _remove_stale_folders(tree, seen_folders)
+
     # Okay, let's commit everything
+    writer.close()
     conn.commit()
 
+    if incremental:
+        print " - %s files added, changed, or deleted" % len(changed_paths)
+
     # Print time
     print "(finished in %s)" % (datetime.now() - start_time)
+    return changed_paths if incremental else None
+
+
+# Number of files per nb_jobs to buffer before writing them to the database
+_INGESTION_BATCH_SIZE = 256
+
+
+def _inline_future(fn, *args):
+    """Call ``fn`` right away, and return a completed Future of its result.
+
+    This stands in for ``ProcessPoolExecutor.submit()`` when we aren't using a
+    worker pool.
+
+    """
+    future = Future()
+    future.set_result(fn(*args))
+    return future
+
+
+def _read_files(folder, names, max_size=0, large_file_policy='skip'):
+    """Read the files called ``names`` in ``folder``, and return a list of
+    (name, hex SHA-1, icon, contents) tuples. Icon and contents are None for
+    files that aren't text.
+
+    Whether a file is text is decided from its first ``dxr.mime.SNIFF_SIZE``
+    bytes. Anything bigger than that is mapped into memory rather than read,
+    so hashing big files, or taking only part of them, doesn't copy them all
+    into our heap.
+
+    This is the top-level function of a file-ingestion worker process.
+
+    :arg max_size: The size in bytes over which ``large_file_policy`` applies
+        to a text file, 0 for no limit
+    :arg large_file_policy: What to do with text files over ``max_size``:
+        "skip" treats them like binaries, "path" indexes them as if they were
+        empty, and "truncate" indexes their first ``max_size`` bytes, up to
+        the last line break
+
+    """
+    read_files = []
+    for name in names:
+        file_path = os.path.join(folder, name)
+        with open(file_path, "rb") as source_file:
+            data = source_file.read(dxr.mime.SNIFF_SIZE)
+            if len(data) == dxr.mime.SNIFF_SIZE:
+                data = _mapped_file(source_file)
+            hash = sha1(data).hexdigest()
+
+            # Don't index non-text files
+            if not dxr.mime.is_text(file_path, data[:dxr.mime.SNIFF_SIZE]):
+                read_files.append((name, hash, None, None))
+                continue
+
+            if max_size and len(data) > max_size:
+                if large_file_policy == 'skip':
+                    read_files.append((name, hash, None, None))
+                    continue
+                elif large_file_policy == 'path':
+                    data = ''
+                else:  # truncate
+                    data = data[:max_size]
+                    data = data[:data.rfind('\n') + 1] or data
+            else:
+                data = data[:]
+
+        # Find an icon (ideally dxr.mime should use magic numbers, etc.)
+        # that's why it makes sense to save this result in the database
+        read_files.append((name, hash, dxr.mime.icon(file_path), data))
+    return read_files
+
+
+def _mapped_file(file):
+    """Return a read-only memory map of a whole file."""
+    return mmap(file.fileno(), 0, access=ACCESS_READ)
+
+
+def _remove_html(tree, path):
+    """Delete the HTML page of a file, and any gzipped copy, if it has them."""
+    html_path = os.path.join(tree.target_folder, path + '.html')
+    _remove_if_exists(html_path)
+    _remove_if_exists(html_path + '.gz')
+
+
+def _remove_if_exists(path):
+    """Delete a file, if it exists."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _remove_stale_folders(tree, folders):
+    """Delete the output folders of any source folders not in ``folders``."""
+    for root, subfolders, files in os.walk(tree.target_folder, topdown=True):
+        rel_path = os.path.relpath(root, tree.target_folder)
+        if rel_path == '.':
+            rel_path = ""
+        for folder in subfolders[:]:
+            if os.path.join(rel_path, folder) not in folders:
+                shutil.rmtree(os.path.join(root, folder))
+                subfolders.remove(folder)
+
+
+class _FileRowWriter(object):
+    """A buffer of changes to the ``files``, ``blobs``, ``trg_index``, and
+    ``manifest`` tables, written out with ``executemany()`` whenever
+    ``batch_size`` files have piled up
+
+    Files with identical contents share a single blob, so their text is stored
+    and trigram-indexed only once.
+
+    """
+    def __init__(self, conn, encoding, batch_size):
+        self.conn = conn
+        self.encoding = encoding
+        self.batch_size = batch_size
+        self.next_id = conn.execute(
+            "SELECT coalesce(max(id), 0) FROM files").fetchone()[0] + 1
+        self.next_blob_id = conn.execute(
+            "SELECT coalesce(max(id), 0) FROM blobs").fetchone()[0] + 1
+        self.blob_ids = dict(conn.execute("SELECT hash, id FROM blobs"))
+        self.files = []
+        self.blobs = []
+        self.texts = []
+        self.manifest = []
+        self.removed_ids = []
+        self.removed_paths = []
+
+    def add(self, path, icon, data, hash):
+        """Queue a file for insertion, and return its ID.
+
+        :arg hash: The hex SHA-1 of the file, which identifies its blob
+
+        """
+        id = self.next_id
+        self.next_id += 1
+        blob_id = self.blob_ids.get(hash)
+        if blob_id is None:
+            blob_id = self.blob_ids[hash] = self.next_blob_id
+            self.next_blob_id += 1
+            self.blobs.append((blob_id, hash))
+            self.texts.append((blob_id, data))
+        self.files.append((id, path, icon, self.encoding, blob_id))
+        if len(self.files) >= self.batch_size:
+            self.flush()
+        return id
+
+    def remove(self, id):
+        """Queue the deletion of a file previously added.
+
+        Its blob stays until ``close()``, in case another file still has the
+        same contents.
+
+        """
+        self.removed_ids.append((id,))
+
+    def record(self, path, size, mtime, hash, file_id):
+        """Queue a manifest entry to be inserted or updated."""
+        self.manifest.append((path, size, mtime, hash, file_id))
+        if len(self.manifest) >= self.batch_size:
+            self.flush()
+
+    def forget(self, path):
+        """Queue the deletion of a manifest entry."""
+        self.removed_paths.append((path,))
+
+    def flush(self):
+        """Write out all the queued changes."""
+        if self.removed_ids:
+            self.conn.executemany("DELETE FROM files WHERE id = ?",
+                                  self.removed_ids)
+            del self.removed_ids[:]
+        if self.blobs:
+            self.conn.executemany(
+                "INSERT INTO blobs (id, hash) VALUES (?, ?)",
+                self.blobs)
+            self.conn.executemany(
+                "INSERT INTO trg_index (id, text) VALUES (?, ?)",
+                self.texts)
+            del self.blobs[:]
+            del self.texts[:]
+        if self.files:
+            self.conn.executemany(
+                "INSERT INTO files (id, path, icon, encoding, blob_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                self.files)
+            del self.files[:]
+        if self.removed_paths:
+            self.conn.executemany("DELETE FROM manifest WHERE path = ?",
+                                  self.removed_paths)
+            del self.removed_paths[:]
+        if self.manifest:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO manifest (path, size, mtime, hash, file_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                self.manifest)
+            del self.manifest[:]
+
+    def close(self):
+        """Write out all the queued changes, and delete the blobs no file uses
+        anymore."""
+        self.flush()
+        orphans = self.conn.execute(
+            "SELECT id FROM blobs WHERE id NOT IN (SELECT blob_id FROM files)"
+            ).fetchall()
+        self.conn.executemany("DELETE FROM blobs WHERE id = ?", orphans)
+        self.conn.executemany("DELETE FROM trg_index WHERE id = ?", orphans)
 
 
 def build_folder(tree, conn, folder, indexed_files, indexed_folders):
-    """Build an HTML index file for a single folder."""
+    """Build an HTML index file for a single folder.
+
+    :arg indexed_files: A sorted list of (name, stat result) for the files
+    :arg indexed_folders: A sorted list of (name, stat result) for the
+        subfolders
+
+    """
     # Create the subfolder if it doesn't exist:
     ensure_folder(os.path.join(tree.target_folder, folder))
 
@@ -295,20 +842,15 @@ def build_folder(tree, conn, folder, indexed_files, indexed_folders):
     # Generate list of folders and their mod dates:
     folders = [('folder',
                 f,
-                datetime.fromtimestamp(stat(os.path.join(tree.source_folder,
-                                                         folder,
-                                                         f)).st_mtime),
+                datetime.fromtimestamp(folder_info.st_mtime),
                 # TODO: DRY with Flask route. Use url_for:
                 _join_url(tree.name, 'source', folder, f))
-               for f in indexed_folders]
+               for f, folder_info in indexed_folders]
 
     # Generate list of files:
     files = []
-    for f in indexed_files:
-        # Get file path on disk
-        path = os.path.join(tree.source_folder, folder, f)
-        file_info = stat(path)
-        files.append((dxr.mime.icon(path),
+    for f, file_info in indexed_files:
+        files.append((dxr.mime.icon(f),
                       f,
                       datetime.fromtimestamp(file_info.st_mtime),
                       file_info.st_size,
@@ -342,7 +884,8 @@ def build_folder(tree, conn, folder, indexed_files, indexed_folders):
          'name': name,
          'path': folder,
          'folders': folders,
-         'files': files})
+         'files': files},
+        tree.config.html_compression)
 
 
 def _join_url(*args):
@@ -350,15 +893,67 @@ def _join_url(*args):
     return '/'.join(a for a in args if a)
 
 
-def _fill_and_write_template(jinja_env, template_name, out_path, vars):
+def _fill_and_write_template(jinja_env, template_name, out_path, vars,
+                             compression=''):
     """Get the template `template_name` from the template folder, substitute in
-    `vars`, and write the result to `out_path`."""
+    `vars`, and write the result to `out_path`.
+
+    :arg compression: The html_compression option: '' to write just
+        `out_path`, 'gzip' to also write a gzipped copy to `out_path` + '.gz',
+        or 'gzip-only' to write only the gzipped copy. Whichever of the two
+        isn't written is deleted, lest a previous build's be served.
+
+    """
     template = jinja_env.get_template(template_name)
-    template.stream(**vars).dump(out_path, encoding='utf-8')
+    stream = template.stream(**vars)
+    gzipped_path = out_path + '.gz'
+    if compression == 'gzip-only':
+        gzipped = GzipFile(gzipped_path, 'wb', _HTML_COMPRESSION_LEVEL)
+        try:
+            stream.dump(gzipped, encoding='utf-8')
+        finally:
+            gzipped.close()
+        _remove_if_exists(out_path)
+    else:
+        stream.dump(out_path, encoding='utf-8')
+        if compression == 'gzip':
+            gzipped = GzipFile(gzipped_path, 'wb', _HTML_COMPRESSION_LEVEL)
+            try:
+                with open(out_path, 'rb') as plain:
+                    shutil.copyfileobj(plain, gzipped)
+            finally:
+                gzipped.close()
+        else:
+            _remove_if_exists(gzipped_path)
+
+
+# zlib's default: most of the savings of 9 in much less time
+_HTML_COMPRESSION_LEVEL = 6
+
+
+def _can_index_while_building(tree, incremental):
+    """Return whether the files of a tree can be indexed while its build
+    command runs.
+
+    Not if the build writes into the source folder, lest we index half-written
+    build products, and not for incremental builds, whose plugins need
+    ``tree.changed_paths`` before the build starts (and whose indexing is quick
+    anyway).
+
+    """
+    return not incremental and not (tree.object_folder + os.sep).startswith(
+        tree.source_folder + os.sep)
+
+
+def build_tree(tree, conn, verbose, while_building=None):
+    """Build the tree, pre_process, build and post_process.
 
+    :arg while_building: A callable to run while the build command does,
+        passed how many processes it may use. Those are taken out of the ones
+        reserved for the build command, rather than added to them. The
+        plugins' post-processing waits for both to finish.
 
-def build_tree(tree, conn, verbose):
-    """Build the tree, pre_process, build and post_process."""
+    """
     # Load indexers
     indexers = load_indexers(tree)
 
@@ -380,14 +975,34 @@ def build_tree(tree, conn, verbose):
     with open_log(tree, 'build.log', verbose) as log:
         # Call the make command
         print "Building the '%s' tree" % tree.name
-        r = subprocess.call(
-            tree.build_command.replace('$jobs', tree.config.nb_jobs),
-            shell   = True,
-            stdout  = log,
-            stderr  = log,
-            env     = environ,
-            cwd     = tree.object_folder
-        )
+        with _jobs(tree.config.nb_jobs) as jobs:
+            if while_building:
+                # Split the processes, so the two together use no more than
+                # the build command would alone.
+                while_jobs = max(1, jobs // 2)
+                jobs = max(1, jobs - while_jobs)
+            build = subprocess.Popen(
+                tree.build_command.replace('$jobs', str(jobs)),
+                shell   = True,
+                stdout  = log,
+                stderr  = log,
+                env     = environ,
+                cwd     = tree.object_folder,
+                # In a group of its own, so we can stop make and the
+                # compilers along with the shell:
+                preexec_fn = os.setsid
+            )
+            try:
+                if while_building:
+                    while_building(while_jobs)
+                r = build.wait()
+            except:
+                try:
+                    os.killpg(build.pid, signal.SIGKILL)
+                except OSError:  # It's already gone.
+                    pass
+                build.wait()
+                raise
 
     # Abort if build failed!
     if r != 0:
@@ -399,9 +1014,30 @@ def build_tree(tree, conn, verbose):
                 print >> sys.stderr, '    | %s ' % '    | '.join(log_file)
         sys.exit(1)
 
-    # Let plugins post process
+    # Let plugins post process, reserving processes only while they use them
+    tree.post_process_jobs = _jobs
     for indexer in indexers:
         indexer.post_process(tree, conn)
+    index_symbol_names(conn)
+
+
+def index_symbol_names(conn):
+    """Fill symbol_trg, a trigram index of the distinct names of symbols.
+
+    Search filters look names up in it before matching patterns which start
+    with a wildcard, like ``function:*foo*``, since no B-tree index can help
+    with those.
+
+    """
+    print "Indexing symbol names"
+    tables = set(name for name, in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    selects = ['SELECT name FROM %s WHERE name IS NOT NULL' % table
+               for table in _SYMBOL_TABLES if table in tables]
+    if selects:
+        names = conn.execute(' UNION '.join(selects))
+        conn.executemany("INSERT INTO symbol_trg (id, text) VALUES (?, ?)",
+                         enumerate((name for name, in names), 1))
 
 
 def finalize_database(conn):
@@ -437,44 +1073,134 @@ def build_sections(tree, conn, path, text, htmlifiers):
     return [(section, list(items)) for importance, section, items in links]
 
 
-def _sliced_range_bounds(a, b, slice_size):
-    """Divide ``range(a, b)`` into slices of size ``slice_size``, and
-    return the min and max values of each slice."""
-    this_min = a
-    while this_min == a or this_max < b:
-        this_max = min(b, this_min + slice_size - 1)
-        yield this_min, this_max
-        this_min = this_max + 1
+def _html_batches(sizes, nb_jobs):
+    """Divide files into batches for the HTML workers, and return them as a
+    list of (file IDs, total size) tuples, biggest first.
+
+    Handing out the biggest batches first and the small ones last, as workers
+    free up, keeps one worker stuck on huge files from finishing long after
+    the others.
+
+    :arg sizes: An iterable of (file ID, size in bytes)
+    :arg nb_jobs: The number of workers
+
+    """
+    sizes = sorted(sizes, key=itemgetter(1), reverse=True)
+    batch_size = max(sum(size for id, size in sizes) /
+                     (nb_jobs * _HTML_BATCHES_PER_WORKER),
+                     1)
+    batches = []
+    ids, total = [], 0
+    for id, size in sizes:
+        if ids and (total + size > batch_size or
+                    len(ids) == _MAX_HTML_BATCH_LENGTH):
+            batches.append((ids, total))
+            ids, total = [], 0
+        ids.append(id)
+        total += size
+    if ids:
+        batches.append((ids, total))
+    return batches
+
+
+# About how many batches of HTML to build per worker
+_HTML_BATCHES_PER_WORKER = 8
+
+# The most files to build HTML for in one batch
+_MAX_HTML_BATCH_LENGTH = 500
+
 
+def run_html_workers(tree, config, conn, min_file_id=1):
+    """Farm out the building of HTML for file IDs from ``min_file_id`` on to a
+    pool of processes, balancing their work by file size.
 
-def run_html_workers(tree, config, max_file_id):
-    """Farm out the building of HTML to a pool of processes."""
+    Build it all in this process if workers are disabled.
 
-    print ' - Initializing worker pool'
+    """
+    sizes = conn.execute("SELECT file_id, size, path FROM manifest "
+                         "WHERE file_id >= ?", [min_file_id]).fetchall()
+    if tree.prerender or tree.prerender_paths:
+        # Leave the rest to be rendered on demand by the web app:
+        is_prerendered = _ignore_matcher(tree.prerender, tree.prerender_paths)
+        sizes = [(id, size) for id, size, path in sizes
+                 if is_prerendered(os.path.basename(path), path)]
+        print ' - Prerendering %s files' % len(sizes)
+    else:
+        sizes = [(id, size) for id, size, path in sizes]
+    total_size = sum(size for id, size in sizes)
+
+    with _jobs(1 if config.disable_workers else tree.config.nb_jobs) as nb_jobs:
+        if config.disable_workers:
+            pool = None
+            submit = _inline_future
+        else:
+            print ' - Initializing worker pool'
+            pool = ProcessPoolExecutor(max_workers=nb_jobs)
+            submit = pool.submit
+        try:
+            print ' - Enqueuing jobs'
+            batch_sizes = {}
+            for ids, size in _html_batches(sizes, nb_jobs):
+                batch_sizes[submit(_build_html_for_file_ids, tree, ids)] = size
+
+            print ' - Waiting for workers to complete'
+            start_time = datetime.now()
+            done_size = 0
+            for future in as_completed(batch_sizes):
+                result = future.result()
+                if result:
+                    formatted_tb, type, value, id, path = result
+                    print 'A worker failed while htmlifying %s, id=%s:' % (path, id)
+                    print formatted_tb
+                    # Abort everything if anything fails:
+                    raise type, value  # exits with non-zero
+
+                done_size += batch_sizes[future]
+                elapsed = datetime.now() - start_time
+                elapsed = elapsed.days * 24 * 60 * 60 + elapsed.seconds
+                print '%s of %s bytes of HTML done (%s%%), about %s left.' % (
+                    done_size,
+                    total_size,
+                    done_size * 100 / max(total_size, 1),
+                    timedelta(seconds=elapsed * (total_size - done_size) /
+                                      max(done_size, 1)))
+        finally:
+            if pool:
+                pool.shutdown()
+
+
+def save_tree(tree):
+    """Save a tree's configuration in its target folder, for the web app to
+    load with ``load_tree()``."""
+    with open(os.path.join(tree.target_folder, TREE_FILE), 'wb') as file:
+        cPickle.dump(tree, file, 2)
+
+
+def load_tree(tree_folder):
+    """Return the configuration of the tree whose HTML is in ``tree_folder``,
+    as saved by ``save_tree()``.
+
+    The instance may have been moved since, so point ``target_folder`` at
+    where it is now.
+
+    """
+    with open(os.path.join(tree_folder, TREE_FILE), 'rb') as file:
+        tree = cPickle.load(file)
+    tree.target_folder = tree_folder
+    return tree
 
-    with ProcessPoolExecutor(max_workers=int(tree.config.nb_jobs)) as pool:
-        print ' - Enqueuing jobs'
-        futures = [pool.submit(_build_html_for_file_ids, tree, start, end) for
-                   (start, end) in _sliced_range_bounds(1, max_file_id, 500)]
-        print ' - Waiting for workers to complete'
-        for num_done, future in enumerate(as_completed(futures), 1):
-            print '%s of %s HTML workers done.' % (num_done, len(futures))
-            result = future.result()
-            if result:
-                formatted_tb, type, value, id, path = result
-                print 'A worker failed while htmlifying %s, id=%s:' % (path, id)
-                print formatted_tb
-                # Abort everything if anything fails:
-                raise type, value  # exits with non-zero
 
+# The file in each tree's target folder that save_tree() writes
+TREE_FILE = '.dxr-tree.pickle'
 
-def _build_html_for_file_ids(tree, start, end):
-    """Write HTML files for file IDs from ``start`` to ``end``. Return None if
-    all goes well, a tuple of (stringified exception, exc type, exc value, file
-    ID, file path) if something goes wrong while htmlifying a file.
+
+def _build_html_for_file_ids(tree, file_ids):
+    """Write HTML files for the given file IDs. Return None if all goes well, a
+    tuple of (stringified exception, exc type, exc value, file ID, file path)
+    if something goes wrong while htmlifying a file.
 
     This is the top-level function of an HTML worker process. Log progress to a
-    file named "build-html-<start>-<end>.log".
+    file named "build-html-<first file ID>.log".
 
     """
     path = '(no file yet)'
@@ -484,37 +1210,28 @@ def _build_html_for_file_ids(tree, start, end):
         # them to the master process, since it's already writing the built HTML
         # directly, since that probably yields better parallelism.
 
-        conn = connect_database(tree)
+        conn, plugins = _html_worker_setup(tree)
         # TODO: Replace this ad hoc logging with the logging module (or something
         # more humane) so we can get some automatic timestamps. If we get
         # timestamps spit out in the parent process, we don't need any of the
         # timing or counting code here.
-        with open_log(tree, 'build-html-%s-%s.log' % (start, end)) as log:
-            # Load htmlifier plugins:
-            plugins = load_htmlifiers(tree)
-            for plugin in plugins:
-                plugin.load(tree, conn)
-
+        with open_log(tree, 'build-html-%s.log' % file_ids[0]) as log:
             start_time = datetime.now()
 
             # Fetch and htmlify each document:
             for num_files, (id, path, icon, text) in enumerate(
                     conn.execute("""
                                  SELECT files.id, path, icon, trg_index.text
-                                 FROM trg_index, files
-                                 WHERE trg_index.id = files.id
-                                 AND trg_index.id >= ?
-                                 AND trg_index.id <= ?
-                                 """,
-                                 [start, end]),
+                                 FROM files, trg_index
+                                 WHERE trg_index.id = files.blob_id
+                                 AND files.id IN (%s)
+                                 """ % ', '.join('?' for id in file_ids),
+                                 file_ids),
                     1):
                 dst_path = os.path.join(tree.target_folder, path + '.html')
                 log.write('Starting %s.\n' % path)
                 htmlify(tree, conn, icon, path, text, dst_path, plugins)
 
-            conn.commit()
-            conn.close()
-
             # Write time information:
             time = datetime.now() - start_time
             log.write('Finished %s files in %s.\n' % (num_files, time))
@@ -523,19 +1240,71 @@ def _build_html_for_file_ids(tree, start, end):
         return format_exc(), type, value, id, path
 
 
+def _html_worker_setup(tree):
+    """Return a read-only connection to a tree's database and the tree's
+    loaded htmlifier plugins.
+
+    They're set up the first time a process builds HTML for the tree and kept
+    for every later batch, since loading some plugins is expensive. (The
+    template environment is likewise cached by ``load_template_env()``.)
+
+    """
+    global _html_worker_state
+    key = tree.name, tree.target_folder
+    if _html_worker_state is None or _html_worker_state[0] != key:
+        if _html_worker_state is not None:
+            _html_worker_state[1].close()
+        conn = connect_database(tree)
+        conn.execute("PRAGMA query_only = ON")
+        # Map the database into memory, so workers share the pages through
+        # the OS's cache rather than each copying them into their own:
+        conn.execute("PRAGMA mmap_size = %s" % _HTML_WORKER_MMAP_SIZE)
+        plugins = load_htmlifiers(tree)
+        for plugin in plugins:
+            plugin.load(tree, conn)
+        _html_worker_state = key, conn, plugins
+    return _html_worker_state[1:]
+
+
+# What _html_worker_setup() set up last in this process:
+# ((tree name, target folder), connection, plugins)
+_html_worker_state = None
+
+# How much of the database an HTML worker maps into memory, in bytes
+_HTML_WORKER_MMAP_SIZE = 1 << 30
+
+
 def htmlify(tree, conn, icon, path, text, dst_path, plugins):
     """ Build HTML for path, text save it to dst_path """
+    # Load template
+    env = load_template_env(tree.config.temp_folder,
+                            tree.config.dxrroot)
+    arguments = file_page_arguments(tree, conn, icon, path, text, plugins)
+    try:
+        _fill_and_write_template(env, 'file.html', dst_path, arguments,
+                                 tree.config.html_compression)
+    finally:
+        arguments['lines'].close()
+
+
+def file_page_arguments(tree, conn, icon, path, text, plugins):
+    """Return the arguments of the file.html template for a file, decorated by
+    the given htmlifier plugins.
+
+    Close the SpooledLines under 'lines' once the page is rendered.
+
+    """
     # Create htmlifiers for this source
     htmlifiers = []
     for plugin in plugins:
         htmlifier = plugin.htmlify(path, text)
         if htmlifier:
             htmlifiers.append(htmlifier)
-    # Load template
-    env = load_template_env(tree.config.temp_folder,
-                            tree.config.dxrroot)
+    line_builder = (build_lines_compact if tree.config.compact_tags else
+                    build_lines)
+    menus = MenuTable()
 
-    arguments = {
+    return {
         # Set common template variables
         'wwwroot': tree.config.wwwroot,
         'tree': tree.name,
@@ -552,17 +1321,60 @@ def htmlify(tree, conn, icon, path, text, dst_path, plugins):
         'path': path,
         'name': os.path.basename(path),
 
-        # Someday, it would be great to stream this and not concretize the
-        # whole thing in RAM. The template will have to quit looping through
-        # the whole thing 3 times.
-        'lines': list(lines_and_annotations(build_lines(text, htmlifiers,
-                                                        tree.source_encoding),
-                                            htmlifiers)),
+        # The template loops through this 3 times, so the lines are spooled
+        # to disk on the first pass rather than concretized in RAM.
+        'lines': SpooledLines(lines_and_annotations(
+                     line_builder(text, htmlifiers, tree.source_encoding,
+                                  menus),
+                     htmlifiers)),
+        'menus': menus,
 
         'sections': build_sections(tree, conn, path, text, htmlifiers)
     }
 
-    _fill_and_write_template(env, 'file.html', dst_path, arguments)
+
+class SpooledLines(object):
+    """An iterable of (line of Markup, annotations) pairs that can be looped
+    through several times without holding them all in memory
+
+    The first pass draws the pairs from the given iterable, spooling them to a
+    temporary file, which later passes replay. Only the last
+    ``_LINE_SPOOL_SIZE`` bytes or so of them stay in memory, so huge files
+    render in bounded memory.
+
+    """
+    def __init__(self, lines):
+        self._lines = lines
+        self._spool = SpooledTemporaryFile(_LINE_SPOOL_SIZE)
+        self._spooled = False
+
+    def __iter__(self):
+        return self._replay() if self._spooled else self._spool_lines()
+
+    def _spool_lines(self):
+        for line, annotations in self._lines:
+            # Pickle each pair on its own so the memo doesn't grow.
+            self._spool.write(cPickle.dumps((unicode(line), annotations), 2))
+            yield line, annotations
+        self._spooled = True
+
+    def _replay(self):
+        self._spool.seek(0)
+        while True:
+            try:
+                line, annotations = cPickle.load(self._spool)
+            except EOFError:
+                return
+            yield Markup(line), annotations
+
+    def close(self):
+        """Delete the spooled lines."""
+        self._spool.close()
+
+
+# How many bytes of rendered lines to keep in memory before spooling them to
+# disk. Most files fit.
+_LINE_SPOOL_SIZE = 1 << 20
 
 
 class Line(object):
@@ -572,6 +1384,7 @@ class Line(object):
     of every line (and reopen any afterward that span lines).
 
     """
+    __slots__ = []
     sort_order = 0  # Sort Lines outermost.
     def __repr__(self):
         return 'Line()'
@@ -582,6 +1395,7 @@ LINE = Line()
 class TagWriter(object):
     """A thing that hangs onto a tag's payload (like the class of a span) and
     knows how to write its opening and closing tags"""
+    __slots__ = ['payload']
 
     def __init__(self, payload):
         self.payload = payload
@@ -593,10 +1407,11 @@ class TagWriter(object):
 
 class Region(TagWriter):
     """Thing to open and close <span> tags"""
+    __slots__ = []
     sort_order = 2  # Sort Regions innermost, as it doesn't matter if we split
                     # them.
 
-    def opener(self):
+    def opener(self, menus=None):
         return u'<span class="%s">' % cgi.escape(self.payload, True)
 
     def closer(self):
@@ -605,24 +1420,59 @@ class Region(TagWriter):
 
 class Ref(TagWriter):
     """Thing to open and close <a> tags"""
+    __slots__ = []
     sort_order = 1
 
-    def opener(self):
+    def opener(self, menus=None):
+        """Return the <a> tag.
+
+        :arg menus: A MenuTable to refer to the menu in by ID. If None, the
+            tag carries the whole menu.
+
+        """
         menu, qualname, value = self.payload
-        menu = cgi.escape(json.dumps(menu), True)
+        if menus is None:
+            menu = u'data-menu="%s"' % cgi.escape(json.dumps(menu), True)
+        else:
+            menu = u'data-menu-id="%s"' % menus.id(menu)
         css_class = ''
         if qualname:
             css_class = ' class=\"tok' + str(hash(qualname)) +'\"'
         title = ''
         if value:
             title = ' title="' + cgi.escape(value, True) + '"'
-        return u'<a data-menu="%s"%s%s>' % (menu, css_class, title)
+        return u'<a %s%s%s>' % (menu, css_class, title)
 
     def closer(self):
         return u'</a>'
 
 
-def html_lines(tags, slicer):
+class MenuTable(object):
+    """The distinct context menus of a page, numbered so refs can point to
+    them by ID rather than each carrying a copy
+
+    Render it into the page after all the lines; Jinja takes its __html__().
+
+    """
+    def __init__(self):
+        self._ids = {}  # JSON of a menu -> ID
+        self._menus = []  # JSON of each menu, by ID
+
+    def id(self, menu):
+        """Return the ID of a menu, adding it to the table if it's new."""
+        menu = json.dumps(menu, sort_keys=True)
+        id = self._ids.get(menu)
+        if id is None:
+            id = self._ids[menu] = len(self._menus)
+            self._menus.append(menu)
+        return id
+
+    def __html__(self):
+        """Return a JSON array of the menus, escaped for an HTML attribute."""
+        return cgi.escape('[%s]' % ','.join(self._menus), True)
+
+
+def html_lines(tags, slicer, menus=None):
     """Render tags to HTML, and interleave them with the text they decorate.
 
     :arg tags: An iterable of ordered, non-overlapping, non-empty tag
@@ -631,6 +1481,8 @@ def html_lines(tags, slicer):
     :arg slicer: A callable taking the args (start, end), returning a Unicode
         slice of the source code we're decorating. ``start`` and ``end`` are
         Python-style slice args.
+    :arg menus: A MenuTable to intern the context menus of refs in, or None
+        to inline each into its ref
 
     """
     up_to = 0
@@ -645,7 +1497,8 @@ def html_lines(tags, slicer):
                 segments = []
 
         else:
-            segments.append(payload.opener() if is_start else payload.closer())
+            segments.append(payload.opener(menus) if is_start else
+                            payload.closer())
 
 
 def balanced_tags(tags):
@@ -893,12 +1746,13 @@ def nesting_order((point, is_start, payload)):
                              -payload.sort_order)
 
 
-def build_lines(text, htmlifiers, encoding='utf-8'):
+def build_lines(text, htmlifiers, encoding='utf-8', menus=None):
     """Yield lines of Markup, with decorations from the htmlifier plugins
     applied.
 
     :arg text: UTF-8-encoded string. (In practice, this is not true if the
         input file wasn't UTF-8. We should make it true.)
+    :arg menus: A MenuTable to intern context menus in, as for html_lines()
 
     """
     decoder = getdecoder(encoding)
@@ -915,7 +1769,71 @@ def build_lines(text, htmlifiers, encoding='utf-8'):
     tags.sort(key=nesting_order)  # Balanced_tags undoes this, but we tolerate
                                   # that in html_lines().
     remove_overlapping_refs(tags)
-    return html_lines(balanced_tags(tags), decoded_slice)
+    return html_lines(balanced_tags(tags), decoded_slice, menus)
+
+
+def build_lines_compact(text, htmlifiers, encoding='utf-8', menus=None):
+    """Yield the same lines of Markup as build_lines(), using less memory and
+    time on big files.
+
+    Rather than making a list of (point, is_start, payload) tuples and sorting
+    it with nesting_order(), keep the point of each tag boundary and the index
+    of its payload in parallel arrays, and sort plain ints that pack the
+    nesting_order() key together with the boundary's index. Tuples are then
+    made only as the tag balancer consumes them.
+
+    """
+    decoder = getdecoder(encoding)
+    def decoded_slice(start, end):
+        return decoder(text[start:end], errors='replace')[0]
+
+    payloads = [LINE]
+    points = array('l')
+    payload_ids = array('l')  # Indices into payloads, inverted (~) for ends
+    for point, is_start, payload in chain(tag_boundaries(htmlifiers),
+                                          line_boundaries(text)):
+        points.append(point)
+        if is_start:
+            payload_ids.append(len(payloads))
+            payloads.append(payload)
+        elif payload is LINE:
+            payload_ids.append(~0)
+        else:
+            # tag_boundaries() yields each end right after its start.
+            payload_ids.append(~(len(payloads) - 1))
+
+    # Pack (point, is_start, +/-sort_order, index) into one int per boundary.
+    # Ends get 2 - sort_order and starts 4 + sort_order, so ends come first,
+    # ordered as in nesting_order(). The index keeps the sort stable. The keys
+    # go in an array like the other columns, unless they'd overflow its C
+    # longs, as they can on huge files where longs are 32 bits.
+    count = len(points)
+    if (max(points or [0]) * 8 + 8) * count <= sys.maxint:
+        keys = array('l')
+    else:
+        keys = []
+    for i in xrange(count):
+        payload_id = payload_ids[i]
+        if payload_id >= 0:
+            order = 4 + payloads[payload_id].sort_order
+        else:
+            order = 2 - payloads[~payload_id].sort_order
+        keys.append((points[i] * 8 + order) * count + i)
+    indices = array('l', (key % count for key in sorted(keys)))
+    del keys
+
+    def sorted_tags():
+        for i in indices:
+            payload_id = payload_ids[i]
+            if payload_id >= 0:
+                yield points[i], True, payloads[payload_id]
+            else:
+                yield points[i], False, payloads[~payload_id]
+
+    # The streaming equivalent of remove_overlapping_refs():
+    tags, tags_to_check = tee(sorted_tags())
+    tags = compress(tags, non_overlapping_refs(tags_to_check))
+    return html_lines(balanced_tags(tags), decoded_slice, menus)
 
 
 def lines_and_annotations(lines, htmlifiers):
@@ -1,4 +1,5 @@
 from ConfigParser import ConfigParser
+from contextlib import contextmanager
 from datetime import datetime
 import os
 from os.path import isdir
@@ -29,7 +30,15 @@ class Config(object):
             'directory_index':  ".dxr-directory-index.html",
             'generated_date':   datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S +0000"),
             'disable_workers':  "",
-            'skip_stages': ""
+            'skip_stages': "",
+            'incremental':      "",
+            'index_while_building': "",
+            'concurrent_trees': "1",
+            'compact_tags':     "",
+            'html_compression': "",
+            'render_on_demand': "",
+            'render_cache_folder': "%(target_folder)s/render-cache",
+            'render_cache_size': "256"
         })
         parser.read(configfile)
 
@@ -47,6 +56,14 @@ class Config(object):
         self.generated_date   = parser.get('DXR', 'generated_date',   False, override)
         self.disable_workers  = parser.get('DXR', 'disable_workers',  False, override)
         self.skip_stages      = parser.get('DXR', 'skip_stages',      False, override)
+        self.incremental      = parser.get('DXR', 'incremental',      False, override)
+        self.index_while_building = parser.get('DXR', 'index_while_building', False, override)
+        self.concurrent_trees = parser.get('DXR', 'concurrent_trees', False, override)
+        self.compact_tags     = parser.get('DXR', 'compact_tags',     False, override)
+        self.html_compression = parser.get('DXR', 'html_compression', False, override)
+        self.render_on_demand = parser.get('DXR', 'render_on_demand', False, override)
+        self.render_cache_folder = parser.get('DXR', 'render_cache_folder', False, override)
+        self.render_cache_size = parser.get('DXR', 'render_cache_size', False, override)
         # Set configfile
         self.configfile       = configfile
         self.trees            = []
@@ -62,6 +79,7 @@ class Config(object):
         self.temp_folder      = os.path.abspath(self.temp_folder)
         self.log_folder       = os.path.abspath(self.log_folder)
         self.target_folder    = os.path.abspath(self.target_folder)
+        self.render_cache_folder = os.path.abspath(self.render_cache_folder)
 
         # Make sure wwwroot doesn't end in /
         if self.wwwroot[-1] == '/':
@@ -73,6 +91,26 @@ class Config(object):
         else:
             self.disabled_plugins = self.disabled_plugins.split()
 
+        # Convert concurrent trees to an int
+        try:
+            self.concurrent_trees = int(self.concurrent_trees)
+        except ValueError:
+            print >> sys.stderr, "concurrent_trees must be a number of trees"
+            sys.exit(1)
+
+        # Convert the render cache size to an int
+        try:
+            self.render_cache_size = int(self.render_cache_size)
+        except ValueError:
+            print >> sys.stderr, "render_cache_size must be a number of megabytes"
+            sys.exit(1)
+
+        # Check the HTML compression mode
+        if self.html_compression not in ('', 'gzip', 'gzip-only'):
+            print >> sys.stderr, ("html_compression must be empty, gzip, or "
+                                  "gzip-only")
+            sys.exit(1)
+
         # Convert skipped stages to a list
         self.skip_stages = self.skip_stages.split()
 
@@ -119,7 +157,10 @@ class TreeConfig(object):
             'ignore_patterns':  ".hg .git CVS .svn .bzr .deps .libs",
             'build_command':    "make -j $jobs",
             'source_encoding':  'utf-8',
-            'description':  ''
+            'description':  '',
+            'max_file_size':    "0",
+            'large_file_policy': "skip",
+            'prerender':        ""
         })
         parser.read(configfile)
 
@@ -134,6 +175,9 @@ class TreeConfig(object):
         self.ignore_patterns  = parser.get(name, 'ignore_patterns')
         self.source_encoding  = parser.get(name, 'source_encoding')
         self.description      = parser.get(name, 'description')
+        self.max_file_size    = parser.get(name, 'max_file_size')
+        self.large_file_policy = parser.get(name, 'large_file_policy')
+        self.prerender        = parser.get(name, 'prerender')
 
         # You cannot redefine the target folder!
         self.target_folder    = os.path.join(config.target_folder, 'trees', name)
@@ -141,6 +185,11 @@ class TreeConfig(object):
         self.configfile       = configfile
         self.config           = config
         self.name             = name
+        # Paths changed since the last build, set when building incrementally
+        self.changed_paths    = None
+        # Reserves processes for post_process to use, replaced by the build
+        # with one drawing on the budget of trees built concurrently
+        self.post_process_jobs = _unbudgeted_jobs
 
         # Read all plugin_ keys
         for key, value in parser.items(name):
@@ -152,6 +201,29 @@ class TreeConfig(object):
         self.ignore_paths     = filter(lambda p: p.startswith("/"), self.ignore_patterns)
         self.ignore_patterns  = filter(lambda p: not p.startswith("/"), self.ignore_patterns)
 
+        # Likewise the patterns of files to render HTML for at build time
+        self.prerender        = self.prerender.split()
+        self.prerender_paths  = filter(lambda p: p.startswith("/"), self.prerender)
+        self.prerender        = filter(lambda p: not p.startswith("/"), self.prerender)
+        if (self.prerender or self.prerender_paths) and not config.render_on_demand:
+            print >> sys.stderr, ("prerender for '%s' needs render_on_demand, or "
+                                  "the pages it leaves out can't be shown" % name)
+            sys.exit(1)
+
+        # Convert max file size to an int
+        try:
+            self.max_file_size = int(self.max_file_size)
+        except ValueError:
+            print >> sys.stderr, ("max_file_size for '%s' must be a number of bytes"
+                                  % name)
+            sys.exit(1)
+
+        # Check the large file policy
+        if self.large_file_policy not in ('skip', 'path', 'truncate'):
+            print >> sys.stderr, ("large_file_policy for '%s' must be one of "
+                                  "skip, path, or truncate" % name)
+            sys.exit(1)
+
         # Render all path absolute
         self.temp_folder      = os.path.abspath(self.temp_folder)
         self.log_folder       = os.path.abspath(self.log_folder)
@@ -186,3 +258,9 @@ class TreeConfig(object):
         if "$jobs" not in self.build_command:
             msg = "Warning: $jobs is not used in build_command for '%s'"
             print >> sys.stderr, msg % name
+
+
+@contextmanager
+def _unbudgeted_jobs(wanted):
+    """Grant however many processes are wanted."""
+    yield int(wanted)
@@ -0,0 +1,92 @@
+"""Reachability in directed graphs, for the transitive closures plugins store,
+like that of inheritance
+
+A graph is a dict mapping each node to an iterable of its successors. Nodes
+which only appear as successors needn't have entries.
+
+"""
+
+
+def strongly_connected_components(graph):
+    """Return the strongly connected components of a graph, as lists of nodes.
+
+    A component comes after every other component reachable from it, so
+    walking the list in order visits each component's successors before it.
+
+    This is Tarjan's algorithm, done with an explicit stack so deep graphs
+    don't run out of recursion.
+
+    """
+    index = {}  # node -> order in which the DFS reached it
+    lowlink = {}  # node -> lowest index known to be reachable from it
+    stack = []  # nodes whose components aren't yet complete
+    on_stack = set()
+    components = []
+
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        path = [(root, iter(graph.get(root, ())))]
+        while path:
+            node, successors = path[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    path.append((successor,
+                                 iter(graph.get(successor, ()))))
+                    break
+                elif successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                # All of node's successors are done.
+                path.pop()
+                if path:
+                    parent = path[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def descendants(graph):
+    """Return a dict mapping each node of a graph to the set of nodes
+    reachable from it by one or more edges.
+
+    A node is its own descendant only if it's on a cycle. The graph is
+    condensed into its strongly connected components, and each component's
+    descendants are worked out once, from those of its successors, so the
+    work is linear in the size of the graph plus that of the result.
+
+    Nodes of the same component share one set, so don't modify them.
+
+    """
+    closure = {}
+    for component in strongly_connected_components(graph):
+        members = set(component)
+        cyclic = len(component) > 1
+        reach = set()
+        for node in component:
+            for successor in graph.get(node, ()):
+                if successor in members:
+                    cyclic = True
+                elif successor not in reach:
+                    # Anything reachable from successor is then in reach too.
+                    reach.add(successor)
+                    reach |= closure[successor]
+        if cyclic:
+            reach |= members
+        for node in component:
+            closure[node] = reach
+    return closure
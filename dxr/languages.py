@@ -14,8 +14,28 @@ language_schema = dxr.schema.Schema({
         ("path", "VARCHAR(1024)", True),
         ("icon", "VARCHAR(64)", True),
         ("encoding", "VARCHAR(16)", False),
+        ("blob_id", "INTEGER", False),    # ID of the contents in blobs and trg_index
         ("_key", "id"),
-        ("_index", "path"),               # TODO: Make this a unique index
+        ("_index", "path", {"unique": True}),
+        ("_index", "blob_id"),            # For joining with trg_index
+    ],
+    # Distinct file contents. Files with the same contents share a blob, whose
+    # ID is also that of its text in trg_index.
+    "blobs": [
+        ("id", "INTEGER", False),
+        ("hash", "CHAR(40)", False),      # Hex SHA-1 of the contents
+        ("_key", "id"),
+        ("_index", "hash"),
+    ],
+    # Every file that wasn't ignored, text or not, as of the last build. This is
+    # how incremental builds tell which files changed.
+    "manifest": [
+        ("path", "VARCHAR(1024)", False), # Path relative to the source folder
+        ("size", "INTEGER", False),       # Size in bytes
+        ("mtime", "REAL", False),         # Modification time (secs since epoch)
+        ("hash", "CHAR(40)", False),      # Hex SHA-1 of the contents
+        ("file_id", "INTEGER", True),     # ID in files; NULL if not indexed
+        ("_key", "path"),
     ],
     "scopes": [
         ("id", "INTEGER", False),         # An ID for this scope
@@ -38,6 +58,8 @@ language_schema = dxr.schema.Schema({
         ("_key", "id"),
         ("_fkey", "scopeid", "scopes", "id"),
         ("_index", "qualname"),
+        ("_index", "name"),                   # Exact lookups in Query.direct_result()
+        ("_index", "name", {"collate": "NOCASE"}),  # Unqualified LIKE lookups
     ],
     # Inheritance relations: note that we store the full transitive closure in
     # this table, so if A extends B and B extends C, we'd have (A, C) stored in
@@ -47,7 +69,8 @@ language_schema = dxr.schema.Schema({
         ("tbase", "INTEGER", False),      # tid of base type
         ("tderived", "INTEGER", False),   # tid of derived type
         ("inhtype", "VARCHAR(32)", True), # Type of inheritance; NULL is indirect
-        ("_key", "tbase", "tderived")
+        ("_key", "tbase", "tderived"),
+        ("_index", "tderived"),
     ],
     # Functions: functions, methods, constructors, operator overloads, etc.
     "functions": [
@@ -65,6 +88,8 @@ language_schema = dxr.schema.Schema({
         ("_key", "id"),
         ("_fkey", "scopeid", "scopes", "id"),
         ("_index", "qualname"),
+        ("_index", "name"),                   # Exact lookups in Query.direct_result()
+        ("_index", "name", {"collate": "NOCASE"}),  # Unqualified LIKE lookups
     ],
     # Variables: class, global, local, enum constants; they're all in here
     # Variables are of course not scopes, but for ease of use, they use IDs from
@@ -84,6 +109,7 @@ language_schema = dxr.schema.Schema({
         ("_key", "id"),
         ("_fkey", "scopeid", "scopes", "id"),
         ("_index", "qualname"),
+        ("_index", "name", {"collate": "NOCASE"}),  # Unqualified LIKE lookups
     ],
     "crosslang": [
         ("canonid", "INTEGER", False),
@@ -10,9 +10,15 @@ def icon(path):
     return "mimetypes/" + ext_map.get(ext[1:], "unknown")
 
 
+# The most of a file is_text() needs to see to make up its mind
+SNIFF_SIZE = 8192
+
+
 def is_text(path, data):
+    """Return whether a file is text, judging from ``data``, its contents or
+    at least the first ``SNIFF_SIZE`` bytes of them."""
     # Simple stupid test that apparently works rather well :)
-    return '\0' not in data
+    return '\0' not in data[:SNIFF_SIZE]
 
 
 # File extension known as this point
@@ -15,7 +15,7 @@ def htmlifier_exports():
 def load_indexers(tree):
     """ Load indexers for a given tree """
     # Allow plugins to load from the plugin folder
-    sys.path.append(tree.config.plugin_folder)
+    _add_to_path(tree.config.plugin_folder)
     plugins = []
     for name in tree.enabled_plugins:
         path = os.path.join(tree.config.plugin_folder, name)
@@ -26,15 +26,27 @@ def load_indexers(tree):
     return plugins
 
 
-def load_htmlifiers(tree):
-    """ Load htmlifiers for a given tree """
+def load_htmlifiers(tree, module_suffix=''):
+    """ Load htmlifiers for a given tree
+
+    :arg module_suffix: Appended to the names of the modules. Plugins keep
+        what they load in globals, so pass different suffixes to keep the
+        htmlifiers of several trees loaded at once.
+
+    """
     # Allow plugins to load from the plugin folder
-    sys.path.append(tree.config.plugin_folder)
+    _add_to_path(tree.config.plugin_folder)
     plugins = []
     for name in tree.enabled_plugins:
         path = os.path.join(tree.config.plugin_folder, name)
         f, mod_path, desc = imp.find_module("htmlifier", [path])
-        plugin = imp.load_module('dxr.plugins.' + name + "_htmlifier", f, mod_path, desc)
+        plugin = imp.load_module('dxr.plugins.' + name + "_htmlifier" + module_suffix, f, mod_path, desc)
         f.close()
         plugins.append(plugin)
     return plugins
+
+
+def _add_to_path(folder):
+    """Add a folder to ``sys.path`` unless it's already there."""
+    if folder not in sys.path:
+        sys.path.append(folder)
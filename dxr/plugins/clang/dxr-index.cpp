@@ -18,8 +18,10 @@
 #include <stdlib.h>
 
 // Needed for sha1 hacks
+#include <errno.h>
 #include <fcntl.h>
 #include <unistd.h>
+#include <utime.h>
 #include "sha1.h"
 
 #define CLANG_AT_LEAST(major, minor) \
@@ -370,6 +372,10 @@ public:
       if (fd != -1) {
         write(fd, content.c_str(), content.length());
         close(fd);
+      } else if (errno == EEXIST) {
+        // Mark it as written by this build, so incremental builds don't
+        // take it for stale. See drop_superseded_output() in indexer.py.
+        utime(filename.c_str(), NULL);
       }
     }
   }
@@ -1,9 +1,20 @@
+from collections import deque
 import csv, cgi
+from hashlib import sha1
+from heapq import merge
+from itertools import groupby, izip
 import json
+import marshal
+
+from concurrent.futures import ProcessPoolExecutor
+
 import dxr.plugins
 import dxr.schema
 import os, sys
 import re, urllib
+from tempfile import TemporaryFile
+from time import time
+from dxr.graph import descendants
 from dxr.languages import language_schema
 
 
@@ -33,6 +44,53 @@ def pre_process(tree, env):
     env['DXR_CXX_CLANG_OBJECT_FOLDER']  = tree.object_folder
     env['DXR_CXX_CLANG_TEMP_FOLDER']    = temp_folder
 
+    # Building incrementally, throw away the output about files which changed,
+    # so recompiling rewrites it without leaving old facts behind. Output is
+    # named <sha1 of path>.<sha1 of contents>.csv; see dxr-index.cpp.
+    if tree.changed_paths is not None:
+        changed = set(sha1(path).hexdigest() for path in tree.changed_paths)
+        for f in os.listdir(temp_folder):
+            if f.split('.', 1)[0] in changed:
+                os.remove(os.path.join(temp_folder, f))
+        # Unchanged files are recompiled too when what they include changes.
+        # Mark when the build started, so post_process can tell their new
+        # output from the old.
+        open(os.path.join(temp_folder, _BUILD_STAMP), 'w').close()
+
+
+# File in the temp folder whose mtime is when an incremental build started
+_BUILD_STAMP = 'build-started'
+
+
+def drop_superseded_output(temp_folder):
+    """Delete the output written before an incremental build about files
+    the build wrote output about again, and return the paths of the CSVs
+    left.
+
+    dxr-index.cpp touches the output it would have written again unchanged, so
+    anything older than the build stamp is from translation units which
+    weren't recompiled. For files some recompiled translation unit wrote
+    about, that output is stale: ingesting it alongside the new would keep
+    refs to lines which have since moved.
+
+    """
+    names = [f for f in os.listdir(temp_folder) if f.endswith('.csv')]
+    stamp = os.path.join(temp_folder, _BUILD_STAMP)
+    if not os.path.exists(stamp):
+        return [os.path.join(temp_folder, f) for f in names]
+    started = os.stat(stamp).st_mtime
+    is_new = dict((f, os.stat(os.path.join(temp_folder, f)).st_mtime >=
+                      started) for f in names)
+    rewritten = set(f.split('.', 1)[0] for f in names if is_new[f])
+    kept = []
+    for f in names:
+        if is_new[f] or f.split('.', 1)[0] not in rewritten:
+            kept.append(os.path.join(temp_folder, f))
+        else:
+            os.remove(os.path.join(temp_folder, f))
+    os.remove(stamp)
+    return kept
+
 
 def post_process(tree, conn):
     print "cxx-clang post-processing:"
@@ -41,9 +99,22 @@ def post_process(tree, conn):
 
     print " - Processing files"
     temp_folder = os.path.join(tree.temp_folder, 'plugins', PLUGIN_NAME)
-    for f in os.listdir(temp_folder):
-        csv_path = os.path.join(temp_folder, f)
-        dump_indexer_output(conn, csv_path)
+    csv_paths = drop_superseded_output(temp_folder)
+    # Everything goes in as one transaction, which post_process commits at the
+    # end, instead of one per every so many rows.
+    inserter = _BatchInserter(conn)
+    load_scopes(conn)
+    # Only the parsing is parallel, so hold the processes just for that, and
+    # insert what it spooled after letting them go:
+    with tree.post_process_jobs(1 if tree.config.disable_workers
+                                else tree.config.nb_jobs) as nb_jobs:
+        spool = spool_indexer_output(csv_paths, nb_jobs)
+    try:
+        dump_indexer_output(conn, distinct_indexer_output(spool), inserter)
+    finally:
+        spool.close()
+    inserter.flush()
+    write_scopes(conn)
 
     fixup_scope(conn)
     
@@ -53,11 +124,18 @@ def post_process(tree, conn):
     print " - Generating inheritance graph"
     generate_inheritance(conn)
 
+    print " - Indexing locations"
+    create_resolution_indexes(conn)
+
     print " - Updating definitions"
     update_defids(conn)
 
     print " - Updating references"
     update_refs(conn)
+    drop_resolution_indexes(conn)
+
+    print " - Precomputing annotations"
+    materialize_annotations(conn)
 
     print " - Committing changes"
     conn.commit()
@@ -75,6 +153,7 @@ schema = dxr.schema.Schema({
         ("_location", True),
         ("_key", "id"),
         ("_index", "qualname"),
+        ("_index", "name", {"collate": "NOCASE"}),  # Unqualified LIKE lookups
     ],
     # Namespaces
     "namespaces": [
@@ -86,6 +165,7 @@ schema = dxr.schema.Schema({
         ("_location", True),
         ("_key", "id"),
         ("_index", "qualname"),
+        ("_index", "name", {"collate": "NOCASE"}),  # Unqualified LIKE lookups
     ],
     # References to namespaces
     "namespace_refs": [
@@ -96,6 +176,7 @@ schema = dxr.schema.Schema({
         ("_location", True, 'referenced'),
         ("_fkey", "refid", "namespaces", "id"),
         ("_index", "refid"),
+        ("_index", "file_id", "extent_start"),
     ],
     # Namespace aliases
     "namespace_aliases": [
@@ -107,6 +188,7 @@ schema = dxr.schema.Schema({
         ("_location", True),
         ("_key", "id"),
         ("_index", "qualname"),
+        ("_index", "name", {"collate": "NOCASE"}),  # Unqualified LIKE lookups
     ],
     # References to namespace aliases
     "namespace_alias_refs": [
@@ -117,6 +199,7 @@ schema = dxr.schema.Schema({
         ("_location", True, 'referenced'),
         ("_fkey", "refid", "namespace_aliases", "id"),
         ("_index", "refid"),
+        ("_index", "file_id", "extent_start"),
     ],
     # References to functions
     "function_refs": [
@@ -127,6 +210,7 @@ schema = dxr.schema.Schema({
         ("_location", True, 'referenced'),
         ("_fkey", "refid", "functions", "id"),
         ("_index", "refid"),
+        ("_index", "file_id", "extent_start"),
     ],
     # References to macros
     "macro_refs": [
@@ -137,6 +221,7 @@ schema = dxr.schema.Schema({
         ("_location", True, 'referenced'),
         ("_fkey", "refid", "macros", "id"),
         ("_index", "refid"),
+        ("_index", "file_id", "extent_start"),
     ],
     # References to types
     "type_refs": [
@@ -147,6 +232,7 @@ schema = dxr.schema.Schema({
         ("_location", True, 'referenced'),
         ("_fkey", "refid", "types", "id"),
         ("_index", "refid"),
+        ("_index", "file_id", "extent_start"),
     ],
     # References to typedefs
     "typedef_refs": [
@@ -157,6 +243,7 @@ schema = dxr.schema.Schema({
         ("_location", True, 'referenced'),
         ("_fkey", "refid", "typedefs", "id"),
         ("_index", "refid"),
+        ("_index", "file_id", "extent_start"),
     ],
     # References to variables
     "variable_refs": [
@@ -167,6 +254,7 @@ schema = dxr.schema.Schema({
         ("_location", True, 'referenced'),
         ("_fkey", "refid", "variables", "id"),
         ("_index", "refid"),
+        ("_index", "file_id", "extent_start"),
     ],
     # Warnings found while compiling
     "warnings": [
@@ -186,6 +274,7 @@ schema = dxr.schema.Schema({
         ("extent_end", "INTEGER", True),
         ("_fkey", "defid", "functions", "id"),
         ("_index", "defid"),
+        ("_index", "file_id", "extent_start"),
     ],
     # Declaration/definition mapping for types
     "type_decldef": [
@@ -197,6 +286,7 @@ schema = dxr.schema.Schema({
         ("extent_end", "INTEGER", True),
         ("_fkey", "defid", "types", "id"),
         ("_index", "defid"),
+        ("_index", "file_id", "extent_start"),
     ],
     # Declaration/definition mapping for variables
     "variable_decldef": [
@@ -208,6 +298,7 @@ schema = dxr.schema.Schema({
         ("extent_end", "INTEGER", True),
         ("_fkey", "defid", "variables", "id"),
         ("_index", "defid"),
+        ("_index", "file_id", "extent_start"),
     ],
     # Macros: this is a table of all of the macros we come across in the code.
     "macros": [
@@ -219,6 +310,8 @@ schema = dxr.schema.Schema({
         ("extent_end", "INTEGER", True),
         ("_location", True),
         ("_key", "id"),
+        ("_index", "name"),                   # +macro: lookups by exact name
+        ("_index", "name", {"collate": "NOCASE"}),  # Unqualified LIKE lookups
     ],
     # #include and #import directives
     # If we can't resolve the target to a file in the tree, we just omit the
@@ -245,6 +338,7 @@ schema = dxr.schema.Schema({
         ("callerid", "INTEGER", False), # The function in which the call occurs
         ("targetid", "INTEGER", False), # The target of the call
         ("_key", "callerid", "targetid"),
+        ("_index", "targetid"),
         ("_fkey", "callerid", "functions", "id")
     ],
     "targets": [
@@ -253,15 +347,26 @@ schema = dxr.schema.Schema({
         ("_key", "targetid", "funcid"),
         ("_fkey", "funcid", "functions", "id"),
         ("_index", "funcid"),
+    ],
+    # Everything the htmlifier shows for a file, precomputed by
+    # materialize_annotations() so rendering a file takes a single read
+    "file_annotations": [
+        ("file_id", "INTEGER", False),
+        ("data", "BLOB", False),         # Marshalled (refs, warnings, sections)
+        ("_key", "file_id"),
+        ("_fkey", "file_id", "files", "id"),
     ]
 })
 
 
 file_cache = {}
+file_paths = {}  # file_id -> path, the reverse of file_cache
 decl_master = {}
 inheritance = {}
 calls = {}
 overrides = {}
+scope_ids = {}   # (file_id, file_line, file_col) -> id of the scope there
+new_scopes = []  # Rows for the scopes found since load_scopes
 
 def getFileID(conn, path):
     global file_cache
@@ -276,6 +381,7 @@ def getFileID(conn, path):
     file_id = None
     if row:
         file_id = row[0]
+        file_paths[file_id] = path
     file_cache[path] = file_id
     return file_id
 
@@ -308,14 +414,39 @@ def fixupExtent(args, extents_key='extent'):
     args['extent_end'] = int(arr[1])
     del args[extents_key]
 
+def load_scopes(conn):
+    """Index the scopes already in the database by location, so getScope
+    needn't query for them."""
+    scope_ids.clear()
+    del new_scopes[:]
+    for id, file_id, file_line, file_col in conn.execute(
+            "SELECT id, file_id, file_line, file_col FROM scopes"):
+        scope_ids[file_id, file_line, file_col] = id
+
+def write_scopes(conn):
+    """Insert the scopes found since load_scopes, all at once."""
+    sql, row = language_schema.get_insert_row('scopes', {})
+    conn.executemany(sql, new_scopes)
+    del new_scopes[:]
+
+def scopeId(file_id, line, col):
+    """Return the ID of the scope at a location. The type or function which
+    opens a scope shares its ID."""
+    return dxr.utils.stable_id('scope', file_paths[file_id], line, col)
+
+def recordId(kind, args):
+    """Return the ID of a type, function, variable or other record, from the
+    args of its CSV line. Like the unique location index of its table, it goes
+    by location and extent."""
+    return dxr.utils.stable_id(kind, args.get('qualname', args.get('name')),
+                               args['loc'], args.get('extent'))
+
 def getScope(args, conn):
-    row = conn.execute("SELECT id FROM scopes WHERE file_id=? AND file_line=? AND file_col=?",
-                                          (args['file_id'], args['file_line'], args['file_col'])).fetchone()
+    return scope_ids.get((args['file_id'], args['file_line'], args['file_col']))
 
-    if row is not None:
-        return row[0]
-
-    return None
+def _newScope(scope):
+    scope_ids[scope['file_id'], scope['file_line'], scope['file_col']] = scope['id']
+    new_scopes.append(language_schema.get_insert_row('scopes', scope)[1])
 
 def addScope(args, conn, name, id):
     scope = {}
@@ -325,9 +456,7 @@ def addScope(args, conn, name, id):
     scope['file_line'] = args['file_line']
     scope['file_col'] = args['file_col']
     scope['language'] = 'native'
-
-    stmt = language_schema.get_insert_sql('scopes', scope)
-    conn.execute(stmt[0], stmt[1])
+    _newScope(scope)
 
 def handleScope(args, conn, canonicalize=False):
     scope = {}
@@ -348,9 +477,9 @@ def handleScope(args, conn, canonicalize=False):
     scopeid = getScope(scope, conn)
 
     if scopeid is None:
-        scope['id'] = scopeid = dxr.utils.next_global_id()
-        stmt = language_schema.get_insert_sql('scopes', scope)
-        conn.execute(stmt[0], stmt[1])
+        scope['id'] = scopeid = scopeId(scope['file_id'], scope['file_line'],
+                                        scope['file_col'])
+        _newScope(scope)
 
     if scopeid is not None:
         args['scopeid'] = scopeid
@@ -381,7 +510,7 @@ def process_decldef(args, conn):
         return None
     fixupExtent(args, 'extent')
     
-    return schema.get_insert_sql(args['kind'] + '_decldef', args)
+    return schema.get_insert_row(args['kind'] + '_decldef', args)
 
 def process_type(args, conn):
     if not fixupEntryPath(args, 'loc', conn):
@@ -393,21 +522,22 @@ def process_type(args, conn):
     if scopeid is not None:
         args['id'] = scopeid
     else:
-        args['id'] = dxr.utils.next_global_id()
+        args['id'] = scopeId(args['file_id'], args['file_line'],
+                             args['file_col'])
         addScope(args, conn, 'name', 'id')
 
     handleScope(args, conn)
     fixupExtent(args, 'extent')
 
-    return language_schema.get_insert_sql('types', args)
+    return language_schema.get_insert_row('types', args)
 
 def process_typedef(args, conn):
-    args['id'] = dxr.utils.next_global_id()
+    args['id'] = recordId('typedef', args)
     if not fixupEntryPath(args, 'loc', conn):
         return None
     fixupExtent(args, 'extent')
 #  handleScope(args, conn)
-    return schema.get_insert_sql('typedefs', args)
+    return schema.get_insert_row('typedefs', args)
 
 def process_function(args, conn):
     if not fixupEntryPath(args, 'loc', conn):
@@ -417,7 +547,8 @@ def process_function(args, conn):
     if scopeid is not None:
         args['id'] = scopeid
     else:
-        args['id'] = dxr.utils.next_global_id()
+        args['id'] = scopeId(args['file_id'], args['file_line'],
+                             args['file_col'])
         addScope(args, conn, 'name', 'id')
 
     if 'overridename' in args:
@@ -425,21 +556,21 @@ def process_function(args, conn):
 
     handleScope(args, conn)
     fixupExtent(args, 'extent')
-    return language_schema.get_insert_sql('functions', args)
+    return language_schema.get_insert_row('functions', args)
 
 def process_impl(args, conn):
     inheritance[args['tbname'], args['tbloc'], args['tcname'], args['tcloc']] = args
     return None
 
 def process_variable(args, conn):
-    args['id'] = dxr.utils.next_global_id()
+    args['id'] = recordId('variable', args)
     if 'value' in args:
         args['value'] = _truncate(args['value'])
     if not fixupEntryPath(args, 'loc', conn):
         return None
     handleScope(args, conn)
     fixupExtent(args, 'extent')
-    return language_schema.get_insert_sql('variables', args)
+    return language_schema.get_insert_row('variables', args)
 
 def process_ref(args, conn):
     if 'extent' not in args:
@@ -453,23 +584,23 @@ def process_ref(args, conn):
         return None
     fixupExtent(args, 'extent')
 
-    return schema.get_insert_sql(args['kind'] + '_refs', args)
+    return schema.get_insert_row(args['kind'] + '_refs', args)
 
 def process_warning(args, conn):
     if not fixupEntryPath(args, 'loc', conn):
         return None
     fixupExtent(args, 'extent')
-    return schema.get_insert_sql('warnings', args)
+    return schema.get_insert_row('warnings', args)
 
 def process_macro(args, conn):
-    args['id'] = dxr.utils.next_global_id()
+    args['id'] = recordId('macro', args)
     if 'text' in args:
         args['text'] = args['text'].replace("\\\n", "\n").strip()
         args['text'] = _truncate(args['text'])
     if not fixupEntryPath(args, 'loc', conn):
         return None
     fixupExtent(args, 'extent')
-    return schema.get_insert_sql('macros', args)
+    return schema.get_insert_row('macros', args)
 
 def process_call(args, conn):
     if 'callername' in args:
@@ -483,16 +614,16 @@ def process_call(args, conn):
 def process_namespace(args, conn):
     if not fixupEntryPath(args, 'loc', conn):
         return None
-    args['id'] = dxr.utils.next_global_id()
+    args['id'] = recordId('namespace', args)
     fixupExtent(args, 'extent')
-    return schema.get_insert_sql('namespaces', args)
+    return schema.get_insert_row('namespaces', args)
 
 def process_namespace_alias(args, conn):
     if not fixupEntryPath(args, 'loc', conn):
         return None
-    args['id'] = dxr.utils.next_global_id()
+    args['id'] = recordId('namespace_alias', args)
     fixupExtent(args, 'extent')
-    return schema.get_insert_sql('namespace_aliases', args)
+    return schema.get_insert_row('namespace_aliases', args)
 
 def process_include(args, conn):
     """Turn an "include" line from a CSV into a row in the "includes" table."""
@@ -523,46 +654,137 @@ def load_indexer_output(fname):
     finally:
         f.close()
 
-def dump_indexer_output(conn, fname):
-    f = open(fname, 'r')
-    limit = 0
+class _BatchInserter(object):
+    """Collects rows bound for the database and inserts them with one
+    executemany per statement, which prepares each statement once rather than
+    once per row."""
 
-    try:
-        parsed_iter = csv.reader(f)
-        for line in parsed_iter:
-            args = {}
-            # Our first column is the type that we're reading, the others are just
-            # a key/value pairs array to be passed in
-            for i in range(1, len(line), 2):
-                args[line[i]] = line[i + 1]
+    def __init__(self, conn, batch_size=10000):
+        self.conn = conn
+        self.batch_size = batch_size
+        self._rows = {}  # sql -> rows waiting to be inserted, in order
+        self._count = 0
 
-            stmt = globals()['process_' + line[0]](args, conn)
+    def add(self, sql, row):
+        self._rows.setdefault(sql, []).append(row)
+        self._count += 1
+        if self._count >= self.batch_size:
+            self.flush()
 
-            if stmt is None:
-                continue
+    def flush(self):
+        for sql, rows in self._rows.iteritems():
+            self.conn.executemany(sql, rows)
+        self._rows = {}
+        self._count = 0
 
-            if isinstance(stmt, list):
-                for elem in list:
-                    conn.execute(elem[0], elem[1])
-            elif isinstance(stmt, tuple):
-                try:
-                    conn.execute(stmt[0], stmt[1])
-                except Exception:
-                    print line
-                    print stmt
-                    raise
-            else:
-                conn.execute(stmt)
-
-            limit = limit + 1
-
-            if limit > 10000:
-                limit = 0
-                conn.commit()
-    except IndexError:
-        raise
+
+def _processor(kind, _processors={}):
+    """Return the process_* function for a kind of CSV line."""
+    try:
+        return _processors[kind]
+    except KeyError:
+        process = _processors[kind] = globals()['process_' + kind]
+        return process
+
+def parse_indexer_output(fname):
+    """Parse a CSV of the compiler plugin's output, and return its distinct
+    lines along with their SHA-1s, in order.
+
+    This is the top-level function of a CSV-parsing worker process, so it
+    returns a pair of strings, which are cheap to send back: the 20-byte
+    digests, concatenated, and the list of lines, marshaled.
+
+    """
+    lines = []
+    digests = []
+    seen = set()
+    f = open(fname, 'rb')
+    try:
+        for line in csv.reader(f):
+            digest = sha1('\0'.join(line)).digest()
+            if digest not in seen:
+                seen.add(digest)
+                digests.append(digest)
+                lines.append(line)
     finally:
         f.close()
+    return ''.join(digests), marshal.dumps(lines)
+
+def _parsed_indexer_output(fnames, nb_jobs):
+    """Parse the CSVs ``fnames`` across ``nb_jobs`` processes, and yield what
+    parse_indexer_output returns for each, in order."""
+    if nb_jobs <= 1:
+        for fname in fnames:
+            yield parse_indexer_output(fname)
+        return
+
+    pool = ProcessPoolExecutor(max_workers=nb_jobs)
+    try:
+        # Keep a couple of CSVs per worker in flight: enough to keep the pool
+        # busy without piling parsed lines up in memory.
+        in_flight = deque()
+        for fname in fnames:
+            in_flight.append(pool.submit(parse_indexer_output, fname))
+            if len(in_flight) > 2 * nb_jobs:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+    finally:
+        pool.shutdown()
+
+def spool_indexer_output(fnames, nb_jobs=1):
+    """Parse the CSVs ``fnames`` across ``nb_jobs`` processes, and return a
+    temporary file of what parse_indexer_output returns for each, rewound for
+    distinct_indexer_output() to read."""
+    spool = TemporaryFile()
+    try:
+        for parsed in _parsed_indexer_output(fnames, nb_jobs):
+            marshal.dump(parsed, spool)
+        spool.seek(0)
+    except:
+        spool.close()
+        raise
+    return spool
+
+def distinct_indexer_output(spool, memory=500000):
+    """Yield the lines spooled by spool_indexer_output(), leaving out those
+    seen lately.
+
+    Headers are recorded again by every translation unit that includes them,
+    so most lines are duplicates. Dropping them here, by content hash, saves
+    processing them only for INSERT OR IGNORE to throw them away.
+
+    :arg memory: How many digests of lines to remember at least, and at most
+        twice that. Each takes about 100 bytes. Once that many are seen, the
+        older half is forgotten, so the occasional duplicate gets through on
+        big trees, to be ignored by the database instead.
+
+    """
+    seen, older = set(), set()
+    while True:
+        try:
+            digests, lines = marshal.load(spool)
+        except EOFError:
+            return
+        for i, line in enumerate(marshal.loads(lines)):
+            digest = digests[i * 20:i * 20 + 20]
+            if digest not in seen and digest not in older:
+                seen.add(digest)
+                if len(seen) >= memory:
+                    seen, older = set(), seen
+                yield line
+
+def dump_indexer_output(conn, lines, inserter):
+    for line in lines:
+        # Our first column is the type that we're reading, the others are
+        # key/value pairs to be passed in.
+        pairs = iter(line)
+        kind = next(pairs)
+        args = dict(izip(pairs, pairs))
+
+        stmt = _processor(kind)(args, conn)
+        if stmt is not None:
+            inserter.add(*stmt)
 
 def canonicalize_decl(name, id, line, col):
     value = decl_master.get((name, id, line, col), None)
@@ -577,15 +799,18 @@ def recanon_decl(name, loc):
     return (name, loc)
 
 def fixup_scope(conn):
-    conn.execute ("UPDATE types SET scopeid = (SELECT id FROM scopes WHERE " +
-                                "scopes.file_id = types.file_id AND scopes.file_line = types.file_line " +
-                                "AND scopes.file_col = types.file_col) WHERE scopeid IS NULL")
-    conn.execute ("UPDATE functions SET scopeid = (SELECT id from scopes where " +
-                                "scopes.file_id = functions.file_id AND scopes.file_line = functions.file_line " +
-                                "AND scopes.file_col = functions.file_col) WHERE scopeid IS NULL")
-    conn.execute ("UPDATE variables SET scopeid = (SELECT id from scopes where " +
-                                "scopes.file_id = variables.file_id AND scopes.file_line = variables.file_line " +
-                                "AND scopes.file_col = variables.file_col) WHERE scopeid IS NULL")
+    """Give the types, functions and variables without a scope the one at
+    their location, if there is one."""
+    for table in ['types', 'functions', 'variables']:
+        updates = []
+        for id, file_id, file_line, file_col in conn.execute(
+                "SELECT id, file_id, file_line, file_col FROM %s "
+                "WHERE scopeid IS NULL" % table).fetchall():
+            scopeid = scope_ids.get((file_id, file_line, file_col))
+            if scopeid is not None:
+                updates.append((scopeid, id))
+        conn.executemany("UPDATE %s SET scopeid = ? WHERE id = ?" % table,
+                         updates)
 
 
 def build_inherits(base, child, direct):
@@ -595,14 +820,15 @@ def build_inherits(base, child, direct):
     return db
 
 def generate_inheritance(conn):
-    childMap, parentMap = {}, {}
+    """Fill the impl table with the transitive closure of inheritance."""
     types = {}
 
     for row in conn.execute("SELECT qualname, file_id, file_line, file_col, id from types").fetchall():
         types[(row[0], row[1], row[2], row[3])] = row[4]
 
-    for infoKey in inheritance:
-        info = inheritance[infoKey]
+    children = {}  # base type id -> ids of types directly derived from it
+    direct = {}  # (base, child) -> kind of inheritance
+    for info in inheritance.itervalues():
         try:
             base_loc = splitLoc(conn, info['tbloc'])
             child_loc = splitLoc(conn, info['tcloc'])
@@ -614,29 +840,16 @@ def generate_inheritance(conn):
         except KeyError:
             continue
 
-        conn.execute("INSERT OR IGNORE INTO impl(tbase, tderived, inhtype) VALUES (?, ?, ?)",
-                                  (base, child, info.get('access', '')))
-
-        # Get all known relations
-        subs = childMap.setdefault(child, [])
-        supers = parentMap.setdefault(base, [])
-        # Use this information
-        for sub in subs:
-            conn.execute("INSERT OR IGNORE INTO impl(tbase, tderived) VALUES (?, ?)",
-                                      (base, sub))
-            parentMap[sub].append(base)
-        for sup in supers:
-            conn.execute("INSERT OR IGNORE INTO impl(tbase, tderived) VALUES (?, ?)",
-                                      (sup, child))
-            childMap[sup].append(child)
-
-        # Carry through these relations
-        newsubs = childMap.setdefault(base, [])
-        newsubs.append(child)
-        newsubs.extend(subs)
-        newsupers = parentMap.setdefault(child, [])
-        newsupers.append(base)
-        newsupers.extend(supers)
+        if (base, child) not in direct:
+            direct[base, child] = info.get('access', '')
+            children.setdefault(base, []).append(child)
+
+    # Indirect relations get a NULL inhtype.
+    conn.executemany("INSERT OR IGNORE INTO impl(tbase, tderived, inhtype) VALUES (?, ?, ?)",
+                     ((base, derived, direct.get((base, derived)))
+                      for base, derivatives in descendants(children).iteritems()
+                      for derived in derivatives
+                      if derived != base))
 
 
 def generate_callgraph(conn):
@@ -700,157 +913,360 @@ def generate_callgraph(conn):
 
         overridemap.setdefault(basekey, set()).add(funcid)
 
-    rescan = [x for x in overridemap]
-    while len(rescan) > 0:
-        base = rescan.pop(0)
-        childs = overridemap[base]
-        prev = len(childs)
-        temp = childs.union(*(overridemap.get(sub, []) for sub in childs))
-        childs.update(temp)
-        if len(childs) != prev:
-            rescan.append(base)
-
-    for base, childs in overridemap.iteritems():
-        conn.execute("INSERT OR IGNORE INTO targets (targetid, funcid) VALUES (?, ?)",
-                                  (-base, base));
-
-        for child in childs:
-            conn.execute("INSERT OR IGNORE INTO targets (targetid, funcid) VALUES (?, ?)",
-                                      (-base, child));
+    # A virtual call may land on the function or anything overriding it,
+    # however indirectly.
+    overriders = descendants(overridemap)
+    targets = []
+    for base in overridemap:
+        targets.append((-base, base))
+        targets.extend((-base, child) for child in overriders[base])
 
+    callers = []
     for call in callgraph:
         if call['calltype'] == 'virtual':
             targetid = call['targetid']
             call['targetid'] = -targetid
             if targetid not in overridemap:
                 overridemap[targetid] = set()
-                conn.execute("INSERT OR IGNORE INTO targets (targetid, funcid) VALUES (?, ?)",
-                                          (-targetid, targetid));
-        conn.execute("INSERT OR IGNORE INTO callers (callerid, targetid) VALUES (?, ?)",
-                                    (call['callerid'], call['targetid']))
-
+                targets.append((-targetid, targetid))
+        callers.append((call['callerid'], call['targetid']))
+
+    conn.executemany("INSERT OR IGNORE INTO targets (targetid, funcid) VALUES (?, ?)",
+                     targets)
+    conn.executemany("INSERT OR IGNORE INTO callers (callerid, targetid) VALUES (?, ?)",
+                     callers)
+
+
+# How definitions and references are resolved, in order. Each entry is (table,
+# column, target table, target column, prefix): for each row of the table whose
+# column is NULL, it's set to the target column of the target row at the row's
+# prefixed location (eg. its referenced_file_id, referenced_file_line and
+# referenced_file_col).
+_defid_resolutions = [
+    ('type_decldef', 'defid', 'types', 'id', 'definition'),
+    ('function_decldef', 'defid', 'functions', 'id', 'definition'),
+    ('variable_decldef', 'defid', 'variables', 'id', 'definition'),
+]
+_refid_resolutions = [
+    # References to declarations
+    ('type_refs', 'refid', 'type_decldef', 'defid', 'referenced'),
+    ('function_refs', 'refid', 'function_decldef', 'defid', 'referenced'),
+    ('variable_refs', 'refid', 'variable_decldef', 'defid', 'referenced'),
+    # References to definitions
+    ('macro_refs', 'refid', 'macros', 'id', 'referenced'),
+    ('type_refs', 'refid', 'types', 'id', 'referenced'),
+    ('typedef_refs', 'refid', 'typedefs', 'id', 'referenced'),
+    ('function_refs', 'refid', 'functions', 'id', 'referenced'),
+    ('variable_refs', 'refid', 'variables', 'id', 'referenced'),
+    ('namespace_refs', 'refid', 'namespaces', 'id', 'referenced'),
+    ('namespace_alias_refs', 'refid', 'namespace_aliases', 'id', 'referenced'),
+]
+
+def create_resolution_indexes(conn):
+    """Index the targets of resolution by location, covering the column taken
+    from them, so resolving never has to visit the tables themselves.
+
+    Targets whose column is their rowid need none: their unique location
+    index carries the rowid already.
+
+    """
+    targets = set((target, target_column) for _, _, target, target_column, _
+                  in _defid_resolutions + _refid_resolutions)
+    for target, target_column in sorted(targets):
+        if not _is_rowid(target, target_column):
+            conn.execute("CREATE INDEX IF NOT EXISTS %s_resolution_index "
+                         "ON %s (file_id, file_line, file_col, %s)" %
+                         (target, target, target_column))
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS resolved "
+                 "(source_row INTEGER PRIMARY KEY, value INTEGER)")
+
+def _is_rowid(table, column):
+    """Return whether a column is its table's INTEGER PRIMARY KEY, which
+    SQLite makes an alias of the rowid."""
+    spec = schema.tables.get(table) or language_schema.tables[table]
+    return (spec.key == (column,) and
+            dict(spec.columns)[column][0] == 'INTEGER')
+
+def drop_resolution_indexes(conn):
+    """Drop what create_resolution_indexes made, which is of no use to the web
+    app."""
+    targets = set(target for _, _, target, _, _
+                  in _defid_resolutions + _refid_resolutions)
+    for target in sorted(targets):
+        conn.execute("DROP INDEX IF EXISTS %s_resolution_index" % target)
+    conn.execute("DROP TABLE IF EXISTS temp.resolved")
+
+def resolve(conn, table, column, target, target_column, prefix):
+    """Carry out one of the resolutions of _defid_resolutions or
+    _refid_resolutions.
+
+    Rather than run a subquery per row, join the table to the target once,
+    noting the values found by rowid, and then update just those rows.
+
+    """
+    conn.execute("DELETE FROM temp.resolved")
+    # Where several targets share a location, the lowest value wins.
+    conn.execute("""
+        INSERT INTO temp.resolved (source_row, value)
+             SELECT source.rowid, min(target.{target_column})
+               FROM {table} AS source, {target} AS target
+              WHERE source.{column} IS NULL
+                AND target.file_id   = source.{prefix}_file_id
+                AND target.file_line = source.{prefix}_file_line
+                AND target.file_col  = source.{prefix}_file_col
+                AND target.{target_column} IS NOT NULL
+           GROUP BY source.rowid""".format(
+        table=table, column=column, target=target,
+        target_column=target_column, prefix=prefix))
+    conn.execute("""
+        UPDATE {table} SET {column} = (
+               SELECT value FROM temp.resolved
+                WHERE source_row = {table}.rowid)
+         WHERE rowid IN (SELECT source_row FROM temp.resolved)""".format(
+        table=table, column=column))
+
+def _resolve_all(conn, resolutions):
+    for resolution in resolutions:
+        start = time()
+        resolve(conn, *resolution)
+        print "   - %s.%s from %s: %.2fs" % (resolution[0], resolution[1],
+                                            resolution[2], time() - start)
 
 def update_defids(conn):
-    sql = """
-        UPDATE type_decldef SET defid = (
-              SELECT id
-                FROM types AS def
-               WHERE def.file_id   = definition_file_id
-                 AND def.file_line = definition_file_line
-                 AND def.file_col  = definition_file_col
-        )"""
-    conn.execute(sql)
-    sql = """
-        UPDATE function_decldef SET defid = (
-              SELECT id
-                FROM functions AS def
-               WHERE def.file_id   = definition_file_id
-                 AND def.file_line = definition_file_line
-                 AND def.file_col  = definition_file_col
-        )"""
-    conn.execute(sql)
-    sql = """
-        UPDATE variable_decldef SET defid = (
-              SELECT id
-                FROM variables AS def
-               WHERE def.file_id   = definition_file_id
-                 AND def.file_line = definition_file_line
-                 AND def.file_col  = definition_file_col
-        )"""
-    conn.execute(sql)
-
+    _resolve_all(conn, _defid_resolutions)
 
 def update_refs(conn):
-    # References to declarations
-    sql = """
-        UPDATE type_refs SET refid = (
-                SELECT defid
-                  FROM type_decldef AS decl
-                 WHERE decl.file_id   = referenced_file_id
-                   AND decl.file_line = referenced_file_line
-                   AND decl.file_col  = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE function_refs SET refid = (
-                SELECT defid
-                  FROM function_decldef AS decl
-                 WHERE decl.file_id   = referenced_file_id
-                   AND decl.file_line = referenced_file_line
-                   AND decl.file_col  = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE variable_refs SET refid = (
-                SELECT defid
-                  FROM variable_decldef AS decl
-                 WHERE decl.file_id   = referenced_file_id
-                   AND decl.file_line = referenced_file_line
-                   AND decl.file_col  = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-
-    # References to definitions
-    sql = """
-        UPDATE macro_refs SET refid = (
-                SELECT id
-                  FROM macros AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE type_refs SET refid = (
-                SELECT id
-                  FROM types AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE typedef_refs SET refid = (
-                SELECT id
-                  FROM typedefs AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE function_refs SET refid = (
-                SELECT id
-                  FROM functions AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE variable_refs SET refid = (
-                SELECT id
-                  FROM variables AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE namespace_refs SET refid = (
-                SELECT id
-                  FROM namespaces AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
-    sql = """
-        UPDATE namespace_alias_refs SET refid = (
-                SELECT id
-                  FROM namespace_aliases AS def
-                 WHERE def.file_id    = referenced_file_id
-                   AND def.file_line  = referenced_file_line
-                   AND def.file_col   = referenced_file_col
-        ) WHERE refid IS NULL"""
-    conn.execute(sql)
+    _resolve_all(conn, _refid_resolutions)
+
+
+# Queries yielding the refs of every file, in the order the htmlifier used to
+# look them up. Each selects (file_id, extent_start, extent_end, name, extra,
+# value, path, line), where extra is the second argument of the kind's menu
+# builder, and path and line locate the definition to jump to, if any.
+_ref_queries = [
+    ('function', """
+        SELECT file_id, extent_start, extent_end, qualname,
+               id IN (SELECT funcid FROM targets), NULL, NULL, NULL
+          FROM functions
+      ORDER BY file_id, file_line, file_col"""),
+    ('function', """
+        SELECT decldef.file_id, decldef.extent_start, decldef.extent_end,
+               functions.qualname,
+               functions.id IN (SELECT funcid FROM targets), NULL,
+               (SELECT path FROM files WHERE files.id = functions.file_id),
+               functions.file_line
+          FROM function_decldef AS decldef, functions
+         WHERE decldef.defid = functions.id
+      ORDER BY decldef.file_id, decldef.file_line, decldef.file_col"""),
+    ('variable', """
+        SELECT file_id, extent_start, extent_end, qualname, NULL, value,
+               NULL, NULL
+          FROM variables
+      ORDER BY file_id, file_line, file_col"""),
+    ('variable', """
+        SELECT decldef.file_id, decldef.extent_start, decldef.extent_end,
+               variables.qualname, NULL, variables.value,
+               (SELECT path FROM files WHERE files.id = variables.file_id),
+               variables.file_line
+          FROM variable_decldef AS decldef, variables
+         WHERE decldef.defid = variables.id
+      ORDER BY decldef.file_id, decldef.file_line, decldef.file_col"""),
+    ('type', """
+        SELECT file_id, extent_start, extent_end, qualname, kind, NULL,
+               NULL, NULL
+          FROM types
+      ORDER BY file_id, file_line, file_col"""),
+    ('type', """
+        SELECT decldef.file_id, decldef.extent_start, decldef.extent_end,
+               types.qualname, types.kind, NULL,
+               (SELECT path FROM files WHERE files.id = types.file_id),
+               types.file_line
+          FROM type_decldef AS decldef, types
+         WHERE decldef.defid = types.id
+      ORDER BY decldef.file_id, decldef.file_line, decldef.file_col"""),
+    ('typedef', """
+        SELECT file_id, extent_start, extent_end, qualname, NULL, NULL,
+               NULL, NULL
+          FROM typedefs
+      ORDER BY file_id, file_line, file_col"""),
+    ('namespace', """
+        SELECT file_id, extent_start, extent_end, qualname, NULL, NULL,
+               NULL, NULL
+          FROM namespaces
+      ORDER BY file_id, file_line, file_col"""),
+    ('namespace_alias', """
+        SELECT file_id, extent_start, extent_end, qualname, NULL, NULL,
+               NULL, NULL
+          FROM namespace_aliases
+      ORDER BY file_id, file_line, file_col"""),
+    ('macro', """
+        SELECT file_id, extent_start, extent_end, name, NULL, text,
+               NULL, NULL
+          FROM macros
+      ORDER BY file_id, file_line, file_col"""),
+    ('type', """
+        SELECT refs.file_id, refs.extent_start, refs.extent_end,
+               types.qualname, types.kind, NULL,
+               (SELECT path FROM files WHERE files.id = types.file_id),
+               types.file_line
+          FROM types, type_refs AS refs
+         WHERE types.id = refs.refid
+      ORDER BY refs.file_id, refs.file_line, refs.file_col"""),
+    ('typedef', """
+        SELECT refs.file_id, refs.extent_start, refs.extent_end,
+               typedefs.qualname, NULL, NULL,
+               (SELECT path FROM files WHERE files.id = typedefs.file_id),
+               typedefs.file_line
+          FROM typedefs, typedef_refs AS refs
+         WHERE typedefs.id = refs.refid
+      ORDER BY refs.file_id, refs.file_line, refs.file_col"""),
+    ('function', """
+        SELECT refs.file_id, refs.extent_start, refs.extent_end,
+               functions.qualname,
+               functions.id IN (SELECT funcid FROM targets), NULL,
+               (SELECT path FROM files WHERE files.id = functions.file_id),
+               functions.file_line
+          FROM functions, function_refs AS refs
+         WHERE functions.id = refs.refid
+      ORDER BY refs.file_id, refs.file_line, refs.file_col"""),
+    ('variable', """
+        SELECT refs.file_id, refs.extent_start, refs.extent_end,
+               variables.qualname, NULL, variables.value,
+               (SELECT path FROM files WHERE files.id = variables.file_id),
+               variables.file_line
+          FROM variables, variable_refs AS refs
+         WHERE variables.id = refs.refid
+      ORDER BY refs.file_id, refs.file_line, refs.file_col"""),
+    # References to namespaces don't jump to a definition.
+    ('namespace', """
+        SELECT refs.file_id, refs.extent_start, refs.extent_end,
+               namespaces.qualname, NULL, NULL, NULL, NULL
+          FROM namespaces, namespace_refs AS refs
+         WHERE namespaces.id = refs.refid
+      ORDER BY refs.file_id, refs.file_line, refs.file_col"""),
+    ('namespace_alias', """
+        SELECT refs.file_id, refs.extent_start, refs.extent_end,
+               namespace_aliases.qualname, NULL, NULL,
+               (SELECT path FROM files
+                 WHERE files.id = namespace_aliases.file_id),
+               namespace_aliases.file_line
+          FROM namespace_aliases, namespace_alias_refs AS refs
+         WHERE namespace_aliases.id = refs.refid
+      ORDER BY refs.file_id, refs.file_line, refs.file_col"""),
+    ('macro', """
+        SELECT refs.file_id, refs.extent_start, refs.extent_end,
+               macros.name, NULL, macros.text,
+               (SELECT path FROM files WHERE files.id = macros.file_id),
+               macros.file_line
+          FROM macros, macro_refs AS refs
+         WHERE macros.id = refs.refid
+      ORDER BY refs.file_id, refs.file_line, refs.file_col"""),
+    # #includes jump to the whole file they include.
+    ('include', """
+        SELECT includes.file_id, extent_start, extent_end, '', NULL, NULL,
+               path, NULL
+          FROM includes INNER JOIN files ON files.id = includes.target_id
+      ORDER BY includes.file_id"""),
+]
+
+# Queries yielding what goes into the warnings and the navigation sections
+_other_queries = [
+    ('warning', """
+        SELECT file_id, file_line, msg, opt
+          FROM warnings
+      ORDER BY file_id, file_line"""),
+    ('type_link', """
+        SELECT file_id, id, name, file_line, kind
+          FROM types
+      ORDER BY file_id, file_line, file_col"""),
+    ('member', """
+        SELECT file_id, scopeid, 'method', name, file_line
+          FROM functions
+         WHERE scopeid IS NOT NULL AND name != ''
+      ORDER BY file_id, file_line, file_col"""),
+    ('member', """
+        SELECT file_id, scopeid, 'field', name, file_line
+          FROM variables
+         WHERE scopeid IS NOT NULL AND name != ''
+      ORDER BY file_id, file_line, file_col"""),
+    ('macro_link', """
+        SELECT file_id, name, file_line
+          FROM macros
+      ORDER BY file_id, file_line, file_col"""),
+]
+
+
+def _numbered_rows(conn, number, sql):
+    """Yield (file_id, query number, row number, rest of the row) for each row
+    of a query whose first column is a file ID."""
+    for row_number, row in enumerate(conn.execute(sql)):
+        if row[0] is not None:
+            yield row[0], number, row_number, row[1:]
+
+
+def _annotation_record(kinds, rows):
+    """Return the (refs, warnings, sections) record of a file, given the rows
+    of the queries about it, in query order."""
+    refs, warnings, types, macros = [], [], [], []
+    members = {}
+    for file_id, number, row_number, row in rows:
+        kind = kinds[number]
+        if kind == 'warning':
+            line, msg, opt = row
+            if opt:
+                msg = msg + " [" + opt + "]"
+            warnings.append((line, msg))
+        elif kind == 'type_link':
+            types.append(row)
+        elif kind == 'member':
+            scopeid, link_kind, name, line = row
+            members.setdefault(scopeid, []).append(
+                (link_kind, name, "#%s" % line))
+        elif kind == 'macro_link':
+            name, line = row
+            macros.append(('macro', name, "#%s" % line))
+        else:
+            refs.append((kind,) + row)
+
+    # For each type add a section with members
+    sections = []
+    for tid, name, line, type_kind in types:
+        if len(name) == 0: continue
+        links = sorted(members.get(tid, []), key=lambda link: link[1])
+
+        # Make sure we have a sane limitation of kind
+        if type_kind not in ('class', 'struct', 'enum', 'union'):
+            print >> sys.stderr, "kind '%s' was replaced for 'type'!" % type_kind
+            type_kind = 'type'
+
+        # Add the outer type as the first link
+        links.insert(0, (type_kind, name, "#%s" % line))
+        sections.append((30, name, links))
+
+    # Add all macros to the macro section
+    if macros:
+        sections.append((100, "Macros", macros))
+    return refs, warnings, sections
+
+
+def materialize_annotations(conn, batch_size=1000):
+    """Store, for each file, the refs, warnings and navigation links the
+    htmlifier shows for it.
+
+    Rather than running a score of queries per file at HTML time, we run each
+    of them once over the whole tree, ordered by file, and merge the results.
+
+    """
+    queries = _ref_queries + _other_queries
+    kinds = [kind for kind, sql in queries]
+    rows = merge(*[_numbered_rows(conn, number, sql)
+                   for number, (kind, sql) in enumerate(queries)])
+    insert = 'INSERT INTO file_annotations (file_id, data) VALUES (?, ?)'
+    batch = []
+    for file_id, file_rows in groupby(rows, lambda row: row[0]):
+        record = _annotation_record(kinds, file_rows)
+        batch.append((file_id, buffer(marshal.dumps(record))))
+        if len(batch) >= batch_size:
+            conn.executemany(insert, batch)
+            batch = []
+    conn.executemany(insert, batch)
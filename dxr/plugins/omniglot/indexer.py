@@ -1,13 +1,18 @@
 import dxr.plugins
+from omniglot.vcs import (discover_repositories, repositories_path,
+                          save_repositories)
 
-# Nothing to do here, but we must implement indexer.py to explicitely declared
-# that these functions are no-op. Otherwise DXR shall assume the file or the
-# implementation is missing, and thus, something is badly wrong.
 
 def pre_process(tree, environ):
     pass
 
+
 def post_process(tree, conn):
-    pass
+    """Discover the tree's repositories once, rather than in every HTML
+    worker, and save them for the htmlifier."""
+    print "omniglot post-processing:"
+    print " - Discovering repositories"
+    save_repositories(discover_repositories(tree), repositories_path(tree))
+
 
 __all__ = dxr.plugins.indexer_exports()
@@ -79,7 +79,7 @@ class Query(object):
                 FROM trg_index, files
               WHERE %s ORDER BY files.path LIMIT ? OFFSET ?
         """
-        conditions = " files.id = trg_index.id "
+        conditions = " files.blob_id = trg_index.id "
         arguments = []
 
         # Give each registered filter an opportunity to contribute to the
@@ -331,6 +331,22 @@ def like_escape(val):
                .replace("?", "_")
                .replace("*", "%"))
 
+
+def trigram_query(val):
+    """Return a trilite query for the names in symbol_trg which might match a
+    pattern for the LIKE operator, as taken by like_escape(), or None if the
+    index isn't worth consulting.
+
+    It's worth it only for patterns starting with a wildcard, which B-tree
+    indexes can't help with, and only if they have a run of 3 or more literal
+    characters for the trigrams to narrow things down by.
+
+    """
+    if not val.startswith(("*", "?")):
+        return None
+    longest = max(re.split(r"[*?]", val), key=len)
+    return "isubstr:" + longest if len(longest) >= 3 else None
+
 class genWrap(object):
     """Auxiliary class for wrapping a generator and make it nicer"""
     def __init__(self, gen):
@@ -486,7 +502,7 @@ class TriLiteSearchFilter(SearchFilter):
                            True)
 
         if not_conds:
-            yield (""" files.id NOT IN (SELECT id FROM trg_index WHERE %s) """
+            yield (""" files.blob_id NOT IN (SELECT id FROM trg_index WHERE %s) """
                        % " AND ".join(not_conds),
                    not_args,
                    False)
@@ -547,22 +563,42 @@ class ExistsLikeFilter(SearchFilter):
             given arguments (file_id, %arg%), where arg is the argument given to
             param. Again %s will be replaced with " = ?" or "LIKE %?%" depending on
             whether or not param is prefixed +
+            Pass symbol_names=True if like_name is the name of a symbol from one of
+            the tables symbol_trg indexes, so patterns with leading wildcards can be
+            looked up there first.
     """
-    def __init__(self, param, filter_sql, ext_sql, qual_name, like_name, **kwargs):
+    def __init__(self, param, filter_sql, ext_sql, qual_name, like_name,
+                 symbol_names=False, **kwargs):
         super(ExistsLikeFilter, self).__init__(**kwargs)
         self.param = param
         self.filter_sql = filter_sql
         self.ext_sql = ext_sql
         self.qual_expr = " %s = ? " % qual_name
         self.like_expr = """ %s LIKE ? ESCAPE "\\" """ % like_name
+        if symbol_names:
+            # Narrow patterns with leading wildcards down by symbol_trg first:
+            self.trigram_expr = (""" (%s LIKE ? ESCAPE "\\"
+                                      AND %s IN (SELECT text FROM symbol_trg
+                                                 WHERE contents MATCH ?)) """ %
+                                 (like_name, like_name))
+        else:
+            self.trigram_expr = None
+
+    def _condition(self, term):
+        """Return the expression to substitute into the SQL for a term, and
+        its params."""
+        arg = term['arg']
+        if term['qualified']:
+            return self.qual_expr, [arg]
+        trigrams = self.trigram_expr and trigram_query(arg)
+        if trigrams:
+            return self.trigram_expr, [like_escape(arg), trigrams]
+        return self.like_expr, [like_escape(arg)]
 
     def filter(self, terms):
         for term in terms.get(self.param, []):
-            is_qualified = term['qualified']
-            arg = term['arg']
-            filter_sql = (self.filter_sql % (self.qual_expr if is_qualified
-                                             else self.like_expr))
-            sql_params = [arg if is_qualified else like_escape(arg)]
+            sql_expr, sql_params = self._condition(term)
+            filter_sql = self.filter_sql % sql_expr
             if term['not']:
                 yield 'NOT EXISTS (%s)' % filter_sql, sql_params, False
             else:
@@ -571,12 +607,9 @@ class ExistsLikeFilter(SearchFilter):
     def extents(self, terms, execute_sql, file_id):
         def builder():
             for term in terms.get(self.param, []):
-                arg = term['arg']
-                escaped_arg, sql_expr = (
-                    (arg, self.qual_expr) if term['qualified']
-                    else (like_escape(arg), self.like_expr))
+                sql_expr, sql_params = self._condition(term)
                 for start, end in execute_sql(self.ext_sql % sql_expr,
-                                              [file_id, escaped_arg]):
+                                              [file_id] + sql_params):
                     # Nones used to occur in the DB. Is this still true?
                     if start and end:
                         yield start, end, []
@@ -656,6 +689,7 @@ filters = [
                            ORDER BY functions.extent_start
                         """,
         like_name     = "functions.name",
+        symbol_names  = True,
         qual_name     = "functions.qualname"
     ),
 
@@ -675,6 +709,7 @@ filters = [
                            ORDER BY refs.extent_start
                         """,
         like_name     = "functions.name",
+        symbol_names  = True,
         qual_name     = "functions.qualname"
     ),
 
@@ -694,6 +729,7 @@ filters = [
                            ORDER BY decldef.extent_start
                         """,
         like_name     = "functions.name",
+        symbol_names  = True,
         qual_name     = "functions.qualname"
     ),
 
@@ -719,6 +755,7 @@ filters = [
                              ORDER BY functions.extent_start
                           """,
           like_name     = "target.name",
+          symbol_names  = True,
           qual_name     = "target.qualname"
       ),
 
@@ -745,6 +782,7 @@ filters = [
                              ORDER BY functions.extent_start
                           """,
           like_name     = "target.name",
+          symbol_names  = True,
           qual_name     = "target.qualname")],
 
       description = Markup('Functions which call the given function or method: <code>callers:GetStringFromName</code>')
@@ -772,6 +810,7 @@ filters = [
                              ORDER BY functions.extent_start
                           """,
           like_name     = "caller.name",
+          symbol_names  = True,
           qual_name     = "caller.qualname"
       ),
 
@@ -798,6 +837,7 @@ filters = [
                              ORDER BY functions.extent_start
                           """,
           like_name     = "caller.name",
+          symbol_names  = True,
           qual_name     = "caller.qualname"
       )],
 
@@ -818,6 +858,7 @@ filters = [
                            ORDER BY types.extent_start
                         """,
         like_name     = "types.name",
+        symbol_names  = True,
         qual_name     = "types.qualname"
       ),
       ExistsLikeFilter(
@@ -832,6 +873,7 @@ filters = [
                            ORDER BY typedefs.extent_start
                         """,
         like_name     = "typedefs.name",
+        symbol_names  = True,
         qual_name     = "typedefs.qualname")],
       description=Markup('Type or class definition: <code>type:Stack</code>')
     ),
@@ -852,6 +894,7 @@ filters = [
                            ORDER BY refs.extent_start
                         """,
         like_name     = "types.name",
+        symbol_names  = True,
         qual_name     = "types.qualname"
       ),
       ExistsLikeFilter(
@@ -868,6 +911,7 @@ filters = [
                            ORDER BY refs.extent_start
                         """,
         like_name     = "typedefs.name",
+        symbol_names  = True,
         qual_name     = "typedefs.qualname")],
       description='Type or class references, uses, or instantiations'
     ),
@@ -888,6 +932,7 @@ filters = [
                          ORDER BY decldef.extent_start
                       """,
       like_name     = "types.name",
+      symbol_names  = True,
       qual_name     = "types.qualname"
     ),
 
@@ -905,6 +950,7 @@ filters = [
                            ORDER BY variables.extent_start
                         """,
         like_name     = "variables.name",
+        symbol_names  = True,
         qual_name     = "variables.qualname"
     ),
 
@@ -924,6 +970,7 @@ filters = [
                            ORDER BY refs.extent_start
                         """,
         like_name     = "variables.name",
+        symbol_names  = True,
         qual_name     = "variables.qualname"
     ),
 
@@ -943,6 +990,7 @@ filters = [
                            ORDER BY decldef.extent_start
                         """,
         like_name     = "variables.name",
+        symbol_names  = True,
         qual_name     = "variables.qualname"
     ),
 
@@ -960,6 +1008,7 @@ filters = [
                            ORDER BY macros.extent_start
                         """,
         like_name     = "macros.name",
+        symbol_names  = True,
         qual_name     = "macros.name"
     ),
 
@@ -979,6 +1028,7 @@ filters = [
                            ORDER BY refs.extent_start
                         """,
         like_name     = "macros.name",
+        symbol_names  = True,
         qual_name     = "macros.name"
     ),
 
@@ -996,6 +1046,7 @@ filters = [
                            ORDER BY namespaces.extent_start
                         """,
         like_name     = "namespaces.name",
+        symbol_names  = True,
         qual_name     = "namespaces.qualname"
     ),
 
@@ -1015,6 +1066,7 @@ filters = [
                            ORDER BY refs.extent_start
                         """,
         like_name     = "namespaces.name",
+        symbol_names  = True,
         qual_name     = "namespaces.qualname"
     ),
 
@@ -1032,6 +1084,7 @@ filters = [
                            ORDER BY namespace_aliases.extent_start
                         """,
         like_name     = "namespace_aliases.name",
+        symbol_names  = True,
         qual_name     = "namespace_aliases.qualname"
     ),
 
@@ -1051,6 +1104,7 @@ filters = [
                            ORDER BY refs.extent_start
                         """,
         like_name     = "namespace_aliases.name",
+        symbol_names  = True,
         qual_name     = "namespace_aliases.qualname"
     ),
 
@@ -1073,6 +1127,7 @@ filters = [
                                         )
                         """,
         like_name     = "types.name",
+        symbol_names  = True,
         qual_name     = "types.qualname"
     ),
 
@@ -1095,6 +1150,7 @@ filters = [
                                         )
                         """,
         like_name     = "types.name",
+        symbol_names  = True,
         qual_name     = "types.qualname"
     ),
 
@@ -1114,6 +1170,7 @@ filters = [
                            ORDER BY mem.extent_start
                         """,
         like_name     = "type.name",
+        symbol_names  = True,
         qual_name     = "type.qualname"
       ),
       # member filter for types
@@ -1131,6 +1188,7 @@ filters = [
                            ORDER BY mem.extent_start
                         """,
         like_name     = "type.name",
+        symbol_names  = True,
         qual_name     = "type.qualname"
       ),
       # member filter for variables
@@ -1148,6 +1206,7 @@ filters = [
                            ORDER BY mem.extent_start
                         """,
         like_name     = "type.name",
+        symbol_names  = True,
         qual_name     = "type.qualname")],
 
       description = Markup('Member variables, types, or methods of a class: <code>member:SomeClass</code>')
@@ -1160,7 +1219,7 @@ filters = [
         filter_sql    = """SELECT 1
                              FROM functions as base, functions as derived, targets
                             WHERE %s
-                              AND base.id = -targets.targetid
+                              AND targets.targetid = -base.id
                               AND derived.id = targets.funcid
                               AND base.id <> derived.id
                               AND base.file_id = files.id
@@ -1170,13 +1229,14 @@ filters = [
                            WHERE functions.file_id = ?
                              AND EXISTS (SELECT 1 FROM functions as derived, targets
                                           WHERE %s
-                                            AND functions.id = -targets.targetid
+                                            AND targets.targetid = -functions.id
                                             AND derived.id = targets.funcid
                                             AND functions.id <> derived.id
                                         )
                            ORDER BY functions.extent_start
                         """,
         like_name     = "derived.name",
+        symbol_names  = True,
         qual_name     = "derived.qualname"
     ),
 
@@ -1204,6 +1264,7 @@ filters = [
                            ORDER BY functions.extent_start
                         """,
         like_name     = "base.name",
+        symbol_names  = True,
         qual_name     = "base.qualname"
     ),
 
@@ -0,0 +1,240 @@
+"""Rendering file pages in the web app, for trees built with the
+render_on_demand option"""
+
+from hashlib import sha1
+import os
+from os.path import isdir, join
+from shutil import rmtree
+from tempfile import mkstemp
+from threading import Lock
+
+from ordereddict import OrderedDict
+
+from dxr.build import file_page_arguments, load_tree
+from dxr.plugins import load_htmlifiers
+from dxr.utils import connect_database
+
+
+def render_file_page(jinja_env, tree_folder, generation, path, out_path):
+    """Render the page of a file to ``out_path``, from the database in
+    ``tree_folder``. Return whether the file was there to render.
+
+    :arg generation: The build of the tree the database is from, as for
+        PageCache. The tree's plugins are loaded once per generation and kept
+        for later pages.
+
+    """
+    with _renderers_lock:
+        renderer = _renderers.get(tree_folder)
+        if renderer is None:
+            renderer = _renderers[tree_folder] = _TreeRenderer(tree_folder)
+    return renderer.render(jinja_env, generation, path, out_path)
+
+
+class _TreeRenderer(object):
+    """The loaded htmlifiers of a tree, and the connection to its database
+    they use
+
+    Plugins keep what they load in globals, so each tree gets copies of the
+    plugin modules of its own, and renders one page at a time.
+
+    """
+    def __init__(self, tree_folder):
+        self.tree_folder = tree_folder
+        self.generation = None
+        self.tree = None
+        self.conn = None
+        self.plugins = []
+        self._lock = Lock()
+
+    def render(self, jinja_env, generation, path, out_path):
+        with self._lock:
+            if generation != self.generation:
+                self._load(generation)
+            row = self.conn.execute("""
+                                    SELECT icon, trg_index.text
+                                    FROM files, trg_index
+                                    WHERE trg_index.id = files.blob_id
+                                      AND path = ?
+                                    """, [path]).fetchone()
+            if row is None:
+                return False
+            icon, text = row
+            arguments = file_page_arguments(self.tree, self.conn, icon, path,
+                                            text, self.plugins)
+            try:
+                jinja_env.get_template('file.html').stream(
+                    **arguments).dump(out_path, encoding='utf-8')
+            finally:
+                arguments['lines'].close()
+            return True
+
+    def _load(self, generation):
+        """Load the tree and its plugins afresh, for a new build."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        self.generation = None
+        self.tree = load_tree(self.tree_folder)
+        # Connections are normally kept to their threads, but this one is used
+        # by whichever request thread holds the lock:
+        self.conn = connect_database(self.tree, check_same_thread=False)
+        self.conn.execute("PRAGMA query_only = ON")
+        self.plugins = load_htmlifiers(self.tree,
+                                       module_suffix='_' + self.tree.name)
+        for plugin in self.plugins:
+            plugin.load(self.tree, self.conn)
+        self.generation = generation
+
+
+_renderers = {}  # tree folder -> _TreeRenderer
+_renderers_lock = Lock()
+
+
+class PageCache(object):
+    """A bounded cache of rendered pages, on disk and, for the most recently
+    used ones, in memory
+
+    Pages are keyed by tree, build generation, and path. When a tree's
+    generation changes, the pages of its older ones are thrown away. Beyond
+    that, the least recently used pages are evicted to keep within the size
+    limits.
+
+    The on-disk part survives restarts of the app. Several processes may share
+    it, but each enforces the size limit on its own.
+
+    """
+    def __init__(self, folder, disk_size, memory_size=32 * 1024 * 1024):
+        """
+        :arg folder: The folder to keep pages in
+        :arg disk_size: Roughly how many bytes of pages to keep on disk
+        :arg memory_size: Roughly how many bytes of pages to keep in memory
+
+        """
+        self.folder = folder
+        self.disk_size = disk_size
+        self.memory_size = memory_size
+        self._lock = Lock()
+        self._generations = {}  # tree -> generation last asked for
+        self._memory = OrderedDict()  # (tree, generation, path) -> page
+        self._memory_used = 0
+        self._disk = None  # page's path relative to folder -> size
+        self._disk_used = 0
+
+    def page(self, tree, generation, path, render):
+        """Return the page of a file, or None if there is no such file.
+
+        :arg render: A callable that takes a file path and renders the page to
+            it, returning whether there was such a file. It's called only on a
+            cache miss.
+
+        """
+        key = tree, generation, path
+        name = join(tree, generation,
+                    sha1(path.encode('utf-8') if isinstance(path, unicode)
+                         else path).hexdigest() + '.html')
+        with self._lock:
+            self._switch_generation(tree, generation)
+            if key in self._memory:
+                page = self._memory.pop(key)
+                self._memory[key] = page
+                return page
+            cached = name in self._disk
+            if cached:
+                self._disk[name] = self._disk.pop(name)
+        if cached:
+            try:
+                with open(join(self.folder, name), 'rb') as file:
+                    page = file.read()
+            except IOError:  # Evicted by another thread in the meantime
+                cached = False
+        if not cached:
+            page = self._render(name, render)
+            if page is None:
+                return None
+        with self._lock:
+            self._remember(key, page)
+        return page
+
+    def _render(self, name, render):
+        """Render a page into the cache, and return it."""
+        folder = join(self.folder, os.path.dirname(name))
+        try:
+            os.makedirs(folder)
+        except OSError:
+            if not isdir(folder):
+                raise
+        # Render to a temp file and move it into place, so no other thread or
+        # process sees a partial page.
+        fd, temp_path = mkstemp(dir=folder)
+        os.close(fd)
+        try:
+            if not render(temp_path):
+                return None
+            with open(temp_path, 'rb') as file:
+                page = file.read()
+            os.rename(temp_path, join(self.folder, name))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        with self._lock:
+            if name not in self._disk:
+                self._disk[name] = len(page)
+                self._disk_used += len(page)
+            while self._disk_used > self.disk_size and len(self._disk) > 1:
+                evicted, size = self._disk.popitem(last=False)
+                self._disk_used -= size
+                try:
+                    os.remove(join(self.folder, evicted))
+                except OSError:
+                    pass
+        return page
+
+    def _remember(self, key, page):
+        """Keep a page in memory, evicting others as needed."""
+        if key in self._memory or len(page) > self.memory_size / 4:
+            return
+        self._memory[key] = page
+        self._memory_used += len(page)
+        while self._memory_used > self.memory_size:
+            evicted_key, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted)
+
+    def _switch_generation(self, tree, generation):
+        """Throw away the pages of a tree's other generations if it's on a new
+        one. Load the index of what's on disk the first time."""
+        if self._disk is None:
+            self._load_disk_index()
+        if self._generations.get(tree) == generation:
+            return
+        self._generations[tree] = generation
+        tree_folder = join(self.folder, tree)
+        if not isdir(tree_folder):
+            return
+        for other in os.listdir(tree_folder):
+            if other != generation:
+                rmtree(join(tree_folder, other), ignore_errors=True)
+        prefix = tree + os.sep
+        for name in [n for n in self._disk if n.startswith(prefix) and
+                     not n.startswith(join(tree, generation) + os.sep)]:
+            self._disk_used -= self._disk.pop(name)
+        for key in [k for k in self._memory if k[0] == tree and
+                    k[1] != generation]:
+            self._memory_used -= len(self._memory.pop(key))
+
+    def _load_disk_index(self):
+        """Index the pages already on disk, least recently modified first."""
+        pages = []
+        for root, folders, files in os.walk(self.folder):
+            for f in files:
+                path = join(root, f)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                pages.append((stat.st_mtime,
+                              os.path.relpath(path, self.folder),
+                              stat.st_size))
+        pages.sort()
+        self._disk = OrderedDict((name, size) for mtime, name, size in pages)
+        self._disk_used = sum(size for mtime, name, size in pages)
@@ -26,6 +26,9 @@ class Schema(object):
     def get_insert_sql(self, tblname, args):
         return self.tables[tblname].get_insert_sql(args)
 
+    def get_insert_row(self, tblname, args):
+        return self.tables[tblname].get_insert_row(args)
+
 
 class SchemaTable(object):
     """ A table schema dictionary has column names as keys and information tuples
@@ -37,6 +40,12 @@ class SchemaTable(object):
       
         Any column name that begins with a `_' is metadata about the table:
           _key: the result tuple is a tuple for the primary key of the table.
+          _index: the result tuple is a tuple of columns to index. There may be
+              several. A dictionary of options may follow the columns:
+              "name" overrides the index's name, "unique" makes it a unique
+              index, and "collate" (e.g., "NOCASE") sets the collation of
+              its columns, so that case-insensitive comparisons, LIKE
+              included, can use it.
 
         Special values for type strings are as follows:
           _location: A file:loc[:col] value for the column. A boolean element
@@ -53,11 +62,12 @@ class SchemaTable(object):
     def __init__(self, tblname, tblschema):
         self.name = tblname
         self.key = None
-        self.index = None
+        self.indexes = []
         self.fkeys = []
         self.columns = []
         self.needLang = False
         self.needFileKey = False
+        self._insert_sql = None
         defaults = ['VARCHAR(256)', True]
         for col in tblschema:
             if isinstance(tblschema, tuple) or isinstance(tblschema, list):
@@ -71,7 +81,10 @@ class SchemaTable(object):
             elif col == '_fkey':
                 self.fkeys.append(spec)
             elif col == '_index':
-                self.index = spec
+                if isinstance(spec[-1], dict):
+                    self.indexes.append((spec[:-1], spec[-1]))
+                else:
+                    self.indexes.append((spec, {}))
             elif col == '_location':
                 if len(spec) <= 1:
                     prefix = ''
@@ -115,8 +128,15 @@ class SchemaTable(object):
             colstrs.append('PRIMARY KEY (%s)' % ', '.join(self.key))
         sql += ',\n  '.join(colstrs)
         sql += '\n);\n'
-        if self.index is not None:
-            sql += 'CREATE INDEX %s_%s_index on %s (%s);\n' % (self.name, '_'.join(self.index), self.name, ','.join(self.index))
+        for columns, options in self.indexes:
+            collate = options.get('collate')
+            if collate:
+                name = '%s_%s_%s_index' % (self.name, '_'.join(columns), collate.lower())
+                columns = [c + ' COLLATE ' + collate for c in columns]
+            else:
+                name = '%s_%s_index' % (self.name, '_'.join(columns))
+            sql += 'CREATE %sINDEX %s on %s (%s);\n' % ('UNIQUE ' if options.get('unique') else '',
+                                                       options.get('name', name), self.name, ','.join(columns))
         if self.needFileKey is True:
             has_extents = 'extent_start' in [x[0] for x in self.columns]
             sql += ('CREATE UNIQUE INDEX %s_file_index on %s (file_id, file_line, file_col%s);' %
@@ -138,3 +158,18 @@ class SchemaTable(object):
         return ('INSERT OR IGNORE INTO %s (%s) VALUES (%s)' %
                         (self.name, ','.join(args.keys()), ','.join('?' for k in range(0, len(args)))),
                         args.values())
+
+    def get_insert_row(self, args):
+        """ Returns the SQL to insert a row into this table and the row's
+            values, taken from the args dictionary.
+
+            Unlike get_insert_sql, the SQL names every column, leaving those
+            not in args NULL, so it's the same for every row of the table. It
+            can thus be prepared once and run for many rows with executemany.
+            Keys of args which aren't columns are ignored. """
+        if self._insert_sql is None:
+            self._column_names = [col[0] for col in self.columns]
+            self._insert_sql = ('INSERT OR IGNORE INTO %s (%s) VALUES (%s)' %
+                                (self.name, ','.join(self._column_names),
+                                 ','.join('?' for c in self._column_names)))
+        return self._insert_sql, tuple(map(args.get, self._column_names))
@@ -6,7 +6,27 @@ $(function() {
     // Get the file content container
     var fileContainer = $('#file'),
         queryField = $('#query'),
-        contentContainer = $('#content');
+        contentContainer = $('#content'),
+        menus;  // The page's context menus, read on first use
+
+    /**
+     * Return the menu items of a symbol node. Each distinct menu is stored
+     * once per page, in the data-menus attribute of the file container, and
+     * nodes refer to theirs by index. Nodes can also carry a whole menu in
+     * their data-menu attribute.
+     *
+     * @param Object node The symbol node.
+     */
+    function menuOf(node) {
+        var id = node.data('menu-id');
+        if (id === undefined) {
+            return node.data('menu');
+        }
+        if (menus === undefined) {
+            menus = fileContainer.data('menus');
+        }
+        return menus[id];
+    }
 
     /**
      * Highlight, or remove highlighting from, all symbols with the same class
@@ -145,8 +165,7 @@ $(function() {
             if (currentNode.length) {
                 toggleSymbolHighlights(currentNode);
 
-                var currentNodeData = currentNode.data('menu');
-                menuItems = menuItems.concat(currentNodeData);
+                menuItems = menuItems.concat(menuOf(currentNode));
             }
 
             contextMenu.menuItems = menuItems;
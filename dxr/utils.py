@@ -9,12 +9,14 @@ import ctypes
 # is fine.
 ctypes.CDLL('libtrilite.so').load_trilite_extension()
 
+from hashlib import sha1
 import os
 from os import dup
 from os.path import join
 import jinja2
 import sqlite3
 import string
+from struct import unpack
 from sys import stdout
 from urllib import quote, quote_plus
 
@@ -22,10 +24,11 @@ from urllib import quote, quote_plus
 TEMPLATE_DIR = 'static/templates'
 
 
-def connect_database(tree):
+def connect_database(tree, check_same_thread=True):
     """Connect to database ensuring that dependencies are built first"""
     # Create connection
-    conn = sqlite3.connect(os.path.join(tree.target_folder, ".dxr-xref.sqlite"))
+    conn = sqlite3.connect(os.path.join(tree.target_folder, ".dxr-xref.sqlite"),
+                           check_same_thread=check_same_thread)
     # Configure connection
     conn.execute("PRAGMA synchronous=off")  # TODO Test performance without this
     conn.execute("PRAGMA page_size=32768")
@@ -67,6 +70,22 @@ def next_global_id():
     return n
 
 
+def stable_id(*parts):
+    """Return an ID derived from ``parts``, which are strings or numbers.
+    Unicode strings are hashed as UTF-8.
+
+    Unlike next_global_id, this needs no coordination: any process computing
+    the ID of a thing gets the same one, in this build or the next, as long as
+    what identifies the thing stays the same. IDs are positive and fit in a
+    SQLite INTEGER. Being 63-bit hashes, distinct things collide only with
+    negligible probability.
+
+    """
+    digest = sha1('\0'.join(p.encode('utf-8') if isinstance(p, unicode)
+                            else str(p) for p in parts)).digest()
+    return (unpack('>Q', digest[:8])[0] >> 1) or 1
+
+
 def open_log(config_or_tree, name, use_stdout=False):
     """Return a writable file-like object representing a log file.
 
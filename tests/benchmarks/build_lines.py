@@ -0,0 +1,83 @@
+#!/usr/bin/env python2
+"""Compare the time and memory ``build_lines()`` and ``build_lines_compact()``
+take to decorate a big synthetic source file.
+
+Usage: build_lines.py [number of lines]
+
+Each engine runs in its own process, so its peak RSS can be told apart.
+
+"""
+from multiprocessing import Process, Queue
+from random import Random
+import resource
+import sys
+from time import time
+import warnings
+
+from dxr.build import build_lines, build_lines_compact
+
+
+class Htmlifier(object):
+    """Lots of regions and refs, some nested, some overlapping"""
+
+    def __init__(self, text):
+        random = Random(42)
+        self._regions, self._refs = [], []
+        offset = 0
+        for line in text.splitlines(True):
+            for start in xrange(offset, offset + len(line) - 8, 8):
+                self._regions.append((start, start + random.randint(2, 6),
+                                      random.choice(['k', 'str', 'c'])))
+                if random.random() < 0.5:
+                    self._refs.append((start + 1,
+                                       start + random.randint(3, 40),
+                                       ({}, 'qual%s' % start, None)))
+            offset += len(line)
+
+    def regions(self):
+        return self._regions
+
+    def refs(self):
+        return self._refs
+
+
+def synthetic_source(lines):
+    return ''.join('    int variable_%s = function_%s(argument, %s);\n' %
+                   (i, i % 97, i) for i in xrange(lines))
+
+
+def run(engine, text, results):
+    warnings.simplefilter('ignore')  # The refs overlap on purpose.
+    htmlifier = Htmlifier(text)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time()
+    for line in engine(text, [htmlifier]):
+        pass
+    results.put((time() - start,
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline))
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    text = synthetic_source(lines)
+    print '%s lines, %s bytes' % (lines, len(text))
+
+    # Make sure the engines agree before timing them:
+    small = synthetic_source(2000)
+    if (list(build_lines(small, [Htmlifier(small)])) !=
+        list(build_lines_compact(small, [Htmlifier(small)]))):
+        print >> sys.stderr, 'The engines disagree!'
+        sys.exit(1)
+
+    for engine in [build_lines, build_lines_compact]:
+        results = Queue()
+        process = Process(target=run, args=(engine, text, results))
+        process.start()
+        seconds, rss = results.get()
+        process.join()
+        print '%-20s %6.2fs  %7d KiB more peak RSS' % (engine.__name__,
+                                                      seconds, rss)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python2
+"""Time the clang plugin's ``generate_inheritance()`` on a big synthetic class
+hierarchy.
+
+Usage: inheritance.py [number of types]
+
+The hierarchy is COM-like: every type derives from a common root, and most
+also from one or two other types defined before it, some levels deep.
+
+"""
+import imp
+from os.path import dirname, join
+from random import Random
+import sqlite3
+import sys
+from time import time
+
+import dxr.plugins  # Plugins are loaded as submodules of it.
+from dxr.languages import language_schema
+
+
+def load_clang_indexer():
+    folder = join(dirname(dirname(dirname(__file__))), 'dxr', 'plugins',
+                  'clang')
+    f, path, description = imp.find_module('indexer', [folder])
+    try:
+        return imp.load_module('dxr.plugins.clang_indexer', f, path,
+                               description)
+    finally:
+        f.close()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    indexer = load_clang_indexer()
+    random = Random(42)
+
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(language_schema.get_create_sql())
+    conn.executescript(indexer.schema.get_create_sql())
+    conn.execute("INSERT INTO files (id, path, icon, encoding, blob_id) "
+                 "VALUES (1, 'main.cpp', 'cpp', 'utf-8', 1)")
+    conn.executemany("INSERT INTO types (id, name, qualname, file_id, "
+                     "file_line, file_col) VALUES (?, ?, ?, 1, ?, 1)",
+                     ((i, 'T%s' % i, 'T%s' % i, i) for i in xrange(count)))
+
+    def loc(i):
+        return 'main.cpp:%s:1' % i
+
+    for child in xrange(1, count):
+        # Bases come from a window behind the child, so the hierarchy is a
+        # few dozen levels deep rather than a single long chain.
+        bases = set([0] + [random.randint(max(1, child - 5000), child - 1)
+                           for _ in xrange(random.randint(0, 2))
+                           if child > 1])
+        for base in bases:
+            indexer.inheritance['T%s' % base, loc(base),
+                                'T%s' % child, loc(child)] = {
+                'tbname': 'T%s' % base, 'tbloc': loc(base),
+                'tcname': 'T%s' % child, 'tcloc': loc(child),
+                'access': 'public'}
+    print '%s types, %s direct relations' % (count, len(indexer.inheritance))
+
+    start = time()
+    indexer.generate_inheritance(conn)
+    print '%.2fs, %s impl rows' % (
+        time() - start, conn.execute('SELECT count(*) FROM impl').fetchone()[0])
+
+
+if __name__ == '__main__':
+    main()
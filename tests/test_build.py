@@ -5,12 +5,16 @@ from unittest import TestCase
 import warnings
 from warnings import catch_warnings
 
-from nose.tools import eq_
+from jinja2 import Markup
+from nose.tools import eq_, ok_
+from ordereddict import OrderedDict
 
+import dxr.build
 from dxr.build import (line_boundaries, remove_overlapping_refs, Region, LINE,
-                       Ref, balanced_tags, build_lines, tag_boundaries,
+                       Ref, balanced_tags, build_lines, build_lines_compact,
+                       tag_boundaries,
                        html_lines, nesting_order, balanced_tags_with_empties,
-                       lines_and_annotations)
+                       lines_and_annotations, MenuTable, SpooledLines)
 
 
 def test_line_boundaries():
@@ -308,6 +312,23 @@ class IntegrationTests(TestCase):
                                            refs=[(0, 9, ({}, '', None))])])),
             u'<a data-menu="{}"><span class="k">this</span> that</a>')
 
+    def test_menu_table(self):
+        """Refs with the same menu should refer to a single copy of it in the
+        MenuTable."""
+        menus = MenuTable()
+        eq_(''.join(build_lines('this that',
+                                [Htmlifier(refs=[(0, 4, ([{'a': 1}], '', None)),
+                                                 (5, 9, ([{'a': 1}], '', None))])],
+                                menus=menus)),
+            u'<a data-menu-id="0">this</a> <a data-menu-id="0">that</a>')
+        eq_(menus.__html__(), '[[{&quot;a&quot;: 1}]]')
+
+    def test_menu_table_key_order(self):
+        """Menus should be the same whatever order their keys are in."""
+        menus = MenuTable()
+        eq_(menus.id([OrderedDict([('a', 1), ('b', 2)])]),
+            menus.id([OrderedDict([('b', 2), ('a', 1)])]))
+
     def test_split_anchor_across_lines(self):
         """Support unavoidable splits of an anchor across lines."""
         eq_(list(build_lines('this\nthat',
@@ -336,3 +357,68 @@ class IntegrationTests(TestCase):
         """
         list(build_lines('hello!',
                          [Htmlifier(regions=[(3, 3, 'a'), (3, 5, 'b')])]))
+
+
+class CompactTagsTests(TestCase):
+    """Tests for ``build_lines_compact()``, which should yield just what
+    ``build_lines()`` does"""
+
+    def _eq_build_lines(self, text, htmlifier):
+        eq_(list(build_lines_compact(text, [htmlifier])),
+            list(build_lines(text, [htmlifier])))
+
+    def test_horrors(self):
+        """Untangle interleaved and coincident tags the same way."""
+        self._eq_build_lines('this&that',
+                             Htmlifier(regions=[(0, 9, 'a'), (1, 8, 'b'),
+                                                (4, 7, 'c'), (3, 4, 'd'),
+                                                (3, 5, 'e'), (0, 4, 'm'),
+                                                (5, 9, 'n')]))
+
+    def test_refs_across_lines(self):
+        """Nest refs and regions, split them across lines, and drop
+        overlapping refs the same way."""
+        with catch_warnings():
+            warnings.simplefilter('ignore')
+            self._eq_build_lines('this\nthat\nother',
+                                 Htmlifier(regions=[(0, 4, 'k'), (5, 9, 'k'),
+                                                    (3, 12, 'x')],
+                                           refs=[(0, 9, ({}, '', None)),
+                                                 (2, 14, ({}, 'a', None)),
+                                                 (10, 15, ({}, 'b', '3'))]))
+
+    def test_empty(self):
+        """Cope with files without any tags or text."""
+        self._eq_build_lines('', Htmlifier())
+        self._eq_build_lines('hello\n', Htmlifier())
+
+
+class SpooledLinesTests(TestCase):
+    """Tests for replaying rendered lines from a spool"""
+
+    def _eq_replayed(self, size):
+        """Make sure every pass through SpooledLines yields the lines, and
+        return whether they outgrew memory."""
+        lines = [(Markup(u'<b>line</b> %s \xe9' % i + 'x' * 50),
+                  [{'title': 'note %s' % i}] if i % 3 else [])
+                 for i in range(100)]
+        old_size = dxr.build._LINE_SPOOL_SIZE
+        dxr.build._LINE_SPOOL_SIZE = size
+        try:
+            spooled = SpooledLines(iter(lines))
+        finally:
+            dxr.build._LINE_SPOOL_SIZE = old_size
+        try:
+            for _ in range(3):
+                replayed = list(spooled)
+                eq_(replayed, lines)
+                ok_(all(isinstance(line, Markup) for line, _ in replayed))
+            return spooled._spool._rolled
+        finally:
+            spooled.close()
+
+    def test_in_memory(self):
+        eq_(self._eq_replayed(1 << 20), False)
+
+    def test_on_disk(self):
+        eq_(self._eq_replayed(1000), True)
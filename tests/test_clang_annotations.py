@@ -0,0 +1,592 @@
+"""Tests for what the clang plugin's materialize_annotations() stores and its
+htmlifier shows, and for how its indexer treats its output"""
+
+from hashlib import sha1
+import imp
+import marshal
+import os
+from os.path import dirname, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from nose.tools import eq_, ok_
+
+import dxr
+from dxr.languages import language_schema
+from dxr.query import filters
+import dxr.utils  # Load trilite before sqlite3.
+from dxr.utils import stable_id
+import sqlite3
+
+
+def load_clang(kind):
+    """Load the clang plugin's indexer or htmlifier module as DXR does."""
+    folder = join(dirname(dxr.__file__), 'plugins', 'clang')
+    file, path, description = imp.find_module(kind, [folder])
+    try:
+        return imp.load_module('dxr.plugins.clang_' + kind, file, path,
+                               description)
+    finally:
+        file.close()
+
+
+class Config(object):
+    wwwroot = '/dxr'
+
+
+class Tree(object):
+    name = 'code'
+    config = Config()
+
+
+class AnnotationTests(TestCase):
+    """Check the htmlifier's output, built from materialized annotations,
+    against what it showed when it queried the symbol tables per file"""
+
+    def setUp(self):
+        indexer = load_clang('indexer')
+        self.htmlifier = load_clang('htmlifier')
+        self.conn = conn = sqlite3.connect(':memory:')
+        conn.executescript(language_schema.get_create_sql())
+        conn.executescript(indexer.schema.get_create_sql())
+
+        def insert(table, **row):
+            conn.execute('INSERT INTO %s (%s) VALUES (%s)' %
+                         (table, ', '.join(row), ', '.join('?' * len(row))),
+                         row.values())
+
+        insert('files', id=1, path='main.cpp', icon='cpp', encoding='utf-8',
+               blob_id=1)
+        insert('files', id=2, path='foo.h', icon='h', encoding='utf-8',
+               blob_id=2)
+        insert('files', id=3, path='other.c', icon='c', encoding='utf-8',
+               blob_id=3)
+        # foo.h:
+        insert('macros', id=20, name='MAX', text='10', file_id=2,
+               file_line=1, file_col=9, extent_start=8, extent_end=11)
+        insert('types', id=21, name='Foo', qualname='ns::Foo', kind='class',
+               file_id=2, file_line=3, file_col=7, extent_start=30,
+               extent_end=33)
+        insert('functions', id=22, scopeid=21, name='bar',
+               qualname='ns::Foo::bar()', args='()', type='void',
+               file_id=2, file_line=4, file_col=10, extent_start=45,
+               extent_end=48)
+        insert('targets', targetid=-22, funcid=22)
+        insert('variables', id=23, scopeid=21, name='count',
+               qualname='ns::Foo::count', value='3', type='int',
+               file_id=2, file_line=5, file_col=7, extent_start=60,
+               extent_end=65)
+        insert('typedefs', id=24, name='FooPtr', qualname='ns::FooPtr',
+               file_id=2, file_line=7, file_col=14, extent_start=80,
+               extent_end=86)
+        insert('warnings', msg='unused variable', opt='-Wunused',
+               file_id=2, file_line=5, file_col=7, extent_start=60,
+               extent_end=65)
+        # main.cpp:
+        insert('includes', file_id=1, extent_start=10, extent_end=17,
+               target_id=2)
+        insert('namespaces', id=25, name='ns', qualname='ns', file_id=1,
+               file_line=3, file_col=11, extent_start=30, extent_end=32)
+        insert('namespace_aliases', id=26, name='n', qualname='n',
+               file_id=1, file_line=4, file_col=11, extent_start=45,
+               extent_end=46)
+        insert('functions', id=27, name='main', qualname='main()',
+               args='()', type='int', file_id=1, file_line=6, file_col=5,
+               extent_start=60, extent_end=64)
+        insert('function_decldef', defid=22, file_id=1, file_line=8,
+               file_col=14, extent_start=80, extent_end=83)
+        insert('type_refs', refid=21, file_id=1, file_line=9, file_col=5,
+               extent_start=90, extent_end=93)
+        insert('typedef_refs', refid=24, file_id=1, file_line=9, file_col=9,
+               extent_start=94, extent_end=100)
+        insert('function_refs', refid=22, file_id=1, file_line=10,
+               file_col=9, extent_start=110, extent_end=113)
+        insert('variable_refs', refid=23, file_id=1, file_line=10,
+               file_col=20, extent_start=121, extent_end=126)
+        insert('namespace_refs', refid=25, file_id=1, file_line=11,
+               file_col=5, extent_start=130, extent_end=132)
+        insert('namespace_alias_refs', refid=26, file_id=1, file_line=11,
+               file_col=9, extent_start=134, extent_end=135)
+        insert('macro_refs', refid=20, file_id=1, file_line=12, file_col=12,
+               extent_start=150, extent_end=153)
+        insert('warnings', msg='unused result', file_id=1, file_line=10,
+               file_col=5, extent_start=106, extent_end=126)
+
+        indexer.materialize_annotations(conn, batch_size=1)
+        self.htmlifier.load(Tree(), conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _html(self, path):
+        """Return the refs, regions, annotations, and links of a file.
+
+        Refs are summarized as their extents, title, and value plus the label
+        and link of the first menu item, which is where the jump to a
+        definition goes.
+
+        """
+        html = self.htmlifier.htmlify(path, '')
+        return (sorted((start, end, title, value,
+                        menu[0]['html'], menu[0]['href'])
+                       for start, end, (menu, title, value) in html.refs()),
+                list(html.regions()),
+                list(html.annotations()),
+                list(html.links()))
+
+    def test_definitions(self):
+        """A file defining things should get refs, warnings, and links to
+        its types' members and its macros."""
+        refs, regions, annotations, links = self._html('foo.h')
+        eq_(refs, [
+            (8, 11, 'MAX', '10', 'Find references',
+             '/dxr/code/search?q=%2Bmacro-ref%3AMAX'),
+            (30, 33, 'ns::Foo', None, 'Find declarations',
+             '/dxr/code/search?q=%2Btype-decl%3Ans%3A%3AFoo'),
+            (45, 48, 'ns::Foo::bar()', None, 'Find declarations',
+             '/dxr/code/search?q=%2Bfunction-decl%3Ans%3A%3AFoo%3A%3Abar%28%29'),
+            (60, 65, 'ns::Foo::count', '3', 'Find declarations',
+             '/dxr/code/search?q=%2Bvar-decl%3Ans%3A%3AFoo%3A%3Acount'),
+            (80, 86, 'ns::FooPtr', None, 'Find references',
+             '/dxr/code/search?q=%2Btype-ref%3Ans%3A%3AFooPtr')])
+        eq_(regions, [])
+        eq_(annotations, [
+            (5, {'title': 'unused variable [-Wunused]',
+                 'class': 'note note-warning',
+                 'style': "background-image: "
+                          "url('/dxr/static/icons/warning.png');"})])
+        eq_(links, [
+            (30, 'Foo', [('class', 'Foo', '#3'),
+                         ('method', 'bar', '#4'),
+                         ('field', 'count', '#5')]),
+            (100, 'Macros', [('macro', 'MAX', '#1')])])
+
+    def test_references(self):
+        """References should jump to what they refer to, except for those to
+        namespaces, and #includes to the files included."""
+        refs, regions, annotations, links = self._html('main.cpp')
+        eq_(refs, [
+            (10, 17, '', None, 'Jump to file', '/dxr/code/source/foo.h'),
+            (30, 32, 'ns', None, 'Find definitions',
+             '/dxr/code/search?q=%2Bnamespace%3Ans'),
+            (45, 46, 'n', None, 'Find references',
+             '/dxr/code/search?q=%2Bnamespace-alias-ref%3An'),
+            (60, 64, 'main()', None, 'Find declarations',
+             '/dxr/code/search?q=%2Bfunction-decl%3Amain%28%29'),
+            (80, 83, 'ns::Foo::bar()', None, 'Jump to definition',
+             '/dxr/code/source/foo.h#4'),
+            (90, 93, 'ns::Foo', None, 'Jump to definition',
+             '/dxr/code/source/foo.h#3'),
+            (94, 100, 'ns::FooPtr', None, 'Jump to definition',
+             '/dxr/code/source/foo.h#7'),
+            (110, 113, 'ns::Foo::bar()', None, 'Jump to definition',
+             '/dxr/code/source/foo.h#4'),
+            (121, 126, 'ns::Foo::count', '3', 'Jump to definition',
+             '/dxr/code/source/foo.h#5'),
+            (130, 132, 'ns', None, 'Find definitions',
+             '/dxr/code/search?q=%2Bnamespace%3Ans'),
+            (134, 135, 'n', None, 'Jump to definition',
+             '/dxr/code/source/main.cpp#4'),
+            (150, 153, 'MAX', '10', 'Jump to definition',
+             '/dxr/code/source/foo.h#1')])
+        eq_([line for line, annotation in annotations], [10])
+        eq_(links, [])
+
+    def test_virtual(self):
+        """Only menus of virtual functions should offer overrides."""
+        def labels(path):
+            return dict((title, [item['html'] for item in menu])
+                        for start, end, (menu, title, value)
+                        in self.htmlifier.htmlify(path, '').refs())
+        ok_('Find overrides' in labels('foo.h')['ns::Foo::bar()'])
+        ok_('Find overrides' not in labels('main.cpp')['main()'])
+
+    def test_unannotated(self):
+        """Files without annotations should still get an htmlifier, but
+        files the tree doesn't know of shouldn't."""
+        refs, regions, annotations, links = self._html('other.c')
+        eq_((refs, regions, annotations, links), ([], [], [], []))
+        eq_(self.htmlifier.htmlify('missing.c', ''), None)
+
+
+class SupersededOutputTests(TestCase):
+    """Tests for which output of previous builds drop_superseded_output()
+    keeps"""
+
+    def setUp(self):
+        self.indexer = load_clang('indexer')
+        self.folder = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def _write(self, name, mtime):
+        path = join(self.folder, name)
+        open(path, 'w').close()
+        os.utime(path, (mtime, mtime))
+
+    def _kept(self):
+        return sorted(os.path.basename(path) for path in
+                      self.indexer.drop_superseded_output(self.folder))
+
+    def test_incremental(self):
+        """Old output about files the build wrote about again should go, but
+        old output about other files should stay."""
+        self._write('main.1.csv', 100)   # Rewritten
+        self._write('main.2.csv', 200)
+        self._write('util.1.csv', 100)   # Touched, since unchanged
+        self._write('util.2.csv', 100)   # Superseded
+        self._write('util.3.csv', 250)
+        self._write('other.1.csv', 100)  # Not recompiled
+        self._write(self.indexer._BUILD_STAMP, 200)
+        eq_(self._kept(), ['main.2.csv', 'other.1.csv', 'util.3.csv'])
+        eq_(sorted(os.listdir(self.folder)),
+            ['main.2.csv', 'other.1.csv', 'util.3.csv'])
+
+    def test_full(self):
+        """Without a build stamp, all output should be kept."""
+        self._write('main.1.csv', 100)
+        self._write('main.2.csv', 200)
+        eq_(self._kept(), ['main.1.csv', 'main.2.csv'])
+
+
+class IndexerOutputTests(TestCase):
+    """Tests for parsing and deduplicating the compiler plugin's CSVs"""
+
+    def setUp(self):
+        self.indexer = load_clang('indexer')
+        self.folder = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def _csvs(self, *contents):
+        paths = []
+        for i, text in enumerate(contents):
+            paths.append(join(self.folder, '%s.csv' % i))
+            with open(paths[-1], 'w') as file:
+                file.write(text)
+        return paths
+
+    def _distinct(self, paths, nb_jobs=1, **kwargs):
+        spool = self.indexer.spool_indexer_output(paths, nb_jobs)
+        try:
+            return list(self.indexer.distinct_indexer_output(spool, **kwargs))
+        finally:
+            spool.close()
+
+    def test_parse(self):
+        """Parsing should drop repeated lines and keep each digest with its
+        line."""
+        [path] = self._csvs('a,1\nb,2\na,1\n')
+        digests, lines = self.indexer.parse_indexer_output(path)
+        eq_(marshal.loads(lines), [['a', '1'], ['b', '2']])
+        eq_(digests, sha1('a\x001').digest() + sha1('b\x002').digest())
+
+    def test_across_files(self):
+        """Lines repeated in other files should come out once, in order."""
+        paths = self._csvs('a,1\nb,2\n', 'b,2\nc,3\n', 'a,1\n')
+        eq_(self._distinct(paths),
+            [['a', '1'], ['b', '2'], ['c', '3']])
+
+    def test_workers(self):
+        """Parsing in worker processes should give the same lines."""
+        paths = self._csvs(*['x,%s\ny,%s\n' % (i % 3, i) for i in range(7)])
+        eq_(self._distinct(paths, nb_jobs=2), self._distinct(paths))
+
+    def test_memory(self):
+        """Only about ``memory`` digests should be remembered: once that many
+        are seen, the older ones are forgotten."""
+        paths = self._csvs('a\nb\n', 'c\n', 'a\n', 'd\n', 'a\n')
+        eq_(self._distinct(paths, memory=2),
+            [['a'], ['b'], ['c'], ['d'], ['a']])
+
+
+class ResolutionTests(TestCase):
+    """Tests for resolving definitions and references by location"""
+
+    def setUp(self):
+        self.indexer = load_clang('indexer')
+        self.conn = conn = sqlite3.connect(':memory:')
+        conn.executescript(language_schema.get_create_sql())
+        conn.executescript(self.indexer.schema.get_create_sql())
+        self.indexer.create_resolution_indexes(conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _insert(self, table, columns, rows):
+        self.conn.executemany('INSERT INTO %s (%s) VALUES (%s)' %
+                              (table, ', '.join(columns),
+                               ', '.join('?' * len(columns))),
+                              rows)
+
+    def _refids(self):
+        return self.conn.execute('SELECT extent_start, refid FROM type_refs '
+                                 'ORDER BY extent_start').fetchall()
+
+    def test_indexes(self):
+        """Only targets whose column isn't the rowid should get indexes."""
+        eq_(sorted(name for name, in self.conn.execute(
+                "SELECT name FROM sqlite_master "
+                "WHERE name LIKE '%resolution_index'")),
+            ['function_decldef_resolution_index',
+             'type_decldef_resolution_index',
+             'variable_decldef_resolution_index'])
+
+    def test_decldefs(self):
+        """Ties should go to the lowest value, NULLs shouldn't hide known
+        values, and rows already resolved should be left alone."""
+        self._insert('type_decldef',
+                     ['defid', 'file_id', 'file_line', 'file_col',
+                      'extent_start', 'extent_end'],
+                     [(30, 1, 5, 1, 0, 1),   # Tied
+                      (20, 1, 5, 1, 2, 3),
+                      (None, 1, 6, 1, 0, 1),  # Unknown
+                      (40, 1, 6, 1, 2, 3)])
+        self._insert('type_refs',
+                     ['refid', 'file_id', 'file_line', 'file_col',
+                      'extent_start', 'extent_end', 'referenced_file_id',
+                      'referenced_file_line', 'referenced_file_col'],
+                     [(None, 2, 1, 1, 10, 11, 1, 5, 1),
+                      (None, 2, 2, 1, 20, 21, 1, 6, 1),
+                      (99, 2, 3, 1, 30, 31, 1, 5, 1),   # Resolved
+                      (None, 2, 4, 1, 40, 41, 1, 7, 1)])  # Nothing there
+        self.indexer.resolve(self.conn, 'type_refs', 'refid',
+                             'type_decldef', 'defid', 'referenced')
+        eq_(self._refids(), [(10, 20), (20, 40), (30, 99), (40, None)])
+
+    def test_update_refs(self):
+        """References to declarations should resolve to their definitions,
+        and others to what's at the location they refer to, through the
+        rowid."""
+        self._insert('types',
+                     ['id', 'name', 'qualname', 'file_id', 'file_line',
+                      'file_col'],
+                     [(7, 'Foo', 'Foo', 1, 3, 7)])
+        self._insert('type_decldef',
+                     ['defid', 'file_id', 'file_line', 'file_col',
+                      'extent_start', 'extent_end'],
+                     [(7, 1, 9, 7, 0, 1)])
+        self._insert('type_refs',
+                     ['file_id', 'file_line', 'file_col', 'extent_start',
+                      'extent_end', 'referenced_file_id',
+                      'referenced_file_line', 'referenced_file_col'],
+                     [(2, 1, 1, 10, 11, 1, 3, 7),
+                      (2, 2, 1, 20, 21, 1, 9, 7),
+                      (2, 3, 1, 30, 31, 1, 4, 7)])
+        self.indexer.update_refs(self.conn)
+        eq_(self._refids(), [(10, 7), (20, 7), (30, None)])
+
+
+class BatchInserterTests(TestCase):
+    """Tests for inserting the rows of the compiler plugin's output in
+    batches"""
+
+    def setUp(self):
+        self.indexer = load_clang('indexer')
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.executescript(self.indexer.schema.get_create_sql())
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _count(self):
+        return self.conn.execute('SELECT count(*) FROM macros').fetchone()[0]
+
+    def _macro(self, id):
+        return self.indexer.schema.get_insert_row(
+            'macros', {'id': id, 'name': 'M%s' % id, 'text': str(id),
+                       'file_id': 1, 'file_line': id, 'file_col': 9,
+                       'extent_start': id * 10, 'extent_end': id * 10 + 2,
+                       'unknown': 'ignored'})
+
+    def test_flushing(self):
+        """Rows should go in once a batch fills up, and on flush()."""
+        inserter = self.indexer._BatchInserter(self.conn, batch_size=3)
+        inserter.add(*self._macro(1))
+        inserter.add(*self._macro(2))
+        eq_(self._count(), 0)
+        inserter.add(*self._macro(3))
+        eq_(self._count(), 3)
+        inserter.add(*self._macro(4))
+        eq_(self._count(), 3)
+        inserter.flush()
+        eq_(self._count(), 4)
+
+    def test_columns(self):
+        """The values of a row should line up with the columns its SQL names,
+        whatever order the args are in."""
+        sql, row = self._macro(5)
+        inserter = self.indexer._BatchInserter(self.conn)
+        inserter.add(sql, row)
+        inserter.flush()
+        eq_(self.conn.execute(
+                'SELECT id, name, text, file_id, file_line, file_col, '
+                'extent_start, extent_end FROM macros').fetchall(),
+            [(5, 'M5', '5', 1, 5, 9, 50, 52)])
+        eq_(self.indexer.schema.get_insert_row('macros', {'name': 'N'}),
+            (sql, tuple('N' if value == 'M5' else None for value in row)))
+
+
+class ScopeTests(TestCase):
+    """Tests for finding the scopes of things as the compiler plugin's output
+    is ingested"""
+
+    def setUp(self):
+        self.indexer = load_clang('indexer')
+        self.conn = conn = sqlite3.connect(':memory:')
+        conn.executescript(language_schema.get_create_sql())
+        conn.executescript(self.indexer.schema.get_create_sql())
+        conn.execute("INSERT INTO files (id, path, icon, encoding, blob_id) "
+                     "VALUES (1, 'main.cpp', 'cpp', 'utf-8', 1)")
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _ingest(self, lines):
+        """Ingest CSV lines as post_process does, up to fixing up scopes."""
+        inserter = self.indexer._BatchInserter(self.conn)
+        self.indexer.load_scopes(self.conn)
+        self.indexer.dump_indexer_output(self.conn, lines, inserter)
+        inserter.flush()
+        self.indexer.write_scopes(self.conn)
+        self.indexer.fixup_scope(self.conn)
+
+    def _variable(self, name, line):
+        return ['variable', 'name', name, 'qualname', 'bar::' + name,
+                'loc', 'main.cpp:%s:9' % line, 'type', 'int',
+                'extent', '%s:%s' % (line * 10, line * 10 + 1),
+                'scopename', 'bar', 'scopeloc', 'main.cpp:2:6']
+
+    def _scopeids(self, table):
+        return dict(self.conn.execute('SELECT name, scopeid FROM %s' % table))
+
+    def test_scopes(self):
+        """A scope should get the same ID whether it's seen before the row of
+        the function opening it, after it, or in a later round of
+        ingestion, and only one row."""
+        bar = stable_id('scope', 'main.cpp', 2, 6)
+        self._ingest([
+            self._variable('x', 3),
+            ['function', 'name', 'bar', 'qualname', 'bar()',
+             'loc', 'main.cpp:2:6', 'args', '()', 'type', 'void',
+             'extent', '20:23'],
+            self._variable('y', 4)])
+        self._ingest([self._variable('z', 5)])
+        eq_(self.conn.execute('SELECT id, name, file_line, file_col '
+                              'FROM scopes').fetchall(),
+            [(bar, 'bar', 2, 6)])
+        eq_(self.conn.execute('SELECT id FROM functions').fetchall(),
+            [(bar,)])
+        eq_(self._scopeids('variables'), {'x': bar, 'y': bar, 'z': bar})
+        # fixup_scope() gives things without a scope the one at their
+        # location, as it did when it looked them up one by one:
+        eq_(self._scopeids('functions'), {'bar': bar})
+
+
+class CallgraphTests(TestCase):
+    """Tests for the callers and targets tables generate_callgraph() makes,
+    as the search filters read them"""
+
+    def setUp(self):
+        self.indexer = load_clang('indexer')
+        self.conn = conn = sqlite3.connect(':memory:')
+        conn.executescript(language_schema.get_create_sql())
+        conn.executescript(self.indexer.schema.get_create_sql())
+        conn.execute("INSERT INTO files (id, path, icon, encoding, blob_id) "
+                     "VALUES (1, 'main.cpp', 'cpp', 'utf-8', 1)")
+
+        def function(qualname, line, col, *overridden):
+            extra = (['overridename', overridden[0],
+                      'overrideloc', 'main.cpp:%s:%s' % overridden[1:]]
+                     if overridden else [])
+            return ['function', 'name', qualname, 'qualname', qualname,
+                    'loc', 'main.cpp:%s:%s' % (line, col), 'args', '()',
+                    'type', 'void', 'extent', '%s:%s' % (line * 10,
+                                                         line * 10 + 1)
+                   ] + extra
+
+        def call(caller, callee, calltype):
+            return (['call'] +
+                    (['callername', caller[0],
+                      'callerloc', 'main.cpp:%s:%s' % caller[1:]]
+                     if caller else []) +
+                    ['calleename', callee[0],
+                     'calleeloc', 'main.cpp:%s:%s' % callee[1:],
+                     'calltype', calltype])
+
+        a, b, c = ('A::f()', 2, 18), ('B::f()', 4, 18), ('C::f()', 6, 18)
+        helper, main = ('helper()', 8, 5), ('main()', 10, 5)
+        use = ('use()', 14, 5)
+        self.indexer.load_scopes(conn)
+        inserter = self.indexer._BatchInserter(conn)
+        self.indexer.dump_indexer_output(conn, [
+            function(*a),
+            function(*(b + a)),  # B::f overrides A::f,
+            function(*(c + b)),  # which C::f overrides.
+            function(*helper),
+            function(*main),
+            function(*use),
+            call(main, a, 'virtual'),
+            call(main, helper, 'static'),
+            call(use, b, 'virtual'),
+            call(use, c, 'virtual'),
+            call(None, helper, 'static')], inserter)
+        inserter.flush()
+        self.indexer.generate_callgraph(conn)
+        self.ids = dict(conn.execute('SELECT qualname, id FROM functions'))
+        self.names = dict(conn.execute('SELECT extent_start, qualname '
+                                       'FROM functions'))
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _rows(self, table, columns):
+        names = dict((id, name) for name, id in self.ids.iteritems())
+        names.update((-id, '-' + name) for name, id in self.ids.iteritems())
+        names[0] = None
+        return sorted(tuple(names[id] for id in row) for row in
+                      self.conn.execute('SELECT %s FROM %s' %
+                                        (columns, table)))
+
+    def _found(self, param, qualname):
+        """Return what the filters named ``param`` find in main.cpp for a
+        qualified name."""
+        found = set()
+        for f in filters:
+            for f in getattr(f, 'filters', [f]):
+                if getattr(f, 'param', None) == param:
+                    found.update(self.names[start] for start, end in
+                                 self.conn.execute(f.ext_sql % f.qual_expr,
+                                                   [1, qualname]))
+        return sorted(found)
+
+    def test_tables(self):
+        """Virtual calls should go to the negated ID of the function called,
+        which targets maps to it and everything overriding it."""
+        eq_(self._rows('callers', 'callerid, targetid'),
+            [(None, 'helper()'),
+             ('main()', '-A::f()'),
+             ('main()', 'helper()'),
+             ('use()', '-B::f()'),
+             ('use()', '-C::f()')])
+        eq_(self._rows('targets', 'targetid, funcid'),
+            [('-A::f()', 'A::f()'), ('-A::f()', 'B::f()'),
+             ('-A::f()', 'C::f()'),
+             ('-B::f()', 'B::f()'), ('-B::f()', 'C::f()'),
+             ('-C::f()', 'C::f()')])
+
+    def test_callers(self):
+        eq_(self._found('callers', 'A::f()'), ['main()'])
+        eq_(self._found('callers', 'C::f()'), ['main()', 'use()'])
+        eq_(self._found('callers', 'helper()'), ['main()'])
+        eq_(self._found('called-by', 'use()'), ['B::f()', 'C::f()'])
+
+    def test_overrides(self):
+        """The override filters should find the whole chain, through
+        targets.targetid = -base.id."""
+        eq_(self._found('overridden', 'C::f()'), ['A::f()', 'B::f()'])
+        eq_(self._found('overrides', 'A::f()'), ['B::f()', 'C::f()'])
+        eq_(self._found('overridden', 'A::f()'), [])
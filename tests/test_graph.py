@@ -0,0 +1,38 @@
+"""Tests for dxr.graph"""
+
+from unittest import TestCase
+
+from nose.tools import eq_
+
+from dxr.graph import descendants, strongly_connected_components
+
+
+class StronglyConnectedComponentsTests(TestCase):
+    def test_order(self):
+        """Components should come after those they reach."""
+        components = strongly_connected_components(
+            {1: [2], 2: [3, 1], 3: [4], 4: [5], 5: [4]})
+        eq_([sorted(c) for c in components], [[4, 5], [3], [1, 2]])
+
+    def test_deep(self):
+        """Graphs deeper than the recursion limit should be fine."""
+        graph = dict((i, [i + 1]) for i in xrange(10000))
+        eq_(len(strongly_connected_components(graph)), 10001)
+
+
+class DescendantsTests(TestCase):
+    def test_diamond(self):
+        """Nodes reachable along several paths should show up once."""
+        eq_(descendants({'a': ['b', 'c'], 'b': ['d'], 'c': ['d']}),
+            {'a': set(['b', 'c', 'd']),
+             'b': set(['d']),
+             'c': set(['d']),
+             'd': set()})
+
+    def test_cycles(self):
+        """Nodes on cycles, and only they, should be their own descendants."""
+        eq_(descendants({1: [2], 2: [1, 3], 4: [4]}),
+            {1: set([1, 2, 3]),
+             2: set([1, 2, 3]),
+             3: set(),
+             4: set([4])})
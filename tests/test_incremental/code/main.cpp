@@ -0,0 +1,5 @@
+#include "util.h"
+
+int main() {
+    return helper(1);
+}
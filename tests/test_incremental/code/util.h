@@ -0,0 +1 @@
+int helper(int x) { return x - 1; }
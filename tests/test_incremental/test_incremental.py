@@ -0,0 +1,80 @@
+"""Tests for updating a tree in place with the ``incremental`` option"""
+
+from os.path import exists, join
+
+from nose.tools import eq_, ok_
+
+from dxr.testing import DxrInstanceTestCase, run
+import dxr.utils  # Load trilite before sqlite3.
+import sqlite3
+
+
+class IncrementalTests(DxrInstanceTestCase):
+    """Build a tree, change a header and delete a folder, then build it again
+    incrementally, and check what the second build kept and replaced"""
+
+    @classmethod
+    def setup_class(cls):
+        super(IncrementalTests, cls).setup_class()
+        conn = cls._connect()
+        cls.old_files = dict(conn.execute("SELECT path, id FROM files"))
+        cls.old_blobs = dict(conn.execute("SELECT path, blob_id FROM files"))
+        conn.close()
+        run('make rebuild')
+
+    @classmethod
+    def _connect(cls):
+        return sqlite3.connect(join(cls._config_dir_path, 'target', 'trees',
+                                    'code', '.dxr-xref.sqlite'))
+
+    def setUp(self):
+        self.conn = self._connect()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _file_ids(self):
+        return dict(self.conn.execute("SELECT path, id FROM files"))
+
+    def test_unchanged_ids(self):
+        """Files which didn't change should keep their IDs."""
+        files = self._file_ids()
+        for path in ['main.cpp', 'makefile']:
+            eq_(files[path], self.old_files[path])
+
+    def test_changed_ids(self):
+        """Changed files should get IDs after all the old ones."""
+        ok_(self._file_ids()['util.h'] > max(self.old_files.itervalues()))
+
+    def test_orphaned_blobs(self):
+        """Contents no file has anymore should be deleted."""
+        blobs = set(id for id, in self.conn.execute("SELECT id FROM blobs"))
+        ok_(self.old_blobs['util.h'] not in blobs)
+        ok_(self.old_blobs['main.cpp'] in blobs)
+
+    def test_deleted_folder(self):
+        """Files in deleted folders should lose their rows and pages."""
+        ok_('gone/notes.txt' in self.old_files)
+        ok_('gone/notes.txt' not in self._file_ids())
+        ok_(not exists(join(self._config_dir_path, 'target', 'trees', 'code',
+                            'gone', 'notes.txt.html')))
+
+    def test_stale_clang_output(self):
+        """Output about unchanged files which were recompiled because a
+        header changed should replace what the first build wrote."""
+        eq_(self.conn.execute(
+                "SELECT functions.file_line FROM functions, files "
+                "WHERE functions.name = 'helper' "
+                "AND functions.file_id = files.id "
+                "AND files.path = 'util.h'").fetchall(),
+            [(2,)])
+        eq_(self.conn.execute(
+                "SELECT function_refs.referenced_file_line "
+                "FROM function_refs, files "
+                "WHERE function_refs.file_id = files.id "
+                "AND files.path = 'main.cpp'").fetchall(),
+            [(2,)])
+        eq_(self.conn.execute(
+                "SELECT count(*) FROM function_refs "
+                "WHERE refid IS NULL").fetchone()[0],
+            0)
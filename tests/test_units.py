@@ -1,10 +1,32 @@
 """Unit tests that don't fit anywhere else"""
 
+from gzip import GzipFile
+import imp
+from itertools import product
+from os import getpid, listdir, makedirs, remove, stat, symlink
+from os.path import dirname, isdir, join
+import re
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
 from unittest import TestCase
 
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
-from dxr.build import linked_pathname
+import dxr
+from dxr.app import make_app
+import dxr.build
+from dxr.render import PageCache
+from dxr.build import (linked_pathname, _html_batches, _ignore_matcher,
+                       _read_files, index_symbol_names, build_tree, _JobBudget,
+                       create_tables, index_files, run_html_workers,
+                       _walk_source, _DirEntry)
+from dxr.config import Config
+from dxr.languages import language_schema
+from dxr.query import filters, TriLiteSearchFilter, trigram_query
+import dxr.utils
+from dxr.utils import connect_database, stable_id
+import sqlite3  # after dxr.utils, so trilite's sqlite is the one loaded
 
 
 class LinkedPathnameTests(TestCase):
@@ -18,3 +40,649 @@ class LinkedPathnameTests(TestCase):
     def test_root_folder(self):
         """Make sure the root folder is treated correctly."""
         eq_(linked_pathname('', 'stuff'), [('/stuff/source', 'stuff')])
+
+
+class ReadTextFilesTests(TestCase):
+    """Tests for the function file-ingestion workers run"""
+
+    def setUp(self):
+        self.folder = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def _make_file(self, name, contents):
+        with open(join(self.folder, name), 'w') as file:
+            file.write(contents)
+
+    def test_binaries_not_indexed(self):
+        """Make sure text files come back with their hashes, icons, and
+        contents, in order, and binary ones with only their hashes."""
+        self._make_file('main.c', 'int main() {}\n')
+        self._make_file('a.out', 'ELF\0\0\0')
+        self._make_file('notes.txt', 'hi')
+        eq_(_read_files(self.folder, ['main.c', 'a.out', 'notes.txt']),
+            [('main.c',
+              '4f2310e53f6278e813db033183e3d08420721956',
+              'mimetypes/c',
+              'int main() {}\n'),
+             ('a.out', 'cc8d75cde73cc41927724851b18a589629b1b772', None, None),
+             ('notes.txt',
+              'c22b5f9178342609428d6f51b2c5af4c0bde6a42',
+              'mimetypes/txt',
+              'hi')])
+
+
+class IgnoreMatcherTests(TestCase):
+    """Tests for the compiled matcher of ignore_patterns and ignore_paths"""
+
+    def setUp(self):
+        self.is_ignored = _ignore_matcher(['.hg', '*.o'],
+                                          ['/obj/', '/docs/*.html'])
+
+    def test_patterns(self):
+        """Make sure patterns match names anywhere in the tree."""
+        assert self.is_ignored('.hg', '.hg', True)
+        assert self.is_ignored('main.o', 'src/main.o')
+        assert not self.is_ignored('main.c', 'src/main.c')
+
+    def test_paths(self):
+        """Make sure paths match from the root, and folder paths end in a
+        slash."""
+        assert self.is_ignored('obj', 'obj', True)
+        assert not self.is_ignored('obj', 'obj')
+        assert not self.is_ignored('obj', 'src/obj', True)
+        assert self.is_ignored('index.html', 'docs/index.html')
+
+    def test_nothing_ignored(self):
+        """Make sure empty lists of globs ignore nothing."""
+        assert not _ignore_matcher([], [])('main.c', 'main.c')
+
+
+class WalkSourceTests(TestCase):
+    """Tests for walking the source folder"""
+
+    def setUp(self):
+        self.folder = mkdtemp()
+        for path in ['main.c', 'README', 'out.o', 'build/main.c',
+                     '.hg/store', 'src/util.c', 'src/gen.o',
+                     'src/build/keep.c', 'src/sub/deep.c']:
+            path = join(self.folder, path)
+            if not isdir(dirname(path)):
+                makedirs(dirname(path))
+            open(path, 'w').close()
+        symlink(join(self.folder, 'src'), join(self.folder, 'link_to_src'))
+        symlink(join(self.folder, 'main.c'), join(self.folder, 'link.c'))
+        symlink(join(self.folder, 'missing'), join(self.folder, 'dangling'))
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def test_walk(self):
+        """Leave out ignored and dangling things, and list symlinks without
+        descending into them."""
+        class Tree(object):
+            source_folder = self.folder
+            ignore_patterns = ['*.o', '.hg']
+            ignore_paths = ['/build/']
+        eq_([(rel_path,
+              [f.name for f in folders],
+              [f.name for f in files])
+             for rel_path, folders, files in _walk_source(Tree())],
+            [('', ['link_to_src', 'src'], ['README', 'link.c', 'main.c']),
+             ('src', ['build', 'sub'], ['util.c']),
+             ('src/build', [], ['keep.c']),
+             ('src/sub', [], ['deep.c'])])
+
+    def test_dir_entry(self):
+        """The stand-in for scandir's entries should follow symlinks except
+        in is_symlink()."""
+        link = _DirEntry(self.folder, 'link_to_src')
+        ok_(link.is_symlink())
+        ok_(link.is_dir())
+        eq_(link.stat().st_ino, stat(join(self.folder, 'src')).st_ino)
+        main = _DirEntry(self.folder, 'main.c')
+        ok_(not main.is_symlink())
+        ok_(not main.is_dir())
+        eq_(main.stat().st_ino, stat(join(self.folder, 'main.c')).st_ino)
+
+
+class LargeFileTests(TestCase):
+    """Tests for the size cap of file-ingestion workers"""
+
+    def setUp(self):
+        self.folder = mkdtemp()
+        with open(join(self.folder, 'big.txt'), 'w') as file:
+            file.write('line one\nline two\n' + 'x' * 9000)
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def _read(self, policy):
+        [(name, hash, icon, data)] = _read_files(self.folder, ['big.txt'],
+                                                 12, policy)
+        return icon, data
+
+    def test_skip(self):
+        eq_(self._read('skip'), (None, None))
+
+    def test_path(self):
+        eq_(self._read('path'), ('mimetypes/txt', ''))
+
+    def test_truncate(self):
+        """Make sure truncation happens at a line break."""
+        eq_(self._read('truncate'), ('mimetypes/txt', 'line one\n'))
+
+    def test_under_limit(self):
+        """Make sure files no bigger than the limit are read whole, even when
+        they're big enough to be mapped into memory."""
+        [(name, hash, icon, data)] = _read_files(self.folder, ['big.txt'],
+                                                 20000, 'skip')
+        eq_(data, 'line one\nline two\n' + 'x' * 9000)
+
+
+class HtmlBatchesTests(TestCase):
+    """Tests for dividing HTML work among workers"""
+
+    def test_biggest_first(self):
+        """Make sure batches come out biggest first, about even in size, and
+        with any file too big for a batch alone in one."""
+        eq_(_html_batches([(1, 10), (2, 1000), (3, 30), (4, 40), (5, 20)], 1),
+            [([2], 1000), ([4, 3, 5, 1], 100)])
+
+    def test_empty(self):
+        eq_(_html_batches([], 4), [])
+
+
+class _IndexedTreeTestCase(TestCase):
+    """Abstract test case which indexes a tree of ``files``, a list of (path,
+    text) pairs, in a temporary instance configured with ``options``"""
+
+    files = []
+    options = ''
+
+    def setUp(self):
+        self.instance = mkdtemp()
+        for path, text in self.files:
+            self._write(path, text)
+        makedirs(join(self.instance, 'temp'))
+        makedirs(join(self.instance, 'target', 'trees', 'code'))
+        with open(join(self.instance, 'dxr.config'), 'w') as file:
+            file.write("[DXR]\n"
+                       "temp_folder = {0}/temp\n"
+                       "target_folder = {0}/target\n"
+                       "{1}\n"
+                       "[code]\n"
+                       "source_folder = {0}/code\n"
+                       "object_folder = {0}/code\n"
+                       "build_command = make -j $jobs\n".format(self.instance,
+                                                               self.options))
+        self.config = Config(join(self.instance, 'dxr.config'))
+        [self.tree] = self.config.trees
+        self.conn = connect_database(self.tree)
+        create_tables(self.tree, self.conn)
+        index_files(self.tree, self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+        rmtree(self.instance)
+        # Don't keep writing compiled templates to the deleted temp folder:
+        dxr.utils._template_env = None
+
+    def _write(self, path, text):
+        path = join(self.instance, 'code', path)
+        if not isdir(dirname(path)):
+            makedirs(dirname(path))
+        with open(path, 'w') as file:
+            file.write(text)
+
+
+class IndexFilesTests(_IndexedTreeTestCase):
+    """Tests for storing the contents of files as blobs"""
+
+    files = [('a.txt', 'same\n'),
+             ('b.txt', 'same\n'),
+             ('sub/c.txt', 'other\n')]
+    options = 'enabled_plugins = pygmentize\ndisable_workers = 1'
+
+    def _blobs(self):
+        """Return the paths of the files of each blob, and the blobs with
+        text."""
+        blobs = dict((id, []) for id, in
+                     self.conn.execute("SELECT id FROM blobs"))
+        for path, blob_id in self.conn.execute(
+                "SELECT path, blob_id FROM files ORDER BY path"):
+            blobs[blob_id].append(path)
+        texts = sorted(id for id, in
+                       self.conn.execute("SELECT id FROM trg_index"))
+        return sorted(blobs.itervalues()), texts == sorted(blobs)
+
+    def test_shared(self):
+        """Files with identical contents should share one blob."""
+        eq_(self._blobs(), ([['a.txt', 'b.txt'], ['sub/c.txt']], True))
+
+    def test_orphans(self):
+        """Rebuilding should delete the blobs no file has anymore, but keep
+        those still shared."""
+        self._write('a.txt', 'new\n')
+        remove(join(self.instance, 'code', 'sub', 'c.txt'))
+        index_files(self.tree, self.conn, incremental=True)
+        eq_(self._blobs(), ([['a.txt'], ['b.txt']], True))
+
+
+class HtmlWorkerTests(_IndexedTreeTestCase):
+    """Tests for setting up HTML workers once, rather than once per batch"""
+
+    files = [('%s.txt' % i, 'file %s\n' % i) for i in range(24)]
+    options = ('enabled_plugins = counter\n'
+               'plugin_folder = %(temp_folder)s/plugins')
+
+    def setUp(self):
+        super(HtmlWorkerTests, self).setUp()
+        # A plugin which notes the process of each setup:
+        folder = join(self.config.plugin_folder, 'counter')
+        makedirs(folder)
+        with open(join(folder, 'htmlifier.py'), 'w') as file:
+            file.write("import os\n"
+                       "def load(tree, conn):\n"
+                       "    with open(os.path.join(tree.target_folder, "
+                       "'loads'), 'a') as file:\n"
+                       "        file.write('%s\\n' % os.getpid())\n"
+                       "def htmlify(path, text):\n"
+                       "    return None\n")
+        makedirs(self.tree.log_folder)
+
+    def tearDown(self):
+        if dxr.build._html_worker_state is not None:
+            dxr.build._html_worker_state[1].close()
+            dxr.build._html_worker_state = None
+        super(HtmlWorkerTests, self).tearDown()
+
+    def _build(self, disable_workers, nb_jobs):
+        """Build the HTML, and return the processes set up, in order, and how
+        many batches there were."""
+        self.config.disable_workers = disable_workers
+        self.tree.config.nb_jobs = nb_jobs
+        run_html_workers(self.tree, self.config, self.conn)
+        with open(join(self.tree.target_folder, 'loads')) as file:
+            loads = [int(pid) for pid in file]
+        batches = [f for f in listdir(self.tree.log_folder)
+                   if f.startswith('build-html-')]
+        return loads, len(batches)
+
+    def test_inline(self):
+        """Without workers, this process should be set up once."""
+        loads, batches = self._build('1', 4)
+        eq_(loads, [getpid()])
+        ok_(batches > 1)
+
+    def test_pool(self):
+        """Each worker should be set up once, and reused for later batches."""
+        loads, batches = self._build('', 2)
+        eq_(len(set(loads)), len(loads))
+        ok_(0 < len(loads) <= 2)
+        ok_(getpid() not in loads)
+        ok_(batches > 2)
+
+
+class IndexWhileBuildingTests(TestCase):
+    """Tests for sharing processes between the build command and indexing"""
+
+    def setUp(self):
+        self.folder = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.folder)
+        dxr.build._job_budget = None
+
+    def _jobs(self, nb_jobs):
+        """Return how many processes the build command and indexing got."""
+        class Config(object):
+            plugin_folder = self.folder
+        class Tree(object):
+            name = 'code'
+            enabled_plugins = []
+            source_folder = object_folder = log_folder = self.folder
+            build_command = 'echo $jobs > jobs'
+        Tree.config = Config()
+        Config.nb_jobs = nb_jobs
+        indexing_jobs = []
+        build_tree(Tree(), sqlite3.connect(':memory:'), False,
+                   while_building=indexing_jobs.append)
+        with open(join(self.folder, 'jobs')) as file:
+            return int(file.read()), indexing_jobs[0]
+
+    def test_split(self):
+        """The two should use no more processes together than configured."""
+        eq_(self._jobs(4), (2, 2))
+        eq_(self._jobs(5), (3, 2))
+        eq_(self._jobs(1), (1, 1))
+
+    def test_budget(self):
+        """Under a shared budget, they should split what the tree got."""
+        dxr.build._job_budget = _JobBudget(3)
+        eq_(self._jobs(8), (2, 1))
+
+
+class GzippedHtmlTests(TestCase):
+    """Tests for serving the gzipped pages of the html_compression option"""
+
+    def setUp(self):
+        self.instance = mkdtemp()
+        tree_folder = join(self.instance, 'trees', 'code')
+        makedirs(tree_folder)
+        with open(join(self.instance, 'config.py'), 'w') as file:
+            file.write("TREES = {'code': ''}\n"
+                       "WWW_ROOT = ''\n"
+                       "GENERATED_DATE = ''\n"
+                       "DIRECTORY_INDEX = '.dxr-directory-index.html'\n")
+        gzipped = GzipFile(join(tree_folder, 'main.c.html.gz'), 'wb')
+        gzipped.write('<p>main</p>')
+        gzipped.close()
+        self.client = make_app(self.instance).test_client()
+
+    def tearDown(self):
+        rmtree(self.instance)
+
+    def test_gzip_accepted(self):
+        """Send the gzipped page as is to clients that accept gzip."""
+        response = self.client.get('/code/source/main.c',
+                                   headers={'Accept-Encoding': 'gzip'})
+        eq_(response.status_code, 200)
+        eq_(response.headers['Content-Encoding'], 'gzip')
+        eq_(GzipFile(fileobj=StringIO(response.data)).read(), '<p>main</p>')
+
+    def test_gzip_not_accepted(self):
+        """Decompress the page for clients that don't accept gzip."""
+        response = self.client.get('/code/source/main.c')
+        eq_(response.status_code, 200)
+        ok_('Content-Encoding' not in response.headers)
+        eq_(response.data, '<p>main</p>')
+
+
+class PageCacheTests(TestCase):
+    """Tests for the cache of pages rendered on demand"""
+
+    def setUp(self):
+        self.folder = mkdtemp()
+        self.rendered = []
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def _render(self, path):
+        """Return a render callable that writes a 100-byte page, or reports
+        there's no such file if ``path`` is None."""
+        def render(out_path):
+            self.rendered.append(path)
+            if path is None:
+                return False
+            with open(out_path, 'w') as file:
+                file.write(path.encode('utf-8') * (100 / len(path)))
+            return True
+        return render
+
+    def _page(self, cache, path, generation='1'):
+        return cache.page('code', generation, path, self._render(path))
+
+    def test_hits(self):
+        """Render pages once, and serve them from memory or disk after."""
+        cache = PageCache(self.folder, 1000, memory_size=1000)
+        eq_(self._page(cache, 'a'), 'a' * 100)
+        eq_(self._page(cache, 'a'), 'a' * 100)
+        eq_(PageCache(self.folder, 1000).page('code', '1', 'a', None),
+            'a' * 100)
+        eq_(self.rendered, ['a'])
+
+    def test_missing(self):
+        """Don't cache the absence of files."""
+        cache = PageCache(self.folder, 1000)
+        eq_(cache.page('code', '1', 'a', self._render(None)), None)
+        eq_(cache.page('code', '1', 'a', self._render(None)), None)
+        eq_(self.rendered, [None, None])
+
+    def test_eviction(self):
+        """Evict the least recently used pages from disk once it's full."""
+        cache = PageCache(self.folder, 250, memory_size=0)
+        for path in ['a', 'b', 'a', 'c', 'a', 'b']:
+            self._page(cache, path)
+        eq_(self.rendered, ['a', 'b', 'c', 'b'])
+
+    def test_generations(self):
+        """Rerender pages for new generations, and throw out the old ones."""
+        cache = PageCache(self.folder, 1000)
+        self._page(cache, 'a')
+        self._page(cache, 'a', generation='2')
+        eq_(self.rendered, ['a', 'a'])
+        eq_(listdir(join(self.folder, 'code')), ['2'])
+
+    def test_non_ascii_path(self):
+        """Cache the pages of files with non-ASCII names."""
+        cache = PageCache(self.folder, 1000, memory_size=0)
+        path = u'caf\xe9.py'
+        eq_(self._page(cache, path), path.encode('utf-8') * 14)
+        eq_(self._page(cache, path), path.encode('utf-8') * 14)
+        eq_(self.rendered, [path])
+
+
+def _load_vcs():
+    """Load the omniglot plugin's vcs module."""
+    folder = join(dirname(dxr.__file__), 'plugins', 'omniglot')
+    file, path, description = imp.find_module('vcs', [folder])
+    try:
+        return imp.load_module('dxr.plugins.omniglot_vcs', file, path,
+                               description)
+    finally:
+        file.close()
+
+
+vcs = _load_vcs()
+
+
+def _repository(vcs_class, root, **state):
+    """Return a VCS of the given class without running any of its commands."""
+    repository = object.__new__(vcs_class)
+    repository.__dict__.update(state, root=root, untracked_files=set())
+    return repository
+
+
+class RepositoryTests(TestCase):
+    """Tests for finding and saving the repositories of a tree"""
+
+    def setUp(self):
+        self.outer = _repository(vcs.Mercurial, '/src', revision='abc',
+                                 upstream='https://hg.example.com/src/')
+        self.inner = _repository(vcs.Git, '/src/third_party/lib',
+                                 revision='0123456789abcdef',
+                                 upstream='https://github.com/lib/lib')
+        self.trie = vcs.RepositoryTrie({'/src': self.outer,
+                                    '/src/third_party/lib': self.inner})
+
+    def test_nested(self):
+        """Paths should be found in every repository containing them, deepest
+        first."""
+        eq_(self.trie.containing('/src/third_party/lib/a.c'),
+            [self.inner, self.outer])
+        eq_(self.trie.containing('/src/third_party/lib'),
+            [self.inner, self.outer])
+        eq_(self.trie.containing('/src/main.c'), [self.outer])
+
+    def test_outside(self):
+        """Paths outside every repository should be in none, even if a root is
+        a prefix of their names."""
+        eq_(self.trie.containing('/elsewhere/a.c'), [])
+        eq_(self.trie.containing('/srcs/a.c'), [])
+        eq_(self.trie.containing('/src/third_party/library/a.c'),
+            [self.outer])
+
+    def test_save_load(self):
+        """Loading saved repositories should give back their classes and
+        state."""
+        folder = mkdtemp()
+        try:
+            self.inner.untracked_files.add('build/out.o')
+            path = join(folder, 'repositories')
+            vcs.save_repositories({'/src': self.outer,
+                               '/src/third_party/lib': self.inner}, path)
+            loaded = vcs.load_repositories(path)
+        finally:
+            rmtree(folder)
+        eq_(sorted(loaded), ['/src', '/src/third_party/lib'])
+        for root, repository in [('/src', self.outer),
+                                 ('/src/third_party/lib', self.inner)]:
+            eq_(type(loaded[root]), type(repository))
+            eq_(loaded[root].__dict__, repository.__dict__)
+        eq_(loaded['/src/third_party/lib'].generate_raw('a.c'),
+            'https://github.com/lib/lib/raw/0123456789abcdef/a.c')
+        ok_(not loaded['/src/third_party/lib'].is_tracked('build/out.o'))
+
+
+class StableIdTests(TestCase):
+    def test_stable(self):
+        """IDs should depend only on their parts and fit in a SQLite INTEGER."""
+        id = stable_id('scope', 'main.cpp', 3, 7)
+        eq_(id, stable_id('scope', 'main.cpp', 3, 7))
+        ok_(0 < id < 2 ** 63)
+        ok_(id != stable_id('scope', 'main.cpp', 3, 8))
+        ok_(id != stable_id('variable', 'main.cpp', 3, 7))
+
+    def test_non_ascii(self):
+        """Unicode parts should be hashed as UTF-8."""
+        eq_(stable_id('scope', u'caf\xe9.cpp', 3, 7),
+            stable_id('scope', 'caf\xc3\xa9.cpp', 3, 7))
+        eq_(stable_id(u'scope', 'main.cpp', 3, 7),
+            stable_id('scope', 'main.cpp', 3, 7))
+
+
+def _symbol_database():
+    """Return a connection to an in-memory database with the tables of the
+    common schema and the clang plugin, and symbol_trg."""
+    folder = join(dirname(dxr.__file__), 'plugins', 'clang')
+    file, path, description = imp.find_module('indexer', [folder])
+    try:
+        clang = imp.load_module('dxr.plugins.clang_indexer', file, path,
+                                description)
+    finally:
+        file.close()
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(language_schema.get_create_sql())
+    conn.executescript(clang.schema.get_create_sql())
+    conn.execute("CREATE VIRTUAL TABLE symbol_trg USING trilite")
+    return conn
+
+
+class QueryPlanTests(TestCase):
+    """Make sure indexes serve the SQL of the search filters."""
+
+    def setUp(self):
+        self.conn = _symbol_database()
+        self.scans = []
+
+    def _explain(self, sql, params):
+        """Note any whole-table scans in the plan of some SQL, other than the
+        one of the files table every search does and lookups in trilite
+        tables."""
+        for row in self.conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            match = re.match(r'SCAN (?:TABLE )?(\w+)', row[-1])
+            if (match and match.group(1) != 'files' and
+                    'VIRTUAL TABLE' not in row[-1]):
+                self.scans.append((row[-1], sql))
+        return []
+
+    def test_no_table_scans(self):
+        """Filters and their extent queries shouldn't scan whole tables,
+        whether their terms are negated, qualified, or have wildcards."""
+        for filter in filters:
+            if isinstance(filter, TriLiteSearchFilter):
+                continue  # Trilite's index takes care of itself.
+            for name, arg, negated, qualified in product(
+                    filter.names(), ['foo', 'foo*', '*foo*'], [False, True],
+                    [False, True]):
+                terms = {name: [{'arg': arg,
+                                 'not': negated,
+                                 'case_sensitive': False,
+                                 'qualified': qualified}]}
+                for sql, params, _ in filter.filter(terms):
+                    self._explain('SELECT files.id FROM files WHERE ' + sql,
+                                  params)
+                for extents in filter.extents(
+                        terms,
+                        lambda sql, params: self._explain(sql, params),
+                        1):
+                    list(extents)
+        eq_(self.scans, [])
+
+
+class TrigramQueryTests(TestCase):
+    """Tests for deciding when to look names up in symbol_trg"""
+
+    def test_leading_wildcard(self):
+        """Take the longest literal run of patterns starting with wildcards."""
+        eq_(trigram_query('*foo*'), 'isubstr:foo')
+        eq_(trigram_query('?get*Element?ById'), 'isubstr:Element')
+
+    def test_no_lookup(self):
+        """B-tree indexes serve the rest, and trigrams need 3 characters."""
+        eq_(trigram_query('foo*'), None)
+        eq_(trigram_query('foo'), None)
+        eq_(trigram_query('*fo*o'), None)
+
+
+class SymbolNameSearchTests(TestCase):
+    """Tests for searching names with leading wildcards through symbol_trg"""
+
+    def setUp(self):
+        self.conn = conn = _symbol_database()
+        for id, path in [(1, 'a.c'), (2, 'b.c')]:
+            conn.execute("INSERT INTO files (id, path, icon, encoding, "
+                         "blob_id) VALUES (?, ?, 'c', 'utf-8', ?)",
+                         [id, path, id])
+        for id, name, file_id, start in [(10, 'get_foo_bar', 1, 20),
+                                         (11, 'bar', 2, 30)]:
+            conn.execute("INSERT INTO functions (id, name, qualname, args, "
+                         "type, file_id, file_line, file_col, extent_start, "
+                         "extent_end) VALUES (?, ?, ?, '()', 'void', ?, 1, 1, "
+                         "?, ?)",
+                         [id, name, name, file_id, start, start + len(name)])
+        for msg, file_id in [('unused variable', 1), ('missing return', 2)]:
+            conn.execute("INSERT INTO warnings (msg, file_id, file_line, "
+                         "file_col, extent_start, extent_end) "
+                         "VALUES (?, ?, 1, 1, 0, 5)", [msg, file_id])
+        index_symbol_names(conn)
+
+    def _paths(self, name, arg, negated=False):
+        """Return the paths of the files a term matches."""
+        filter = [f for f in filters if name in f.names()][0]
+        terms = {name: [{'arg': arg,
+                         'not': negated,
+                         'case_sensitive': False,
+                         'qualified': False}]}
+        paths = []
+        for sql, params, _ in filter.filter(terms):
+            paths.extend(path for path, in self.conn.execute(
+                'SELECT path FROM files WHERE ' + sql + ' ORDER BY path',
+                params))
+        return paths
+
+    def test_symbols(self):
+        """Find symbols by substrings of their names, in any case."""
+        eq_(self._paths('function', '*FOO*'), ['a.c'])
+        eq_(self._paths('function', '*bar'), ['a.c', 'b.c'])
+        eq_(self._paths('function', '*foo*', negated=True), ['b.c'])
+
+    def test_extents(self):
+        """Highlight the matching symbols."""
+        filter = [f for f in filters if 'function' in f.names()][0]
+        terms = {'function': [{'arg': '*foo*',
+                               'not': False,
+                               'case_sensitive': False,
+                               'qualified': False}]}
+        eq_([list(extents) for extents in filter.extents(
+                terms, lambda sql, params: self.conn.execute(sql, params), 1)],
+            [[(20, 31, [])]])
+
+    def test_not_symbols(self):
+        """Leave filters on things other than symbol names, like warnings,
+        alone."""
+        eq_(self._paths('warning', '*unused*'), ['a.c'])
+        eq_(self._paths('warning', '*unused*', negated=True), ['b.c'])